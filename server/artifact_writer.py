@@ -0,0 +1,112 @@
+"""Background, atomic writer for derived on-disk artifacts (e.g. ``schema.csv``).
+
+Artifacts are derived from a database and its description CSVs, so each one
+is stored together with the fingerprint of the sources it was rendered from
+(in a ``<artifact>.fingerprint`` sidecar). A write is skipped when the sidecar
+already matches, and otherwise goes to a temp file in the same directory that
+is then renamed over the target, so readers never see a partial file and
+concurrent sessions can no longer interleave their writes.
+"""
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import get_logger
+
+log = get_logger(__name__)
+
+
+def write_atomic(path, text, encoding='utf-8'):
+    """Write ``text`` to ``path`` via a temp file and an atomic rename."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=directory)
+    try:
+        os.close(fd)
+        _write_text(tmp_path, text, encoding)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _write_text(path, text, encoding='utf-8'):
+    with open(path, 'w', encoding=encoding, newline='') as f:
+        f.write(text)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def fingerprint_path(path):
+    return f"{path}.fingerprint"
+
+
+def is_fresh(path, fingerprint):
+    """Return True if ``path`` exists and was rendered from ``fingerprint``."""
+    if not os.path.exists(path):
+        return False
+    try:
+        with open(fingerprint_path(path), 'r', encoding='utf-8') as f:
+            return f.read().strip() == fingerprint
+    except OSError:
+        return False
+
+
+class ArtifactWriter:
+    """Serializes artifact writes on one background thread.
+
+    ``submit`` never blocks on disk I/O: staleness checks, rendering and the
+    write itself all happen on the writer thread. If the same artifact is
+    submitted again before its write starts, only the latest version is written.
+    """
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="artifact-writer")
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def submit(self, path, fingerprint, render):
+        """Schedule ``render()`` to be written to ``path`` unless it is already fresh."""
+        return self._enqueue(path, fingerprint, lambda tmp_path: _write_text(tmp_path, render()))
+
+    def submit_file(self, path, fingerprint, build):
+        """Like :meth:`submit` for binary artifacts: ``build(tmp_path)`` creates the file."""
+        return self._enqueue(path, fingerprint, build)
+
+    def _enqueue(self, path, fingerprint, build):
+        with self._lock:
+            already_queued = path in self._pending
+            self._pending[path] = (fingerprint, build)
+        if not already_queued:
+            return self._executor.submit(self._write, path)
+        return None
+
+    def _write(self, path):
+        with self._lock:
+            fingerprint, build = self._pending.pop(path)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            if is_fresh(path, fingerprint):
+                return False
+            build(tmp_path)
+            os.replace(tmp_path, path)
+            write_atomic(fingerprint_path(path), fingerprint)
+            return True
+        except Exception as e:
+            log.warning("could not write artifact", path=path, error=repr(e))
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return False
+
+    def flush(self):
+        """Block until every artifact submitted so far has been written."""
+        self._executor.submit(lambda: None).result()
+
+
+# Shared by every writer of schema artifacts in the process
+artifact_writer = ArtifactWriter()
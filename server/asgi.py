@@ -0,0 +1,262 @@
+"""Async (ASGI) serving mode with the same /api/sql/* contract as server.py.
+
+The Flask app holds a worker thread for every request while it waits on the
+LLM. Here every LLM call of the pipeline is awaited instead, so one process
+can keep hundreds of sessions in flight. Blocking work that is not LLM I/O
+(building a schema catalog, executing SQL) runs in worker threads.
+
+Run with ``hypercorn asgi:app --bind 0.0.0.0:8765`` from the ``server``
+directory, or ``python asgi.py``. Requires ``pip install quart``.
+"""
+import asyncio
+import json
+import os
+
+try:
+    from quart import Quart, Response, jsonify, request
+except ImportError as e:
+    raise ImportError("The async serving mode requires Quart: pip install quart") from e
+
+from config import SPECULATIVE_RAW_SQL
+from server import (
+    agenerate_sql,
+    aiter_sql_generation,
+    analysis_payload,
+    asql_generator,
+    attach_question_rewriter,
+    clarification_message,
+    clarification_payload,
+    compare_payload,
+    error_status,
+    route_label,
+    trace_payload,
+    find_solve_session,
+    needs_clarification,
+    open_session,
+    sessions,
+    sse_event,
+    store_sql,
+)
+from metrics import CONTENT_TYPE, HTTP_RESPONSES, render
+from result_encoding import encode_json
+from tracing import get_logger, request_trace, set_session, traced_request
+from utils import add_semicolon_if_missing, parse_schema_text, sanitize_sql
+
+app = Quart(__name__)
+log = get_logger(__name__)
+
+
+@app.after_request
+async def add_cors_headers(response):
+    if request.path.startswith("/api/"):
+        response.headers["Access-Control-Allow-Origin"] = "*"
+        response.headers["Access-Control-Allow-Headers"] = "Content-Type"
+        response.headers["Access-Control-Allow-Methods"] = "GET, POST, OPTIONS"
+    return response
+
+
+async def start_analysis(data):
+    # Session store calls may do blocking backend I/O and rebuild a session
+    current_session = await asyncio.to_thread(open_session, data)
+    # Catalog loading reads the database and description files
+    qr_instance = await asyncio.to_thread(attach_question_rewriter, current_session)
+    if SPECULATIVE_RAW_SQL:
+        question = current_session.question
+        current_session.set_raw_sql(question, asyncio.ensure_future(
+            agenerate_sql(question, None, qr_instance.schema_generator.formatted_full_schema)
+        ))
+    return current_session, qr_instance
+
+
+async def run_clarification(qr_instance, data):
+    response_json = await qr_instance.aambi_correction(message=clarification_message(data))
+    log.debug("clarification response", response=response_json)
+    return json.loads(response_json)
+
+
+def event_stream(generate, trace_name, session_id=None):
+    async def traced():
+        with request_trace(trace_name, session_id):
+            async for event in generate():
+                yield event
+
+    return Response(traced(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+@app.route("/api/sql/analyze", methods=["POST"])
+@traced_request("analyze")
+async def analyze_sql_query():
+    try:
+        data = await request.get_json()
+        dialect = data.get("dialect", "SQLite")
+        current_session, qr_instance = await start_analysis(data)
+
+        # Detect first: a cached detection result also restores the linked schema
+        response_json = await qr_instance.aambi_detection()
+        log.debug("analysis response", response=response_json)
+
+        parsed_schema = parse_schema_text(await qr_instance.schema_generator.aget_db_schema())
+        return jsonify(await asyncio.to_thread(analysis_payload, current_session, parsed_schema, dialect, response_json)), 200
+    except Exception as e:
+        return jsonify({"error": str(e), "message": "Error processing schema analysis"}), error_status(e)
+
+
+@app.route("/api/sql/analyze/stream", methods=["POST"])
+async def analyze_sql_query_stream():
+    """Streaming variant of /api/sql/analyze; same events as the Flask endpoint."""
+    data = await request.get_json() or {}
+
+    async def generate():
+        detection = None
+        try:
+            dialect = data.get("dialect", "SQLite")
+            current_session, qr_instance = await start_analysis(data)
+            yield sse_event("session", {"session_id": current_session.session_id})
+
+            # Detection runs alongside schema linking; it does not need the linked schema
+            events = asyncio.Queue()
+            detection = asyncio.ensure_future(qr_instance.aambi_detection(
+                on_ambiguity=lambda index, item: events.put_nowait({"index": index, "ambiguity": item})
+            ))
+
+            parsed_schema = parse_schema_text(await qr_instance.schema_generator.aget_db_schema())
+            yield sse_event("schema", {"suggested_schema": parsed_schema})
+
+            while not (detection.done() and events.empty()):
+                getter = asyncio.ensure_future(events.get())
+                await asyncio.wait({getter, detection}, return_when=asyncio.FIRST_COMPLETED)
+                if getter.done():
+                    yield sse_event("ambiguity", getter.result())
+                else:
+                    getter.cancel()
+            response_json = detection.result()
+            log.debug("analysis response", response=response_json)
+            yield sse_event("done", await asyncio.to_thread(
+                analysis_payload, current_session, parsed_schema, dialect, response_json
+            ))
+        except Exception as e:
+            yield sse_event("error", {"status": error_status(e), "error": str(e), "message": "Error processing schema analysis"})
+        finally:
+            if detection is not None and not detection.done():
+                detection.cancel()
+
+    return event_stream(generate, "analyze_stream")
+
+
+@app.route("/api/sql/solve", methods=["POST"])
+@traced_request("solve")
+async def solve_ambiguities():
+    try:
+        data = await request.get_json()
+        current_session, error = await asyncio.to_thread(find_solve_session, data)
+        if error is not None:
+            return jsonify(error[0]), error[1]
+        qr_instance = current_session.question_rewriter_instance
+
+        parsed_response = await run_clarification(qr_instance, data)
+        if needs_clarification(parsed_response):
+            return jsonify(await asyncio.to_thread(clarification_payload, current_session, parsed_response)), 200
+
+        # Raw SQL answers the original question; clarified SQL the refined one with evidence
+        original_q = current_session.question or ""
+        refined_q = parsed_response.get('question', original_q)
+        sql_raw, sql_clarified = await asql_generator(
+            original_q, refined_q, parsed_response.get('evidence'),
+            qr_instance.schema_generator.formatted_full_schema,
+            raw_task=current_session.pop_raw_sql(original_q),
+        )
+        return jsonify(await asyncio.to_thread(store_sql, current_session, sql_raw, sql_clarified)), 200
+    except Exception as e:
+        log.exception("solve failed", error=repr(e))
+        return jsonify({"error": str(e), "message": "Error processing ambiguity resolution"}), error_status(e)
+
+
+@app.route("/api/sql/solve/stream", methods=["POST"])
+async def solve_ambiguities_stream():
+    """Streaming variant of /api/sql/solve; same events as the Flask endpoint."""
+    data = await request.get_json() or {}
+    current_session, error = await asyncio.to_thread(find_solve_session, data)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    session_id = current_session.session_id
+    qr_instance = current_session.question_rewriter_instance
+
+    async def generate():
+        try:
+            parsed_response = await run_clarification(qr_instance, data)
+            if needs_clarification(parsed_response):
+                yield sse_event("ambiguities", {"ambiguities": parsed_response['question_set']})
+                yield sse_event("done", await asyncio.to_thread(clarification_payload, current_session, parsed_response))
+                return
+
+            original_q = current_session.question or ""
+            refined_q = parsed_response.get('question', original_q)
+            yield sse_event("clarified", {"question": refined_q, "evidence": parsed_response.get('evidence')})
+            statements = {}
+            async for label, sql in aiter_sql_generation(
+                original_q, refined_q, parsed_response.get('evidence'),
+                qr_instance.schema_generator.formatted_full_schema,
+                raw_task=current_session.pop_raw_sql(original_q),
+            ):
+                statements[label] = sql
+                yield sse_event(f"sql_{label}", {"sql": add_semicolon_if_missing(sanitize_sql(sql))})
+            yield sse_event("done", await asyncio.to_thread(
+                store_sql, current_session, statements["raw"], statements["clarified"]
+            ))
+        except Exception as e:
+            log.exception("solve failed", error=repr(e))
+            yield sse_event("error", {"status": error_status(e), "error": str(e), "message": "Error processing ambiguity resolution"})
+
+    return event_stream(generate, "solve_stream", session_id)
+
+
+@app.after_request
+async def count_response(response):
+    HTTP_RESPONSES.inc(request.method, route_label(request), response.status_code)
+    return response
+
+
+@app.route("/api/sessions/<session_id>/trace")
+async def session_trace(session_id):
+    """Span trees of the session's recent analyze, solve and compare requests."""
+    payload, status = await asyncio.to_thread(trace_payload, session_id)
+    return jsonify(payload), status
+
+
+@app.route("/metrics")
+async def metrics():
+    """Prometheus metrics."""
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+@app.route("/")
+async def health_check():
+    """Server API checkpoint"""
+    return "Chat API is running (async mode)."
+
+
+@app.route("/api/sql/compare", methods=["POST"])
+@traced_request("compare")
+async def compare_sql():
+    try:
+        data = await request.get_json()
+        session_id = data.get("session_id")
+        if not session_id:
+            return jsonify({"error": "session_id is required"}), 400
+
+        current_session = await asyncio.to_thread(sessions.get, session_id)
+        if not current_session:
+            return jsonify({"error": "Session not found or expired"}), 404
+        set_session(session_id)
+
+        payload, status = await asyncio.to_thread(compare_payload, current_session, data)
+        body, headers = await asyncio.to_thread(encode_json, payload, request.headers.get("Accept-Encoding", ""))
+        return Response(body, status=status, headers=headers)
+    except Exception as e:
+        log.exception("compare failed", error=repr(e))
+        return jsonify({"error": str(e), "message": "Error processing SQL comparison"}), 500
+
+
+if __name__ == "__main__":
+    port = int(os.environ.get("PORT", 8765))
+    app.run(host="0.0.0.0", port=port)
@@ -4,6 +4,13 @@ import os
 from pathlib import Path
 
 
+def _env_flag(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ("1", "true", "yes", "on")
+
+
 # Resolve important directories
 SERVER_DIR = Path(__file__).resolve().parent
 # Assumes this file lives in <project_root>/server/config.py
@@ -15,16 +22,152 @@ DEFAULT_WORKDIR = PROJECT_ROOT / "minidev" / "dev_databases" / "database_descrip
 # Allow override via environment variable for flexibility (e.g., Streamlit, Docker)
 WORKDIR = Path(os.getenv("AMBISQL_WORKDIR", str(DEFAULT_WORKDIR)))
 
+# On-disk copies of built schema catalogs, so a restarted server warms up at once
+CATALOG_DIR = Path(os.getenv("AMBISQL_CATALOG_DIR", str(WORKDIR / "catalogs")))
+
+# Column profiling: rows read per table and number of most frequent values kept
+PROFILE_SAMPLE_ROWS = int(os.getenv("AMBISQL_PROFILE_SAMPLE_ROWS", "20000"))
+PROFILE_TOP_K = int(os.getenv("AMBISQL_PROFILE_TOP_K", "5"))
+
+# Lexical schema linking: skip the LLM when at most CONFIDENT_TABLES tables score
+# within CONFIDENT_RATIO of the best one; otherwise send only the TOP_N tables
+SCHEMA_INDEX_ENABLED = _env_flag("AMBISQL_SCHEMA_INDEX", True)
+SCHEMA_INDEX_TOP_N = int(os.getenv("AMBISQL_SCHEMA_INDEX_TOP_N", "6"))
+SCHEMA_INDEX_CONFIDENT_TABLES = int(os.getenv("AMBISQL_SCHEMA_INDEX_CONFIDENT_TABLES", "2"))
+SCHEMA_INDEX_CONFIDENT_RATIO = float(os.getenv("AMBISQL_SCHEMA_INDEX_CONFIDENT_RATIO", "0.6"))
+
+# Value index (<db>/<db>.values.sqlite): build it in the background when missing or stale
+VALUE_INDEX_AUTOBUILD = _env_flag("AMBISQL_VALUE_INDEX_AUTOBUILD", True)
+VALUE_INDEX_MAX_MATCHES = int(os.getenv("AMBISQL_VALUE_INDEX_MAX_MATCHES", "3"))
+
+# LLM response cache: comma-separated pipeline stages to cache (empty disables it).
+# Stages: schema_linking, ambiguity_detection, question_refine, choice_rewrite, node_merge
+LLM_CACHE_STAGES = [s.strip() for s in os.getenv("AMBISQL_LLM_CACHE_STAGES", "schema_linking,choice_rewrite").split(",") if s.strip()]
+LLM_CACHE_PATH = Path(os.getenv("AMBISQL_LLM_CACHE_PATH", str(WORKDIR / "llm_cache.sqlite")))
+LLM_CACHE_TTL = int(os.getenv("AMBISQL_LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("AMBISQL_LLM_CACHE_MAX_ENTRIES", "10000"))
+
+# Cache of whole ambiguity-detection results per (db, normalized question, schema version); 0 disables it
+QUESTION_CACHE_MAX_ENTRIES = int(os.getenv("AMBISQL_QUESTION_CACHE_MAX_ENTRIES", "1000"))
+QUESTION_CACHE_TTL = int(os.getenv("AMBISQL_QUESTION_CACHE_TTL", str(24 * 3600)))
+
+# Maximum number of concurrent choice-generation calls per analyze request
+CHOICE_REWRITE_CONCURRENCY = int(os.getenv("AMBISQL_CHOICE_REWRITE_CONCURRENCY", "5"))
+
+# Stream the ambiguity-detection response and start generating choices for each
+# ambiguity as soon as it has been streamed
+STREAM_DETECTION = _env_flag("AMBISQL_STREAM_DETECTION", True)
+
+# Text-to-SQL model used by /api/sql/solve, and threads available for its concurrent calls
+SQL_MODEL_ID = os.getenv("SQL_MODEL_ID", "gpt-4.1")
+SQL_GENERATION_WORKERS = int(os.getenv("AMBISQL_SQL_GENERATION_WORKERS", "8"))
+# Start the raw SQL during /api/sql/analyze so /api/sql/solve only waits for the clarified one
+SPECULATIVE_RAW_SQL = _env_flag("AMBISQL_SPECULATIVE_RAW_SQL", True)
+
+
+def _named_values(value: str, cast=int) -> dict:
+    """Parse ``name=value,name=value`` (e.g. per-model limits) into a dict."""
+    values = {}
+    for part in value.split(","):
+        if "=" in part:
+            name, item = part.rsplit("=", 1)
+            values[name.strip()] = cast(item)
+    return values
+
+
+# Shared LLM client pool: keep-alive HTTP connections, request timeout (seconds),
+# a global cap on in-flight LLM calls and optional per-model caps ("model=n,...")
+LLM_MAX_CONNECTIONS = int(os.getenv("AMBISQL_LLM_MAX_CONNECTIONS", "100"))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("AMBISQL_LLM_MAX_KEEPALIVE_CONNECTIONS", "20"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("AMBISQL_LLM_KEEPALIVE_EXPIRY", "60"))
+LLM_REQUEST_TIMEOUT = float(os.getenv("AMBISQL_LLM_REQUEST_TIMEOUT", "120"))
+LLM_MAX_CONCURRENCY = int(os.getenv("AMBISQL_LLM_MAX_CONCURRENCY", "32"))
+LLM_MODEL_CONCURRENCY = _named_values(os.getenv("AMBISQL_LLM_MODEL_CONCURRENCY", ""))
+
+# Provider quotas per model (0 = unlimited), with per-model overrides ("model=n,...").
+# Token use is estimated from the prompt size plus a typical completion length.
+LLM_RPM = int(os.getenv("AMBISQL_LLM_RPM", "0"))
+LLM_TPM = int(os.getenv("AMBISQL_LLM_TPM", "0"))
+LLM_MODEL_RPM = _named_values(os.getenv("AMBISQL_LLM_MODEL_RPM", ""))
+LLM_MODEL_TPM = _named_values(os.getenv("AMBISQL_LLM_MODEL_TPM", ""))
+LLM_COMPLETION_TOKEN_ESTIMATE = int(os.getenv("AMBISQL_LLM_COMPLETION_TOKEN_ESTIMATE", "300"))
+# Adaptive concurrency: per-model limit shrinks on 429s and on calls slower than
+# the latency target (seconds), and never goes below the minimum
+LLM_MIN_CONCURRENCY = int(os.getenv("AMBISQL_LLM_MIN_CONCURRENCY", "1"))
+LLM_LATENCY_TARGET = float(os.getenv("AMBISQL_LLM_LATENCY_TARGET", "30"))
+# Longest a rate-limited call keeps waiting and retrying before it fails (seconds)
+LLM_RATE_LIMIT_MAX_WAIT = float(os.getenv("AMBISQL_LLM_RATE_LIMIT_MAX_WAIT", "300"))
+
+# Retries of transient LLM failures (connection errors, timeouts, 5xx) with jittered
+# exponential backoff (seconds), overridable per stage ("stage=n,...")
+LLM_MAX_RETRIES = int(os.getenv("AMBISQL_LLM_MAX_RETRIES", "2"))
+LLM_STAGE_MAX_RETRIES = _named_values(os.getenv("AMBISQL_LLM_STAGE_MAX_RETRIES", ""))
+LLM_BACKOFF_BASE = float(os.getenv("AMBISQL_LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("AMBISQL_LLM_BACKOFF_MAX", "8"))
+# Hedged requests for short idempotent stages: once a call outlives the stage's
+# latency percentile, a duplicate is sent and the first answer wins
+LLM_HEDGE_STAGES = [s.strip() for s in os.getenv("AMBISQL_LLM_HEDGE_STAGES", "choice_rewrite,node_merge").split(",") if s.strip()]
+LLM_HEDGE_PERCENTILE = float(os.getenv("AMBISQL_LLM_HEDGE_PERCENTILE", "0.95"))
+LLM_STAGE_HEDGE_PERCENTILE = _named_values(os.getenv("AMBISQL_LLM_STAGE_HEDGE_PERCENTILE", ""), float)
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("AMBISQL_LLM_HEDGE_MIN_SAMPLES", "20"))
+
+# Request tracing: finished spans kept per session (ring buffer), sessions kept,
+# and an optional JSONL file every finished request trace is appended to
+TRACE_MAX_SPANS = int(os.getenv("AMBISQL_TRACE_MAX_SPANS", "500"))
+TRACE_MAX_SESSIONS = int(os.getenv("AMBISQL_TRACE_MAX_SESSIONS", "1000"))
+TRACE_EXPORT_PATH = os.getenv("AMBISQL_TRACE_EXPORT_PATH", "")
+
+# Logging: level and format ("text" for key=value lines, "json" for one JSON object per line)
+LOG_LEVEL = os.getenv("AMBISQL_LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("AMBISQL_LOG_FORMAT", "text").lower()
+
+# In-memory sessions: idle time-to-live (seconds), maximum number kept, and an
+# optional cap on their approximate total size in bytes (0 disables it)
+SESSION_TTL = int(os.getenv("AMBISQL_SESSION_TTL", str(3600)))
+SESSION_MAX_ENTRIES = int(os.getenv("AMBISQL_SESSION_MAX_ENTRIES", "1000"))
+SESSION_MAX_BYTES = int(os.getenv("AMBISQL_SESSION_MAX_BYTES", "0"))
+
+# Where sessions are persisted besides the in-memory cache: "memory" (this
+# process only) or "sqlite" (a file shared by every worker on the host)
+SESSION_BACKEND = os.getenv("AMBISQL_SESSION_BACKEND", "memory").strip().lower()
+SESSION_DB_PATH = Path(os.getenv("AMBISQL_SESSION_DB_PATH", str(WORKDIR / "sessions.sqlite")))
+
+# Read-only connection pool per database: connections kept, memory-mapped I/O
+# and page cache sizes per connection (bytes / KiB)
+DB_POOL_SIZE = int(os.getenv("AMBISQL_DB_POOL_SIZE", "4"))
+DB_MMAP_SIZE = int(os.getenv("AMBISQL_DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+DB_CACHE_SIZE_KIB = int(os.getenv("AMBISQL_DB_CACHE_SIZE_KIB", str(64 * 1024)))
+
+# Guardrails on executed SQL: seconds a query may run before it is interrupted
+# and rows returned per page (0 disables either limit)
+DB_QUERY_TIMEOUT = float(os.getenv("AMBISQL_DB_QUERY_TIMEOUT", "10"))
+DB_MAX_ROWS = int(os.getenv("AMBISQL_DB_MAX_ROWS", "1000"))
+# Threads executing the raw and clarified queries of /api/sql/compare concurrently
+DB_QUERY_WORKERS = int(os.getenv("AMBISQL_DB_QUERY_WORKERS", "8"))
+
+# Result diff of /api/sql/compare: rows hashed per side (0 for no limit; each
+# costs roughly 100 bytes while the diff runs, and hashing stops at the cap)
+# and example rows returned for each side's unmatched rows
+DIFF_MAX_ROWS = int(os.getenv("AMBISQL_DIFF_MAX_ROWS", "100000"))
+DIFF_SAMPLE_SIZE = int(os.getenv("AMBISQL_DIFF_SAMPLE_SIZE", "20"))
+
+# Compare responses at least this large (bytes) are gzipped for clients that accept it
+GZIP_MIN_BYTES = int(os.getenv("AMBISQL_GZIP_MIN_BYTES", "1024"))
+
 
 def ensure_directories() -> None:
-    """Ensure the workspace directory exists.
+    """Ensure the workspace directories exist.
 
     This avoids crashes like WinError 3 when code expects the directory
     to exist while reading/writing schema analysis artifacts.
     """
     WORKDIR.mkdir(parents=True, exist_ok=True)
+    CATALOG_DIR.mkdir(parents=True, exist_ok=True)
+    # Files the settings above may place in directories of their own
+    for path in (LLM_CACHE_PATH, SESSION_DB_PATH, TRACE_EXPORT_PATH):
+        if path:
+            Path(path).parent.mkdir(parents=True, exist_ok=True)
 
 
 # Ensure on import so any part of the app can rely on it
 ensure_directories()
-
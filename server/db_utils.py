@@ -1,33 +1,278 @@
-import pandas as pd
-import sqlite3
+"""Read-only access to the benchmark SQLite databases.
+
+Each database file gets a small pool of connections opened in read-only URI
+mode (``mode=ro``) with ``query_only`` set and pragmas tuned for analytic
+reads (memory-mapped I/O, a larger page cache, in-memory temp storage). The
+connections stay open across requests, so SQLite's page cache stays warm for
+both query execution and schema profiling. A pool is replaced when its file
+changes on disk.
+
+Queries run under guardrails: a deadline enforced by SQLite's progress handler
+(``AMBISQL_DB_QUERY_TIMEOUT``) and a cap on the rows returned
+(``AMBISQL_DB_MAX_ROWS``). A capped result carries an opaque cursor that
+fetches the next page.
+"""
+import base64
+import hashlib
+import json
 import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from config import DB_CACHE_SIZE_KIB, DB_MAX_ROWS, DB_MMAP_SIZE, DB_POOL_SIZE, DB_QUERY_TIMEOUT
+from metrics import timed
+from tracing import annotate, get_logger
+
+log = get_logger(__name__)
+
+
+def sqlite_path(path, db_name):
+    return os.path.join(path, db_name, f"{db_name}.sqlite")
+
+
+def _file_version(db_file):
+    st = os.stat(db_file)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+class ConnectionPool:
+    """Up to ``size`` read-only connections to one SQLite file, each used by one thread at a time."""
+
+    def __init__(self, db_file, size=DB_POOL_SIZE):
+        self.db_file = db_file
+        self.size = max(1, size)
+        self.version = _file_version(db_file)
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def _open(self):
+        connection = sqlite3.connect(
+            f"file:{quote(os.path.abspath(self.db_file))}?mode=ro", uri=True, check_same_thread=False
+        )
+        connection.execute("PRAGMA query_only = ON;")
+        connection.execute(f"PRAGMA mmap_size = {int(DB_MMAP_SIZE)};")
+        connection.execute(f"PRAGMA cache_size = {-int(DB_CACHE_SIZE_KIB)};")
+        connection.execute("PRAGMA temp_store = MEMORY;")
+        log.debug("opened read-only connection", db=self.db_file)
+        return connection
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._opened < self.size:
+                self._opened += 1
+                open_new = True
+            else:
+                open_new = False
+        if open_new:
+            try:
+                return self._open()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        return self._idle.get()
+
+    def _release(self, connection):
+        if connection.in_transaction:
+            connection.rollback()
+        if self._closed:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            self._release(connection)
+
+    def close(self):
+        """Close idle connections now and the others when they are given back."""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(path, db_name):
+    """Return the connection pool of a database, replacing it if the file changed."""
+    db_file = os.path.realpath(sqlite_path(path, db_name))
+    if not os.path.exists(db_file):
+        raise FileNotFoundError(f"Database file not found: {db_file}")
+    version = _file_version(db_file)
+    with _pools_lock:
+        pool = _pools.get(db_file)
+        if pool is None or pool.version != version:
+            if pool is not None:
+                pool.close()
+            pool = _pools[db_file] = ConnectionPool(db_file)
+    return pool
+
+
+@contextmanager
+def connect(path, db_name):
+    """Borrow a pooled read-only connection to ``db_name``."""
+    with get_pool(path, db_name).connection() as connection:
+        yield connection
+
+
+# SQLite virtual machine instructions between two deadline checks
+PROGRESS_INTERVAL = 1000
+
+
+class QueryResult:
+    """One page of a query's rows, with how it ended."""
+
+    def __init__(self, sql_query, offset=0):
+        self.sql_query = sql_query
+        self.offset = offset
+        self.columns = []
+        self.rows = []
+        self.truncated = False
+        self.timed_out = False
+        self.error = None
+        self.elapsed_ms = 0.0
+        # Hashes of every row, when run_query was given a digest
+        self.digest = None
+
+    @property
+    def success(self):
+        return self.error is None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.sql_query, self.offset + len(self.rows)) if self.truncated else None
+
+    def to_dict(self):
+        return {
+            "success": self.success,
+            "columns": self.columns,
+            "rows": self.rows,
+            "row_count": len(self.rows),
+            "offset": self.offset,
+            "truncated": self.truncated,
+            "next_cursor": self.next_cursor,
+            "timed_out": self.timed_out,
+            "elapsed_ms": self.elapsed_ms,
+            "error": self.error,
+        }
+
+
+def _sql_digest(sql_query):
+    return hashlib.sha1(sql_query.encode("utf-8")).hexdigest()[:16]
+
+
+def encode_cursor(sql_query, offset):
+    """Opaque token for the page of ``sql_query`` starting at row ``offset``."""
+    token = json.dumps({"offset": offset, "sql": _sql_digest(sql_query)}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(token.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(token, sql_query):
+    """Return the row offset of ``token``; ValueError if it is malformed or belongs to another query."""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(token.encode("ascii")))
+        offset = int(data["offset"])
+    except (ValueError, TypeError, KeyError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor: {token!r}") from e
+    if offset < 0 or data.get("sql") != _sql_digest(sql_query):
+        raise ValueError("Cursor does not belong to this query")
+    return offset
+
+
+class QueryTimeout(sqlite3.OperationalError):
+    """A query ran past its deadline and was interrupted."""
+
+
+@contextmanager
+def open_query(path, db_name, sql_query, timeout=DB_QUERY_TIMEOUT):
+    """Execute ``sql_query`` on a pooled connection and yield its cursor for streaming the rows.
+
+    Stepping the statement (executing or fetching) past ``timeout`` seconds
+    raises QueryTimeout; a falsy ``timeout`` disables the deadline.
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    with connect(path, db_name) as connection:
+        if deadline is not None:
+            # A non-zero return aborts the statement with "interrupted"
+            connection.set_progress_handler(lambda: time.monotonic() > deadline, PROGRESS_INTERVAL)
+        cursor = connection.cursor()
+        try:
+            cursor.execute(sql_query)
+            yield cursor
+        except sqlite3.OperationalError as e:
+            if deadline is not None and time.monotonic() > deadline and "interrupted" in str(e):
+                raise QueryTimeout(f"Query exceeded the {timeout:g}s time limit") from e
+            raise
+        finally:
+            cursor.close()
+            if deadline is not None:
+                connection.set_progress_handler(None, 0)
+
+
+@timed("sql_execution")
+def run_query(path, db_name, sql_query, max_rows=DB_MAX_ROWS, timeout=DB_QUERY_TIMEOUT, offset=0, digest=None):
+    """Run ``sql_query`` and return up to ``max_rows`` rows after the first ``offset`` as a QueryResult.
 
-def execute_query(path, db_name, sql_query):
-    """Execute the SQL query generated from JSON and return the results."""
-    """Connect to the SQLite database."""
-    connection = sqlite3.connect(os.path.join(path, db_name, f"{db_name}.sqlite"))
-    cursor = connection.cursor()
-    print(f"Connected to database: {db_name}")
+    The query is interrupted once it has run for ``timeout`` seconds (counting
+    the rows skipped to reach ``offset``); a falsy ``max_rows`` or ``timeout``
+    disables that limit. Errors are reported on the result, not raised.
 
-    # Execute the query and fetch the results
+    With a ``digest`` (``result_diff.RowDigest``), every row of the result,
+    not just the page, is fed to it within the same deadline and the digest is
+    attached to the result; running out of time there fails the digest only.
+    """
+    result = QueryResult(sql_query, offset)
+    result.digest = digest
+    started = time.monotonic()
     try:
-        cursor.execute(sql_query)
+        with open_query(path, db_name, sql_query, timeout) as cursor:
+            # Only statements that produce rows (SELECT/WITH) have a description
+            if cursor.description is not None:
+                result.columns = [column[0] for column in cursor.description]
+                skip = offset
+                while skip > 0:
+                    skipped = cursor.fetchmany(min(skip, 1000))
+                    if not skipped:
+                        break
+                    if digest is not None:
+                        digest.extend(skipped)
+                    skip -= len(skipped)
+                if max_rows:
+                    # One extra row tells whether there is a next page
+                    rows = cursor.fetchmany(max_rows + 1)
+                    result.truncated = len(rows) > max_rows
+                    result.rows = rows[:max_rows]
+                else:
+                    rows = result.rows = cursor.fetchall()
+                if digest is not None and digest.extend(rows) and result.truncated:
+                    digest.consume(cursor)
+    except QueryTimeout as e:
+        result.timed_out = True
+        result.error = str(e)
     except Exception as e:
-        print(sql_query)
-        print(e)
-    # If the SQL query is a SELECT/WITH statement, fetch the results
-    if sql_query.strip().upper().startswith("SELECT") or sql_query.strip().upper().startswith("WITH"):
-        query_result = cursor.fetchall()
-    else:
-        # For other types of SQL queries (like CREATE TABLE), return an empty list
-        query_result = []
-    
-    # Commit any changes (like creating tables or inserting data)
-    connection.commit()
-    
-    """Close the connection to the database."""
-    if connection:
-        connection.close()
-        print(f"Connection to database: {db_name} closed")
-
-    return query_result
\ No newline at end of file
+        result.error = str(e)
+    result.elapsed_ms = round((time.monotonic() - started) * 1000, 3)
+    if result.error is not None:
+        log.warning("query failed", db=db_name, sql=sql_query, error=result.error, timed_out=result.timed_out)
+    annotate(db=db_name, sql_chars=len(sql_query), rows=len(result.rows), offset=offset,
+             truncated=result.truncated, timed_out=result.timed_out)
+    return result
@@ -0,0 +1,175 @@
+"""Content-addressed, disk-backed cache of LLM responses.
+
+Responses are keyed by a hash of the model and the exact messages sent, and
+stored in a local SQLite file together with the token usage of the original
+call, which is counted as tokens saved on every hit. Entries expire after a
+TTL and the least recently used ones are evicted once the cache exceeds its
+size limit; hits only touch the file when their access times are flushed,
+every ``ACCESS_FLUSH_EVERY`` hits and before eviction. Only stages listed in
+``AMBISQL_LLM_CACHE_STAGES`` are cached.
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+from metrics import family, register_collector
+from config import (
+    LLM_CACHE_MAX_ENTRIES,
+    LLM_CACHE_PATH,
+    LLM_CACHE_STAGES,
+    LLM_CACHE_TTL,
+)
+
+
+def cache_key(model, messages):
+    payload = json.dumps({"model": model, "messages": messages}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class CachedResponse:
+    def __init__(self, content, prompt_tokens, completion_tokens, total_tokens):
+        self.content = content
+        self.prompt_tokens = prompt_tokens
+        self.completion_tokens = completion_tokens
+        self.total_tokens = total_tokens
+
+
+# Hits whose access time is kept in memory before it is written to the file
+ACCESS_FLUSH_EVERY = 64
+
+
+class LLMResponseCache:
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL, max_entries=LLM_CACHE_MAX_ENTRIES, stages=LLM_CACHE_STAGES):
+        self.path = str(path)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stages = frozenset(stages)
+        self.hits = Counter()
+        self.misses = Counter()
+        # Tokens the cached responses would have cost, by (stage, kind)
+        self.tokens_saved = Counter()
+        # key -> last access time not yet written to the file
+        self._accessed = {}
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                content TEXT NOT NULL,
+                prompt_tokens INTEGER NOT NULL,
+                completion_tokens INTEGER NOT NULL,
+                total_tokens INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                accessed_at REAL NOT NULL
+            );
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);")
+        self._conn.commit()
+
+    def enabled_for(self, stage):
+        return stage in self.stages
+
+    def get(self, model, messages, stage=None):
+        key = cache_key(model, messages)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, prompt_tokens, completion_tokens, total_tokens, created_at FROM responses WHERE key = ?;",
+                (key,),
+            ).fetchone()
+            if row is not None and self.ttl and now - row[4] > self.ttl:
+                self._conn.execute("DELETE FROM responses WHERE key = ?;", (key,))
+                self._conn.commit()
+                row = None
+            if row is None:
+                self.misses[stage] += 1
+                return None
+            self._accessed[key] = now
+            if len(self._accessed) >= ACCESS_FLUSH_EVERY:
+                self._flush_accessed()
+                self._conn.commit()
+            self.hits[stage] += 1
+            self.tokens_saved[(stage, "prompt")] += row[1]
+            self.tokens_saved[(stage, "completion")] += row[2]
+        return CachedResponse(row[0], row[1], row[2], row[3])
+
+    def _flush_accessed(self):
+        if self._accessed:
+            self._conn.executemany(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?;",
+                [(accessed_at, key) for key, accessed_at in self._accessed.items()],
+            )
+            self._accessed.clear()
+
+    def put(self, model, messages, content, prompt_tokens=0, completion_tokens=0, total_tokens=0):
+        key = cache_key(model, messages)
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?);",
+                (key, model, content, prompt_tokens, completion_tokens, total_tokens, now, now),
+            )
+            self._evict(now)
+            self._conn.commit()
+
+    def _evict(self, now):
+        # Eviction follows the access order, so pending hits count first
+        self._flush_accessed()
+        if self.ttl:
+            self._conn.execute("DELETE FROM responses WHERE created_at < ?;", (now - self.ttl,))
+        if self.max_entries:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM responses;").fetchone()
+            if count > self.max_entries:
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed_at LIMIT ?);",
+                    (count - self.max_entries,),
+                )
+
+    def stats(self):
+        """Return hit/miss counters and tokens saved per stage."""
+        with self._lock:
+            stages = set(self.hits) | set(self.misses)
+            return {
+                stage: {
+                    "hits": self.hits[stage],
+                    "misses": self.misses[stage],
+                    "prompt_tokens_saved": self.tokens_saved[(stage, "prompt")],
+                    "completion_tokens_saved": self.tokens_saved[(stage, "completion")],
+                }
+                for stage in stages
+            }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_llm_cache():
+    """Return the process-wide response cache, or None if no stage is cached."""
+    global _cache
+    if not LLM_CACHE_STAGES:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMResponseCache()
+    return _cache
+
+
+@register_collector
+def collect_cache_metrics():
+    stats = _cache.stats() if _cache is not None else {}
+    return family(
+        "ambisql_llm_cache_requests_total", "counter", "LLM response cache lookups per stage and result.",
+        [({"stage": stage or "", "result": result}, counts[key])
+         for stage, counts in stats.items() for result, key in (("hit", "hits"), ("miss", "misses"))],
+    ) + family(
+        "ambisql_llm_cache_tokens_saved_total", "counter", "Tokens the cached LLM responses served would have cost.",
+        [({"stage": stage or "", "kind": kind}, counts[kind + "_tokens_saved"])
+         for stage, counts in stats.items() for kind in ("prompt", "completion")],
+    )
@@ -1,22 +1,25 @@
-from openai import OpenAI
+from llm_cache import get_llm_cache
+from llm_pool import llm_pool
+from llm_retry import stage_policy
+from tracing import propagate
 import asyncio
+import contextlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
+# Runs the attempts of hedged sync calls
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
 
 class LLMCaller:
     def __init__(self, model, max_concurrency=1):
         self.model = model
+        self.max_concurrency = max_concurrency
         self.total_tokens_used = 0  
         self.input_tokens = 0 
         self.output_tokens = 0
-        try:
-            self.loop = asyncio.get_event_loop()
-        except RuntimeError as e:
-            if "There is no current event loop" in str(e):
-                self.loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(self.loop)
-            else:
-                raise
-        # Remove deprecated 'loop' parameter for Python 3.11+
-        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.cache = get_llm_cache()
+        # Streaming calls record usage from worker threads
+        self._usage_lock = threading.Lock()
         
         api_key = "YOUR_API_KEY_HERE"
         
@@ -27,39 +30,171 @@ class LLMCaller:
         else:
             raise ValueError(f"Model {model} not recognized. Available models: 'gpt' and 'claude'.")
         
-        self.client = OpenAI(
-            api_key = api_key
-        )
-    
-    def call(self, query):
-        response = self.client.chat.completions.create(
-            model=self.model,
-            messages=query
-        )
-        if response.usage:
-            self.total_tokens_used += response.usage.total_tokens
-            self.input_tokens += response.usage.prompt_tokens
-            self.output_tokens += response.usage.completion_tokens
-        return response.choices[0].message.content
-
-    async def async_call(self, query):
-        
-        async with self.semaphore:
-            response = await asyncio.to_thread(lambda: self.client.chat.completions.create(model=self.model, messages=query))
-            if response.usage:
-                self.total_tokens_used += response.usage.total_tokens
-                self.input_tokens += response.usage.prompt_tokens
-                self.output_tokens += response.usage.completion_tokens
-            return response.choices[0].message.content
-
-    async def call_batch_async(self, queries):
-        async def delayed_call(query):
-            await asyncio.sleep(0.1)
-            return await self.async_call(query)
-        tasks = [delayed_call(query) for query in queries]
-        results = await asyncio.gather(*tasks)
-        return results
+        self.api_key = api_key
+        # Clients and concurrency limits are shared process-wide
+        self.client = llm_pool.client(api_key)
+
+    def _cached(self, query, stage):
+        """Return the cached response content for ``query``, or None.
+
+        Cache hits do not consume tokens, so the token counters are left untouched.
+        """
+        if self.cache is None or not self.cache.enabled_for(stage):
+            return None
+        cached = self.cache.get(self.model, query, stage)
+        return cached.content if cached is not None else None
+
+    def _record(self, query, stage, response):
+        return self._record_usage(query, stage, response.choices[0].message.content, response.usage)
+
+    def _record_usage(self, query, stage, content, usage):
+        self._count_usage(usage)
+        if self.cache is not None and self.cache.enabled_for(stage) and content is not None:
+            self.cache.put(
+                self.model, query, content,
+                usage.prompt_tokens if usage else 0,
+                usage.completion_tokens if usage else 0,
+                usage.total_tokens if usage else 0,
+            )
+        return content
+
+    def _count_usage(self, usage):
+        if usage:
+            with self._usage_lock:
+                self.total_tokens_used += usage.total_tokens
+                self.input_tokens += usage.prompt_tokens
+                self.output_tokens += usage.completion_tokens
+
+    def call(self, query, stage=None):
+        cached = self._cached(query, stage)
+        if cached is not None:
+            return cached
+        delay = stage_policy(stage).hedge_delay()
+        if delay is None:
+            response = self._complete(query, stage)
+        else:
+            response = self._hedged(query, stage, delay)
+        return self._record(query, stage, response)
+
+    def _complete(self, query, stage):
+        with llm_pool.slot(self.model, query, stage=stage) as slot:
+            return slot.call(lambda: self.client.chat.completions.create(
+                model=self.model,
+                messages=query
+            ))
+
+    def _hedged(self, query, stage, delay):
+        """Send a duplicate request if the first is still running after ``delay``; the first answer wins.
+
+        A sync request cannot be aborted, so the losing attempt runs to
+        completion in the background; its tokens are still counted.
+        """
+        first = _hedge_executor.submit(propagate(self._complete), query, stage)
+        if wait([first], timeout=delay).done:
+            return first.result()
+        policy = stage_policy(stage)
+        policy.count("hedges")
+        second = _hedge_executor.submit(propagate(self._complete), query, stage)
+        for future in as_completed([first, second]):
+            if future.exception() is None:
+                if future is second:
+                    policy.count("hedge_wins")
+                loser = first if future is second else second
+                loser.add_done_callback(
+                    lambda f: self._count_usage(f.result().usage) if not f.cancelled() and f.exception() is None else None
+                )
+                return future.result()
+        # Both attempts failed
+        return first.result()
+
+    async def astream(self, query, stage=None):
+        """Yield the response text in chunks as the model produces it.
+
+        Usage is taken from the final chunk (``include_usage``) and recorded
+        once the stream is exhausted; a cached response is yielded whole.
+        """
+        cached = self._cached(query, stage)
+        if cached is not None:
+            yield cached
+            return
+        parts = []
+        usage = None
+        async with llm_pool.aslot(self.model, query, stream=True, stage=stage) as slot:
+            response = await slot.acall(lambda: llm_pool.async_client(self.api_key).chat.completions.create(
+                model=self.model,
+                messages=query,
+                stream=True,
+                stream_options={"include_usage": True},
+            ))
+            async for chunk in response:
+                if getattr(chunk, "usage", None):
+                    usage = chunk.usage
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        parts.append(delta)
+                        yield delta
+            slot.record_usage(usage)
+            slot.annotate(response_chars=sum(len(part) for part in parts))
+        self._record_usage(query, stage, "".join(parts), usage)
+
+    async def async_call(self, query, stage=None, semaphore=None):
+        """Make one call on the running event loop.
+
+        ``semaphore`` optionally caps a group of calls (e.g. one batch) on top
+        of the process-wide limits of the pool.
+        """
+        cached = self._cached(query, stage)
+        if cached is not None:
+            return cached
+        async with (semaphore or contextlib.nullcontext()):
+            delay = stage_policy(stage).hedge_delay()
+            if delay is None:
+                response = await self._acomplete(query, stage)
+            else:
+                response = await self._ahedged(query, stage, delay)
+            return self._record(query, stage, response)
+
+    async def _acomplete(self, query, stage):
+        async with llm_pool.aslot(self.model, query, stage=stage) as slot:
+            return await slot.acall(
+                lambda: llm_pool.async_client(self.api_key).chat.completions.create(model=self.model, messages=query)
+            )
+
+    async def _ahedged(self, query, stage, delay):
+        """Async counterpart of :meth:`_hedged`; the losing attempt is cancelled."""
+        first = asyncio.ensure_future(self._acomplete(query, stage))
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result()
+        policy = stage_policy(stage)
+        policy.count("hedges")
+        second = asyncio.ensure_future(self._acomplete(query, stage))
+        pending = {first, second}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            policy.count("hedge_wins")
+                        return task.result()
+            # Both attempts failed
+            return first.result()
+        finally:
+            for task in (first, second):
+                task.cancel()
+
+    async def call_batch_async(self, queries, stage=None, max_concurrency=None, return_exceptions=False):
+        """Run ``queries`` concurrently, at most ``max_concurrency`` at a time.
 
+        Results are returned in the order of ``queries``. With
+        ``return_exceptions`` a failed call yields its exception instead of
+        failing the whole batch.
+        """
+        semaphore = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        tasks = [self.async_call(query, stage, semaphore) for query in queries]
+        return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
 
     def get_total_tokens_used(self):
         return self.total_tokens_used, self.input_tokens, self.output_tokens
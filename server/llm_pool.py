@@ -0,0 +1,459 @@
+"""Process-wide pool of OpenAI clients and concurrency limits.
+
+Every LLM call in the process (``LLMCaller`` and SQL generation) goes through
+one pool:
+
+* one sync client per API key, and one async client per API key and event
+  loop, all backed by keep-alive HTTP connection pools, so connections are
+  reused across requests and sessions;
+* a global cap on in-flight calls (``AMBISQL_LLM_MAX_CONCURRENCY``) and
+  optional per-model caps (``AMBISQL_LLM_MODEL_CONCURRENCY``, e.g.
+  ``gpt-4.1=4,gpt-4o-2024-08-06=16``);
+* per-model requests-per-minute and tokens-per-minute budgets, and a
+  per-model concurrency limit that adapts (AIMD) to 429 responses and latency.
+  A throttled call waits and is sent again instead of failing;
+* per-stage retries of transient failures (see ``llm_retry``). The clients'
+  own retries are disabled so that every attempt goes through the limits.
+
+The limits are shared by sync callers (request threads) and async callers on
+any event loop, so they hold across the Flask and the ASGI serving modes.
+"""
+import asyncio
+import threading
+import time
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI, RateLimitError
+
+from config import (
+    LLM_COMPLETION_TOKEN_ESTIMATE,
+    LLM_KEEPALIVE_EXPIRY,
+    LLM_LATENCY_TARGET,
+    LLM_MAX_CONCURRENCY,
+    LLM_MAX_CONNECTIONS,
+    LLM_MAX_KEEPALIVE_CONNECTIONS,
+    LLM_MIN_CONCURRENCY,
+    LLM_MODEL_CONCURRENCY,
+    LLM_MODEL_RPM,
+    LLM_MODEL_TPM,
+    LLM_RATE_LIMIT_MAX_WAIT,
+    LLM_REQUEST_TIMEOUT,
+    LLM_RPM,
+    LLM_TPM,
+)
+from metrics import LLM_CALL_SECONDS, LLM_TOKENS, family, register_collector
+from llm_retry import backoff_delay, is_transient, stage_policy
+from rate_limiter import AIMDController, TokenBucket, estimate_tokens, retry_after
+from tracing import get_logger, start_span
+
+log = get_logger(__name__)
+
+
+class ConcurrencyLimiter:
+    """A counting semaphore usable from threads and from any event loop.
+
+    Waiters are served first come, first served; a released slot is handed
+    directly to the next waiter, whether it is a thread or a coroutine.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._try_acquire():
+                return
+            event = threading.Event()
+            self._waiters.append(event)
+        event.wait()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self._try_acquire():
+                return
+            future = loop.create_future()
+            waiter = (loop, future)
+            self._waiters.append(waiter)
+        try:
+            await future
+        except asyncio.CancelledError:
+            with self._lock:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                    raise
+            # The slot was already handed over; pass it on unless the wake-up will
+            if future.done() and not future.cancelled():
+                self.release()
+            raise
+
+    def _try_acquire(self):
+        if self.in_use < self.limit and not self._waiters:
+            self.in_use += 1
+            return True
+        return False
+
+    def release(self):
+        with self._lock:
+            if not self._waiters or self.in_use > self.limit:
+                self.in_use -= 1
+                return
+            waiter = self._waiters.popleft()
+        # in_use is unchanged: the slot moves to the waiter
+        self._hand_over(waiter)
+
+    def set_limit(self, limit):
+        """Change the limit; extra slots go to waiters at once, excess ones are not reissued."""
+        woken = []
+        with self._lock:
+            self.limit = limit
+            while self._waiters and self.in_use < self.limit:
+                self.in_use += 1
+                woken.append(self._waiters.popleft())
+        for waiter in woken:
+            self._hand_over(waiter)
+
+    def _hand_over(self, waiter):
+        if isinstance(waiter, threading.Event):
+            waiter.set()
+        else:
+            loop, future = waiter
+            try:
+                loop.call_soon_threadsafe(self._wake, future)
+            except RuntimeError:
+                # The waiter's loop is closed; nobody will take the slot
+                self.release()
+
+    def _wake(self, future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+
+class ModelLimits:
+    """Concurrency limit and request/token budgets of one model."""
+
+    def __init__(self, model, max_concurrency):
+        self.model = model
+        self.limiter = ConcurrencyLimiter(max_concurrency)
+        self.controller = AIMDController(
+            self.limiter, min(LLM_MIN_CONCURRENCY, max_concurrency), max_concurrency, LLM_LATENCY_TARGET
+        )
+        rpm = LLM_MODEL_RPM.get(model, LLM_RPM)
+        tpm = LLM_MODEL_TPM.get(model, LLM_TPM)
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+    def reserve(self, estimate):
+        """Reserve one request and ``estimate`` tokens; return the seconds to wait."""
+        wait = 0.0
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(estimate))
+        return wait
+
+    def throttled(self, error, attempt):
+        """Record a 429 and return how long the call should wait before it is sent again."""
+        self.controller.on_throttle()
+        wait = retry_after(error)
+        if wait is None:
+            wait = backoff_delay(attempt, base=1.0, cap=30.0)
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.drain(wait)
+        return wait
+
+
+class CallSlot:
+    """Permission to make one LLM call, acquired through :meth:`LLMClientPool.slot`.
+
+    Send the request with :meth:`call` (or :meth:`acall`): a 429 or a
+    transient failure gives the slot back, waits, and sends the request again
+    once the model's limits allow it. Streamed calls report their usage with
+    :meth:`record_usage`.
+    """
+
+    def __init__(self, pool, limits, estimate, measure_latency=True, policy=None, span=None):
+        self.pool = pool
+        self.limits = limits
+        self.estimate = estimate
+        self.measure_latency = measure_latency
+        self.policy = policy or stage_policy(None)
+        self.started = None
+        self._held = []
+        self._usage_recorded = False
+        # Trace span of the call (None outside a traced request)
+        self.span = span
+
+    def _limiters(self):
+        # Model slot first, so a call waiting on its model does not hold a global slot
+        return [self.limits.limiter, self.pool.global_limiter]
+
+    def _acquire(self):
+        wait = self.limits.reserve(self.estimate)
+        if wait:
+            time.sleep(wait)
+        for limiter in self._limiters():
+            limiter.acquire()
+            self._held.append(limiter)
+        self.started = time.monotonic()
+
+    async def _aacquire(self):
+        wait = self.limits.reserve(self.estimate)
+        if wait:
+            await asyncio.sleep(wait)
+        for limiter in self._limiters():
+            await limiter.acquire_async()
+            self._held.append(limiter)
+        self.started = time.monotonic()
+
+    def _release(self):
+        while self._held:
+            self._held.pop().release()
+
+    def _finish(self, error):
+        self._release()
+        if self.started is not None:
+            LLM_CALL_SECONDS.observe(time.monotonic() - self.started, self.policy.stage, self.limits.model)
+        if error is None:
+            latency = time.monotonic() - self.started if self.measure_latency else None
+            self.limits.controller.on_success(latency)
+            if latency is not None:
+                self.policy.observe(latency)
+        elif not isinstance(error, (GeneratorExit, asyncio.CancelledError)):
+            self.policy.count("failures")
+        if self.span is not None:
+            self.span.finish(error)
+
+    def _retry_delay(self, error, attempts, deadline):
+        """Return how long to wait before sending the call again, or None to give up."""
+        if isinstance(error, RateLimitError):
+            wait = self.limits.throttled(error, attempts["throttled"])
+            if time.monotonic() + wait > deadline:
+                return None
+            attempts["throttled"] += 1
+            self._span_count("throttled")
+            log.warning("llm rate limited", model=self.limits.model, stage=self.policy.stage, retry_in=round(wait, 2))
+            return wait
+        if is_transient(error) and attempts["transient"] < self.policy.max_retries:
+            wait = backoff_delay(attempts["transient"])
+            attempts["transient"] += 1
+            self.policy.count("retries")
+            self._span_count("retries")
+            log.warning("llm call failed", model=self.limits.model, stage=self.policy.stage, error=repr(error), retry_in=round(wait, 2))
+            return wait
+        return None
+
+    def call(self, create):
+        deadline = time.monotonic() + LLM_RATE_LIMIT_MAX_WAIT
+        attempts = {"throttled": 0, "transient": 0}
+        while True:
+            try:
+                response = create()
+            except Exception as e:
+                wait = self._retry_delay(e, attempts, deadline)
+                if wait is None:
+                    raise
+                self._release()
+                time.sleep(wait)
+                self._acquire()
+                continue
+            self._record_response(response)
+            return response
+
+    async def acall(self, create):
+        deadline = time.monotonic() + LLM_RATE_LIMIT_MAX_WAIT
+        attempts = {"throttled": 0, "transient": 0}
+        while True:
+            try:
+                response = await create()
+            except Exception as e:
+                wait = self._retry_delay(e, attempts, deadline)
+                if wait is None:
+                    raise
+                self._release()
+                await asyncio.sleep(wait)
+                await self._aacquire()
+                continue
+            self._record_response(response)
+            return response
+
+    def _record_response(self, response):
+        choices = getattr(response, "choices", None)
+        if choices and self.span is not None:
+            self.span.set(response_chars=len(choices[0].message.content or ""))
+        self.record_usage(getattr(response, "usage", None))
+
+    def annotate(self, **attributes):
+        """Set attributes on the call's trace span."""
+        if self.span is not None:
+            self.span.set(**attributes)
+
+    def _span_count(self, name, amount=1):
+        if self.span is not None:
+            self.span.add(name, amount)
+
+    def record_usage(self, usage):
+        """Count the real usage of the call and settle the token budget with it."""
+        if usage is None or self._usage_recorded:
+            return
+        self._usage_recorded = True
+        self.annotate(
+            prompt_tokens=usage.prompt_tokens,
+            completion_tokens=usage.completion_tokens,
+            total_tokens=usage.total_tokens,
+        )
+        LLM_TOKENS.inc(self.policy.stage, self.limits.model, "prompt", amount=usage.prompt_tokens or 0)
+        LLM_TOKENS.inc(self.policy.stage, self.limits.model, "completion", amount=usage.completion_tokens or 0)
+        if self.limits.tokens is not None:
+            self.limits.tokens.refund(self.estimate - usage.total_tokens)
+
+
+class LLMClientPool:
+    def __init__(self, max_concurrency=LLM_MAX_CONCURRENCY, model_concurrency=LLM_MODEL_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.model_concurrency = model_concurrency
+        self.global_limiter = ConcurrencyLimiter(max_concurrency)
+        self.model_limits = {}
+        self._clients = {}
+        # loop -> {(api_key, base_url): client}; dropped together with the loop
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _limits():
+        return httpx.Limits(
+            max_connections=LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+        )
+
+    def client(self, api_key, base_url=None):
+        """Return the shared sync client for ``api_key`` (and ``base_url``)."""
+        key = (api_key, base_url)
+        client = self._clients.get(key)
+        if client is None:
+            with self._lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = OpenAI(
+                        api_key=api_key,
+                        base_url=base_url,
+                        timeout=LLM_REQUEST_TIMEOUT,
+                        max_retries=0,
+                        http_client=DefaultHttpxClient(limits=self._limits()),
+                    )
+                    self._clients[key] = client
+        return client
+
+    def async_client(self, api_key, base_url=None):
+        """Return the async client for ``api_key`` on the running event loop.
+
+        An async connection pool belongs to the loop it was first used on, so
+        there is one async client per loop.
+        """
+        loop = asyncio.get_running_loop()
+        key = (api_key, base_url)
+        with self._lock:
+            clients = self._async_clients.setdefault(loop, {})
+            client = clients.get(key)
+            if client is None:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    timeout=LLM_REQUEST_TIMEOUT,
+                    max_retries=0,
+                    http_client=DefaultAsyncHttpxClient(limits=self._limits()),
+                )
+                clients[key] = client
+        return client
+
+    def limits(self, model):
+        """Return the limits of ``model``, created on first use."""
+        limits = self.model_limits.get(model)
+        if limits is None:
+            with self._lock:
+                limits = self.model_limits.get(model)
+                if limits is None:
+                    limits = ModelLimits(model, self.model_concurrency.get(model, self.max_concurrency))
+                    self.model_limits[model] = limits
+        return limits
+
+    def _new_slot(self, model, messages, stream, stage):
+        estimate = estimate_tokens(messages, LLM_COMPLETION_TOKEN_ESTIMATE)
+        policy = stage_policy(stage)
+        policy.count("calls")
+        span = start_span(
+            "llm_call", stage=stage, model=model, stream=stream,
+            prompt_chars=sum(len(str(m.get("content") or "")) for m in messages or []),
+        )
+        # A stream's duration reflects the answer length, not provider load
+        return CallSlot(self, self.limits(model), estimate, measure_latency=not stream, policy=policy, span=span)
+
+    @contextmanager
+    def slot(self, model, messages=None, stream=False, stage=None):
+        """Hold one in-flight call slot for ``model`` (blocking while the limits are exhausted)."""
+        call_slot = self._new_slot(model, messages, stream, stage)
+        call_slot._acquire()
+        error = None
+        try:
+            yield call_slot
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            call_slot._finish(error)
+
+    @asynccontextmanager
+    async def aslot(self, model, messages=None, stream=False, stage=None):
+        """Async counterpart of :meth:`slot`."""
+        call_slot = self._new_slot(model, messages, stream, stage)
+        await call_slot._aacquire()
+        error = None
+        try:
+            yield call_slot
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            call_slot._finish(error)
+
+    def stats(self):
+        """Return the calls in flight, and the current limit and 429 count of every model."""
+        return {
+            "in_flight": self.global_limiter.in_use,
+            "models": {
+                model: {
+                    "in_flight": limits.limiter.in_use,
+                    "limit": limits.limiter.limit,
+                    "throttled": limits.controller.throttled,
+                }
+                for model, limits in list(self.model_limits.items())
+            },
+        }
+
+
+# Shared by every LLM call in the process
+llm_pool = LLMClientPool()
+
+
+@register_collector
+def collect_pool_metrics():
+    stats = llm_pool.stats()
+    models = stats["models"]
+    return [
+        *family("ambisql_llm_in_flight", "gauge", "LLM calls in flight.",
+                [({}, stats["in_flight"])] + [({"model": m}, s["in_flight"]) for m, s in models.items()]),
+        *family("ambisql_llm_concurrency_limit", "gauge", "Current (adaptive) concurrency limit per model.",
+                [({"model": m}, s["limit"]) for m, s in models.items()]),
+        *family("ambisql_llm_throttled_total", "counter", "Rate limited (429) LLM responses per model.",
+                [({"model": m}, s["throttled"]) for m, s in models.items()]),
+    ]
@@ -0,0 +1,121 @@
+"""Per-stage retry and hedging policy for LLM calls, and their counters.
+
+Transient failures (connection errors, timeouts, 5xx) are retried with full
+jitter exponential backoff. For short idempotent stages listed in
+``AMBISQL_LLM_HEDGE_STAGES``, a call that is still running after the stage's
+latency percentile gets a duplicate request, and whichever answers first wins.
+"""
+import math
+import random
+import threading
+from collections import deque
+
+from openai import APIConnectionError, InternalServerError
+
+from metrics import family, register_collector
+from config import (
+    LLM_BACKOFF_BASE,
+    LLM_BACKOFF_MAX,
+    LLM_HEDGE_MIN_SAMPLES,
+    LLM_HEDGE_PERCENTILE,
+    LLM_HEDGE_STAGES,
+    LLM_MAX_RETRIES,
+    LLM_STAGE_HEDGE_PERCENTILE,
+    LLM_STAGE_MAX_RETRIES,
+)
+
+LATENCY_WINDOW = 200
+
+
+def is_transient(error):
+    """Connection errors, timeouts and 5xx responses are worth retrying."""
+    return isinstance(error, (APIConnectionError, InternalServerError))
+
+
+def backoff_delay(attempt, base=LLM_BACKOFF_BASE, cap=LLM_BACKOFF_MAX):
+    """Full-jitter exponential backoff: uniform in ``[0, min(cap, base * 2**attempt)]``."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class StagePolicy:
+    """Retry and hedging settings and counters of one stage (e.g. ``choice_rewrite``)."""
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.max_retries = LLM_STAGE_MAX_RETRIES.get(stage, LLM_MAX_RETRIES)
+        self.hedge = stage in LLM_HEDGE_STAGES
+        self.hedge_percentile = LLM_STAGE_HEDGE_PERCENTILE.get(stage, LLM_HEDGE_PERCENTILE)
+        self.calls = 0
+        self.failures = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self._latencies = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+
+    def count(self, counter, amount=1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + amount)
+
+    def observe(self, latency):
+        with self._lock:
+            self._latencies.append(latency)
+
+    def hedge_delay(self):
+        """Seconds after which a duplicate request is sent, or None to not hedge (yet)."""
+        if not self.hedge:
+            return None
+        with self._lock:
+            if len(self._latencies) < LLM_HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._latencies)
+        return samples[max(0, math.ceil(self.hedge_percentile * len(samples)) - 1)]
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "failures": self.failures,
+                "retries": self.retries,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+            }
+
+
+_policies = {}
+_policies_lock = threading.Lock()
+
+
+def stage_policy(stage):
+    """Return the shared policy of ``stage`` (``None`` for calls without a stage)."""
+    policy = _policies.get(stage)
+    if policy is None:
+        with _policies_lock:
+            policy = _policies.setdefault(stage, StagePolicy(stage))
+    return policy
+
+
+def stage_stats():
+    """Return the counters of every stage seen so far."""
+    return {stage: policy.snapshot() for stage, policy in list(_policies.items())}
+
+
+_COUNTERS = (
+    ("calls", "LLM calls per stage."),
+    ("failures", "LLM calls per stage that failed after retries."),
+    ("retries", "Retries of transient LLM failures per stage."),
+    ("hedges", "Hedged (duplicate) LLM requests per stage."),
+    ("hedge_wins", "Hedged requests that answered first, per stage."),
+)
+
+
+@register_collector
+def collect_stage_metrics():
+    stats = stage_stats()
+    lines = []
+    for counter, description in _COUNTERS:
+        lines.extend(family(
+            f"ambisql_llm_{counter}_total", "counter", description,
+            [({"stage": stage or ""}, counters[counter]) for stage, counters in stats.items()],
+        ))
+    return lines
@@ -1,10 +1,10 @@
 import sys
 import json
-from openai import OpenAI
 import os
 from pathlib import Path
 from question_rewriter import QuestionRewriter
 from utils import format_message, add_semicolon_if_missing
+from llm_pool import llm_pool
 from prompts.xiyan_template_prompt import xiyan_template_en
 
 CURR_DIR = Path(__file__).resolve().parent
@@ -26,10 +26,8 @@ def sql_generator(question, evidence, schema):
     api_key = os.getenv('MODELSCOPE_API_KEY')
     if not api_key:
         raise PermissionError("Missing MODELSCOPE_API_KEY for SQL generation")
-    client = OpenAI(
-        base_url=base_url,
-        api_key=api_key,  # ModelScope API_KEY
-    )
+    client = llm_pool.client(api_key, base_url=base_url)  # ModelScope API_KEY
+    model_id = 'XGenerationLab/XiYanSQL-QwenCoder-32B-2504' # ModelScope Model-Id
 
     prompt_raw = xiyan_template_en.format(
         dialect="SQLite",
@@ -45,34 +43,38 @@ def sql_generator(question, evidence, schema):
         evidence= evidence
     )
     
-    response_raw = client.chat.completions.create(
-        model='XGenerationLab/XiYanSQL-QwenCoder-32B-2504', # ModelScope Model-Id
-        messages=[
-            {
-                'role': 'system',
-                'content': 'You are a helpful assistant.'
-            },
-            {
-                'role': 'user',
-                'content': prompt_raw
-            }
-        ]
-    )
+    messages_raw = [
+        {
+            'role': 'system',
+            'content': 'You are a helpful assistant.'
+        },
+        {
+            'role': 'user',
+            'content': prompt_raw
+        }
+    ]
+    with llm_pool.slot(model_id, messages_raw, stage="sql_generation") as slot:
+        response_raw = slot.call(lambda: client.chat.completions.create(
+            model=model_id,
+            messages=messages_raw
+        ))
     sql_raw = response_raw.choices[0].message.content
     
-    response_clarified = client.chat.completions.create(
-        model='XGenerationLab/XiYanSQL-QwenCoder-32B-2504',
-        messages=[
-            {
-                'role': 'system',
-                'content': 'You are a helpful assistant.'
-            },
-            {
-                'role': 'user',
-                'content': prompt_with_evidence
-            }
-        ]
-    )
+    messages_clarified = [
+        {
+            'role': 'system',
+            'content': 'You are a helpful assistant.'
+        },
+        {
+            'role': 'user',
+            'content': prompt_with_evidence
+        }
+    ]
+    with llm_pool.slot(model_id, messages_clarified, stage="sql_generation") as slot:
+        response_clarified = slot.call(lambda: client.chat.completions.create(
+            model=model_id,
+            messages=messages_clarified
+        ))
     sql_clarified = response_clarified.choices[0].message.content
     return sql_raw, sql_clarified
 
@@ -0,0 +1,197 @@
+"""Process-wide metrics, rendered in the Prometheus text format at ``/metrics``.
+
+``Counter`` and ``Histogram`` hold values updated where the work happens.
+State that already lives elsewhere (cache counters, session counts, pool
+limits) is read at scrape time by collectors registered with
+:func:`register_collector`, so it is not counted twice.
+"""
+import functools
+import inspect
+import math
+import threading
+import time
+from bisect import bisect_left
+
+from tracing import get_logger, span
+
+# Seconds; LLM calls take from well under a second to a few minutes
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+log = get_logger(__name__)
+
+_registry = []
+_collectors = []
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        return repr(value)
+    return str(value)
+
+
+def family(name, kind, documentation, samples):
+    """Return the text lines of one metric family.
+
+    ``samples`` is an iterable of ``(labels, value)`` with ``labels`` a dict,
+    or of ``(suffix, labels, value)`` for histogram series.
+    """
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for sample in samples:
+        suffix, labels, value = sample if len(sample) == 3 else ("", *sample)
+        lines.append(f"{name}{suffix}{_format_labels(list(labels.items()))} {_format_value(value)}")
+    return lines
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        with _registry_lock:
+            _registry.append(self)
+
+    def _key(self, labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {labelvalues}")
+        return tuple("" if value is None else str(value) for value in labelvalues)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        key = self._key(labelvalues)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return family(self.name, self.kind, self.documentation, [(self._labels(k), v) for k, v in items])
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        key = self._key(labelvalues)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum, count
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self._lock:
+            items = sorted((k, ([*counts], total, count)) for k, (counts, total, count) in self._values.items())
+        samples = []
+        for key, (counts, total, count) in items:
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, math.inf), counts):
+                cumulative += bucket_count
+                samples.append(("_bucket", {**labels, "le": _format_value(float(bound))}, cumulative))
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, count))
+        return family(self.name, self.kind, self.documentation, samples)
+
+
+def register_collector(collect):
+    """Register ``collect()``, returning text lines (see :func:`family`) rendered at each scrape."""
+    with _registry_lock:
+        _collectors.append(collect)
+    return collect
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    with _registry_lock:
+        metrics = list(_registry)
+        collectors = list(_collectors)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    for collect in collectors:
+        try:
+            lines.extend(collect())
+        except Exception as e:
+            log.warning("metrics collector failed", collector=collect.__name__, error=repr(e))
+    return "\n".join(lines) + "\n"
+
+
+STAGE_SECONDS = Histogram(
+    "ambisql_stage_duration_seconds",
+    "Duration of pipeline stages (catalog build, schema filter, detection, choice rewrite, node merge, SQL generation, SQL execution, result diff).",
+    ["stage"],
+)
+STAGE_ERRORS = Counter("ambisql_stage_errors_total", "Pipeline stages that raised.", ["stage"])
+LLM_CALL_SECONDS = Histogram(
+    "ambisql_llm_call_duration_seconds",
+    "Duration of LLM calls, from acquiring a slot to the end of the response.",
+    ["stage", "model"],
+)
+LLM_TOKENS = Counter("ambisql_llm_tokens_total", "Tokens consumed by LLM calls.", ["stage", "model", "kind"])
+HTTP_RESPONSES = Counter("ambisql_http_responses_total", "HTTP responses by route and status code.", ["method", "route", "status"])
+STREAM_ERRORS = Counter("ambisql_stream_errors_total", "Error events sent on streaming (SSE) responses, by status code.", ["status"])
+
+
+def timed(stage):
+    """Decorator recording a sync or async function as pipeline ``stage``: a duration sample and a trace span."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.monotonic()
+                try:
+                    with span(stage):
+                        return await func(*args, **kwargs)
+                except Exception:
+                    STAGE_ERRORS.inc(stage)
+                    raise
+                finally:
+                    STAGE_SECONDS.observe(time.monotonic() - started, stage)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                with span(stage):
+                    return func(*args, **kwargs)
+            except Exception:
+                STAGE_ERRORS.inc(stage)
+                raise
+            finally:
+                STAGE_SECONDS.observe(time.monotonic() - started, stage)
+        return wrapper
+    return decorator
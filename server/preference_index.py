@@ -3,6 +3,10 @@ from collections import defaultdict
 from llm_call import LLMCaller
 from prompts.preference_tree_prompt import NodeMerge_prompt
 from utils import parse_json_response
+from metrics import timed
+from tracing import get_logger
+
+log = get_logger(__name__)
 
 
 class TreeNode:
@@ -25,10 +29,35 @@ class PreferenceTree:
         for qa in qa_set:
             self.add_qa(qa["level_1_label"], qa["level_2_label"], qa["question"], qa["answer"])
 
+    async def aupdate_tree(self, qa_set):
+        # Merges into the same leaf depend on each other, so pairs are added in order
+        for qa in qa_set:
+            await self.aadd_qa(qa["level_1_label"], qa["level_2_label"], qa["question"], qa["answer"])
+
     def add_qa(self, level1, level2, question, answer):
         """
         Add (or merge) a QA pair at (level1, level2), guaranteeing tree/node existence.
         """
+        leaf_node = self._ensure_leaf(level1, level2)
+        if not leaf_node.qa_list:  # is qa_list is empty
+            leaf_node.qa_list.append({"question": question, "answer": answer})
+        else:
+            # LLM merge in leaf nodes
+            leaf_node.qa_list = self.node_merge(
+                leaf_node.qa_list, {"question": question, "answer": answer}
+            )
+
+    async def aadd_qa(self, level1, level2, question, answer):
+        """Async counterpart of :meth:`add_qa`."""
+        leaf_node = self._ensure_leaf(level1, level2)
+        if not leaf_node.qa_list:
+            leaf_node.qa_list.append({"question": question, "answer": answer})
+        else:
+            leaf_node.qa_list = await self.anode_merge(
+                leaf_node.qa_list, {"question": question, "answer": answer}
+            )
+
+    def _ensure_leaf(self, level1, level2):
         # Ensure level1 node exists
         if level1 not in self.root.children:
             self.root.children[level1] = TreeNode(level1=level1, node_type="level1")
@@ -46,15 +75,17 @@ class PreferenceTree:
                 level1=level1, level2=level2, node_type="leaf"
             )
             self.leaf_map[leaf_key] = l2_node.children["leaf"]
-        leaf_node = l2_node.children["leaf"]
-        
-        if not leaf_node.qa_list:  # is qa_list is empty
-            leaf_node.qa_list.append({"question": question, "answer": answer})
-        else:
-            # LLM merge in leaf nodes
-            leaf_node.qa_list = self.node_merge(
-                leaf_node.qa_list, {"question": question, "answer": answer}
-            )
+        return l2_node.children["leaf"]
+
+    def to_dict(self):
+        """Serialize the tree as its leaves in insertion order."""
+        return {"leaves": [[l1, l2, leaf.qa_list] for (l1, l2), leaf in self.leaf_map.items() if leaf is not None]}
+
+    def restore(self, data):
+        """Rebuild the tree from :meth:`to_dict` output."""
+        for level1, level2, qa_list in data.get("leaves", []):
+            self._ensure_leaf(level1, level2).qa_list = qa_list
+        return self
 
     def find_leaf(self, level1, level2):
         """
@@ -62,16 +93,26 @@ class PreferenceTree:
         """
         return self.leaf_map.get((level1, level2), None)
 
+    @timed("node_merge")
     def node_merge(self, qa_list, new_qa):
         """
         Use LLM to merge a new QA pair into an existing list of QAs, removing duplicates by semantics.
         """
+        response = self.llm_caller.call(self._merge_query(qa_list, new_qa), stage="node_merge")
+        return self._parse_merge(response)
+
+    @timed("node_merge")
+    async def anode_merge(self, qa_list, new_qa):
+        response = await self.llm_caller.async_call(self._merge_query(qa_list, new_qa), "node_merge")
+        return self._parse_merge(response)
+
+    def _merge_query(self, qa_list, new_qa):
         node_merge_prompt = NodeMerge_prompt.format(
             old_list=json.dumps(qa_list, ensure_ascii=False, indent=2),
             new_pair=json.dumps(new_qa, ensure_ascii=False, indent=2),
         )
 
-        query = [
+        return [
             {
                 "role": "system",
                 "content": (
@@ -85,10 +126,10 @@ class PreferenceTree:
             },
             {"role": "user", "content": node_merge_prompt},
         ]
-        response = self.llm_caller.call(query)
-        print(response)
+
+    def _parse_merge(self, response):
+        log.debug("node merge response", response=response)
         response = response.strip('`json\n ')
-        print(response)
         return json.loads(response)
 
     def traverse(self, node=None, depth=0):
@@ -0,0 +1,87 @@
+"""In-memory cache of whole ambiguity-detection results.
+
+Users ask the same handful of questions against the same databases over and
+over. A result is keyed on (database, normalized question, schema catalog
+fingerprint, value index readiness), so a question that differs only in case,
+whitespace or punctuation is answered immediately, and a schema change
+invalidates every result computed against the old catalog. Results computed
+before the database's value index was ready lack value evidence; they are
+dropped as soon as a result with it is stored.
+"""
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from config import QUESTION_CACHE_MAX_ENTRIES, QUESTION_CACHE_TTL
+from metrics import family, register_collector
+
+
+def normalize_question(question):
+    """Casefold, drop punctuation and collapse whitespace."""
+    text = unicodedata.normalize("NFKC", question or "").casefold()
+    text = "".join(" " if unicodedata.category(ch).startswith("P") else ch for ch in text)
+    return re.sub(r"\s+", " ", text).strip()
+
+
+class QuestionCache:
+    def __init__(self, max_entries=QUESTION_CACHE_MAX_ENTRIES, ttl=QUESTION_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(db_name, question, fingerprint, value_index_ready=True):
+        return (db_name, normalize_question(question), fingerprint, bool(value_index_ready))
+
+    def get(self, key):
+        if not self.max_entries:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl and time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        db_name, _, fingerprint, value_index_ready = key
+        with self._lock:
+            # Results computed against an older catalog of this database are
+            # stale, and so are those without value evidence once it is available
+            for stale in [k for k in self._entries
+                          if k[0] == db_name and (k[2] != fingerprint or (value_index_ready and not k[3]))]:
+                del self._entries[stale]
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every QuestionRewriter in the process
+question_cache = QuestionCache()
+
+
+@register_collector
+def collect_question_cache_metrics():
+    return [
+        *family("ambisql_question_cache_requests_total", "counter", "Ambiguity detection cache lookups by result.",
+                [({"result": "hit"}, question_cache.hits), ({"result": "miss"}, question_cache.misses)]),
+        *family("ambisql_question_cache_entries", "gauge", "Ambiguity detection results cached.",
+                [({}, len(question_cache._entries))]),
+    ]
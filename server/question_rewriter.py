@@ -5,12 +5,74 @@ from prompts.ambiguity_detection_prompt import (
 )
 from schema_generator import SchemaGenerator
 from preference_index import PreferenceTree
-from utils import format_response, parse_json_response
+from question_cache import question_cache
+from utils import format_response, parse_json_response, run_sync, QuestionSetStreamParser
+from config import CHOICE_REWRITE_CONCURRENCY, STREAM_DETECTION
+from metrics import timed
+from tracing import get_logger
 
+import asyncio
 import time
 import json
 import re
 
+log = get_logger(__name__)
+
+
+def _parse_choices(text: str):
+    """Robustly extract a list of choice strings from an LLM response.
+
+    Accepts:
+    - JSON fenced with ```json ... ```
+    - Raw JSON (list[str] or {choices|options: list[str]})
+    - Fenced code without json tag
+    - Bullet or numbered lists in plain text
+    - Fallback: split by ' or ' if it seems like disjunctive options
+    """
+    try_text = text.strip()
+    # Extract from fenced code blocks first
+    if "```" in try_text:
+        # Prefer ```json...``` block
+        m = re.search(r"```json\s*(.*?)```", try_text, re.DOTALL | re.IGNORECASE)
+        if not m:
+            m = re.search(r"```\s*(.*?)```", try_text, re.DOTALL)
+        if m:
+            try_text = m.group(1).strip()
+
+    # Try parsing JSON forms
+    try:
+        parsed = json.loads(try_text)
+        if isinstance(parsed, list) and all(isinstance(x, str) for x in parsed):
+            return [s.strip() for s in parsed if s and s.strip()]
+        if isinstance(parsed, dict):
+            for key in ("choices", "options"):
+                val = parsed.get(key)
+                if isinstance(val, list) and all(isinstance(x, str) for x in val):
+                    return [s.strip() for s in val if s and s.strip()]
+    except Exception:
+        pass
+
+    # Try to parse bullet/numbered lists
+    lines = [ln.strip(" \t-*") for ln in try_text.splitlines() if ln.strip()]
+    bullet_candidates = []
+    for ln in lines:
+        if re.match(r"^([0-9]+[\).]|[-*])\s+", ln):
+            # Remove leading token
+            bullet_candidates.append(re.sub(r"^([0-9]+[\).]|[-*])\s+", "", ln).strip())
+        elif ln.startswith("-") or ln.startswith("*"):
+            bullet_candidates.append(ln.lstrip("-* ").strip())
+    if bullet_candidates:
+        return [s for s in bullet_candidates if s]
+
+    # Fallback: split by ' or ' if sentence appears to enumerate options
+    if " or " in try_text:
+        parts = [p.strip(" .") for p in try_text.split(" or ")]
+        if len(parts) > 1:
+            return [p for p in parts if p]
+
+    return []
+
+
 class QuestionRewriter:
     def __init__(self, db_name, path, question, model):
         self.db_name = db_name
@@ -20,14 +82,118 @@ class QuestionRewriter:
         self.schema_generator = SchemaGenerator(db_name, path, question, model)
         self.intention_model = PreferenceTree(model)
         
-    def ambi_detection(self):
+    def ambi_detection(self, on_ambiguity=None):
+        """Detect ambiguities, serving repeated questions from the question cache.
+
+        ``on_ambiguity(index, item)`` is called for each ambiguity as soon as
+        its choices are ready.
+        """
+        cached = self.cached_detection()
+        if cached is not None:
+            if on_ambiguity is not None:
+                for index, item in enumerate(json.loads(cached).get("question_set") or []):
+                    on_ambiguity(index, item)
+            return cached
+        key = self._detection_key()
+        response = self._ambi_detection(on_ambiguity)
+        question_cache.put(key, {"response": response, "db_schema": self.schema_generator.db_schema})
+        return response
+
+    async def aambi_detection(self, on_ambiguity=None):
+        """Async counterpart of :meth:`ambi_detection`."""
+        cached = self.cached_detection()
+        if cached is not None:
+            if on_ambiguity is not None:
+                for index, item in enumerate(json.loads(cached).get("question_set") or []):
+                    on_ambiguity(index, item)
+            return cached
+        key = self._detection_key()
+        response = await self._aambi_detection(on_ambiguity)
+        question_cache.put(key, {"response": response, "db_schema": await self.schema_generator.aget_db_schema()})
+        return response
+
+    def _detection_key(self):
+        return question_cache.key(self.db_name, self.question, self.schema_generator.catalog.fingerprint,
+                                  self.schema_generator.value_index_ready)
+
+    def cached_detection(self):
+        """Return the cached detection response for this question, or None.
+
+        A hit also restores the linked schema, so schema linking is skipped.
+        """
+        cached = question_cache.get(self._detection_key())
+        if cached is None:
+            return None
+        self.schema_generator.db_schema = cached["db_schema"]
+        return cached["response"]
+
+    def _ambi_detection(self, on_ambiguity=None):
+        if STREAM_DETECTION:
+            return run_sync(self._astream_detection(on_ambiguity))
         flag, question_set = self.check_ambiguity('')
         if flag:          
-            question_set = self.rewrite_clarification_question(question_set)
+            question_set = self.rewrite_clarification_question(question_set, on_item=on_ambiguity)
             return format_response(is_clarified=False, q_set=question_set)
         else:
             return self.format_response(self.question, self.intention_model)
-        
+
+    async def _aambi_detection(self, on_ambiguity=None):
+        if STREAM_DETECTION:
+            return await self._astream_detection(on_ambiguity)
+        flag, question_set = await self.acheck_ambiguity('')
+        if flag:
+            question_set = await self.arewrite_clarification_question(question_set, on_item=on_ambiguity)
+            return format_response(is_clarified=False, q_set=question_set)
+        else:
+            return self.format_response(self.question, self.intention_model)
+
+    @timed("ambiguity_detection")
+    async def _astream_detection(self, on_ambiguity=None):
+        """Stream ambiguity detection, generating choices for each ambiguity as it arrives.
+
+        Once the whole response is in, the streamed items are used if they match
+        the parsed ``question_set``; otherwise the choices are generated again
+        from the parsed set.
+        """
+        llm_model = self.schema_generator.llm_model
+        semaphore = asyncio.Semaphore(CHOICE_REWRITE_CONCURRENCY)
+        parser = QuestionSetStreamParser()
+        tasks = []
+        chunks = []
+        try:
+            async for delta in llm_model.astream(self._detection_query(''), "ambiguity_detection"):
+                chunks.append(delta)
+                for item in parser.feed(delta):
+                    tasks.append(asyncio.create_task(self._arewrite_item(len(tasks), item, semaphore, on_ambiguity)))
+            response = "".join(chunks)
+            log.debug("ambiguity detection response", response=response)
+            res = parse_json_response(response)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        if not res["has_ambiguity"]:
+            for task in tasks:
+                task.cancel()
+            return self.format_response(self.question, self.intention_model)
+
+        question_set = res["question_set"] or []
+        streamed = await asyncio.gather(*tasks)
+        if len(streamed) == len(question_set) and all(
+            s.get("question") == q.get("question") for s, q in zip(streamed, question_set)
+        ):
+            question_set = streamed
+        else:
+            log.info("streamed question set differs from the parsed response, regenerating choices")
+
+            def on_item(index, item):
+                # Items already reported while streaming are not reported twice
+                if on_ambiguity is not None and index >= len(streamed):
+                    on_ambiguity(index, item)
+
+            question_set = await self.arewrite_clarification_question(question_set, on_item)
+        return format_response(is_clarified=False, q_set=question_set)
 
     def ambi_correction(self, message):
         flag = None
@@ -51,48 +217,86 @@ class QuestionRewriter:
         else:
             return self.format_response(self.question, self.intention_model)
         
+    async def aambi_correction(self, message):
+        """Async counterpart of :meth:`ambi_correction`."""
+        message_parsed = json.loads(message)
+        await self.intention_model.aupdate_tree(message_parsed["qa_set"])
+
+        additional_info = (message_parsed.get('additional_info') or '').strip()
+        if additional_info:
+            self.question = await self.aquestion_refine(additional_info)
+        return self.format_response(self.question, self.intention_model)
+
+    @timed("ambiguity_detection")
     def check_ambiguity(self, message):
+        if message != '':
+            self.question = self.question_refine(json.loads(message)["additional_info"])
+        query = self._detection_query(message)
+        response = self.schema_generator.llm_model.call(query, stage="ambiguity_detection")
+        return self._parse_detection(response)
+
+    @timed("ambiguity_detection")
+    async def acheck_ambiguity(self, message):
+        if message != '':
+            self.question = await self.aquestion_refine(json.loads(message)["additional_info"])
+        query = self._detection_query(message)
+        response = await self.schema_generator.llm_model.async_call(query, "ambiguity_detection")
+        return self._parse_detection(response)
+
+    def _parse_detection(self, response):
+        log.debug("ambiguity detection response", response=response)
+        res = parse_json_response(response)
+
+        if res["has_ambiguity"]:
+            return res["has_ambiguity"], res["question_set"]
+        else:
+            return res["has_ambiguity"], None
+
+    def _detection_query(self, message):
         ambiguity_detection_prompt = ""
 
         if message == '':
             ambiguity_detection_prompt = AmbiguityDetection_prompt.format(
                 question=self.question,
                 schema=self.schema_generator.db_schema_json,
-                evidence=None,
+                evidence=self.schema_generator.value_evidence(self.question),
             )
         else:
             message_dict = json.loads(message)
-            
-            self.question = self.question_refine(message_dict["additional_info"])
-            
+
+            evidence = self.intention_model.traverse()
+            value_evidence = self.schema_generator.value_evidence(message_dict["additional_info"])
+            if value_evidence:
+                evidence = f"{evidence}\n{value_evidence}"
             ambiguity_detection_prompt = AmbiguityDetection_prompt.format(
                 question=message_dict["additional_info"],
                 schema=self.schema_generator.db_schema_json,
-                evidence=self.intention_model.traverse(),
+                evidence=evidence,
             )
-        query = [
+        return [
             {
                 "role": "system",
                 "content": "You are a helpful assistant to find out inherent ambiguity in a natural language statement. Return only the result with no explanation.",
             },
             {"role": "user", "content": ambiguity_detection_prompt},
         ]
-        # print(ambiguity_detection_prompt)
-        response = self.schema_generator.llm_model.call(query)
-        print(response)
-        res = parse_json_response(response)
-
-        if res["has_ambiguity"]:
-            return res["has_ambiguity"], res["question_set"]
-        else:
-            return res["has_ambiguity"], None
 
     def question_refine(self, additional_info):
         # Rewrite question based on new additional info
+        response = self.schema_generator.llm_model.call(self._refine_query(additional_info), stage="question_refine")
+        log.debug("refined question", question=response)
+        return response
+
+    async def aquestion_refine(self, additional_info):
+        response = await self.schema_generator.llm_model.async_call(self._refine_query(additional_info), "question_refine")
+        log.debug("refined question", question=response)
+        return response
+
+    def _refine_query(self, additional_info):
         question_refine_prompt = QuestionRefine_prompt.format(
             question=self.question, additional_info=additional_info
         )
-        query = [
+        return [
             {
                 "role": "system",
                 "content": (
@@ -102,132 +306,105 @@ class QuestionRewriter:
             },
             {"role": "user", "content": question_refine_prompt},
         ]
-        response = self.schema_generator.llm_model.call(query)
-        print(response)
-        return response
 
-    def rewrite_clarification_question(self, question_set):
-        def _parse_choices(text: str):
-            """Robustly extract a list of choice strings from an LLM response.
-
-            Accepts:
-            - JSON fenced with ```json ... ```
-            - Raw JSON (list[str] or {choices|options: list[str]})
-            - Fenced code without json tag
-            - Bullet or numbered lists in plain text
-            - Fallback: split by ' or ' if it seems like disjunctive options
-            """
-            try_text = text.strip()
-            # Extract from fenced code blocks first
-            if "```" in try_text:
-                # Prefer ```json...``` block
-                m = re.search(r"```json\s*(.*?)```", try_text, re.DOTALL | re.IGNORECASE)
-                if not m:
-                    m = re.search(r"```\s*(.*?)```", try_text, re.DOTALL)
-                if m:
-                    try_text = m.group(1).strip()
-
-            # Try parsing JSON forms
-            try:
-                parsed = json.loads(try_text)
-                if isinstance(parsed, list) and all(isinstance(x, str) for x in parsed):
-                    return [s.strip() for s in parsed if s and s.strip()]
-                if isinstance(parsed, dict):
-                    for key in ("choices", "options"):
-                        val = parsed.get(key)
-                        if isinstance(val, list) and all(isinstance(x, str) for x in val):
-                            return [s.strip() for s in val if s and s.strip()]
-            except Exception:
-                pass
-
-            # Try to parse bullet/numbered lists
-            lines = [ln.strip(" \t-*") for ln in try_text.splitlines() if ln.strip()]
-            bullet_candidates = []
-            for ln in lines:
-                if re.match(r"^([0-9]+[\).]|[-*])\s+", ln):
-                    # Remove leading token
-                    bullet_candidates.append(re.sub(r"^([0-9]+[\).]|[-*])\s+", "", ln).strip())
-                elif ln.startswith("-") or ln.startswith("*"):
-                    bullet_candidates.append(ln.lstrip("-* ").strip())
-            if bullet_candidates:
-                return [s for s in bullet_candidates if s]
-
-            # Fallback: split by ' or ' if sentence appears to enumerate options
-            if " or " in try_text:
-                parts = [p.strip(" .") for p in try_text.split(" or ")]
-                if len(parts) > 1:
-                    return [p for p in parts if p]
-
-            return []
-
-        for item in question_set:
-            description_str = ""
-            if isinstance(item.get('description'), dict):
-                description_str = json.dumps(item['description'], indent=2)
-            elif isinstance(item.get('description'), str):
-                description_str = item['description']
-
-            rewrite_clarification_question_prompt = RewriteClarificationQuestion_prompt.format(
-                question=item['question'], description=description_str
+    def rewrite_clarification_question(self, question_set, on_item=None):
+        """Generate answer choices for every ambiguity concurrently.
+
+        Items keep their order; an item whose call fails or whose response
+        cannot be parsed falls back exactly as it would on its own.
+        ``on_item(index, item)`` is called as soon as an item has its choices.
+        """
+        return run_sync(self.arewrite_clarification_question(question_set, on_item))
+
+    async def arewrite_clarification_question(self, question_set, on_item=None):
+        semaphore = asyncio.Semaphore(CHOICE_REWRITE_CONCURRENCY)
+        await asyncio.gather(*(
+            self._arewrite_item(index, item, semaphore, on_item) for index, item in enumerate(question_set)
+        ))
+        return question_set
+
+    @timed("choice_rewrite")
+    async def _arewrite_item(self, index, item, semaphore, on_item=None):
+        try:
+            response_str = await self.schema_generator.llm_model.async_call(
+                self._choice_query(item), "choice_rewrite", semaphore
             )
+        except Exception as e:
+            response_str = e
+        self._apply_choices(item, response_str)
+        if on_item is not None:
+            on_item(index, item)
+        return item
 
-            query = [
-                {
-                    "role": "system",
-                    "content": (
-                        "You are an AI assistant that strictly follows instructions. "
-                        "Your sole task is to output a single, valid JSON object containing a list of strings, "
-                        "without any additional text, comments, or markdown."
-                    ),
-                },
-                {"role": "user", "content": rewrite_clarification_question_prompt},
-            ]
-
-            try:
-                response_str = self.schema_generator.llm_model.call(query)
-                choices_list = _parse_choices(response_str)
-
-                # Fallback: derive options directly from the ambiguity question text
-                if (not choices_list) and isinstance(item.get('question'), str):
-                    qtxt = item['question'].strip()
-                    # Remove leading prompt phrasing like "Do you mean" and trailing punctuation
-                    qtxt = re.sub(r"^do you mean\s*", "", qtxt, flags=re.IGNORECASE).strip(" ?.")
-
-                    # Normalize separators: turn " or " into commas for uniform split
-                    norm = re.sub(r"\s+or\s+", ", ", qtxt, flags=re.IGNORECASE)
-                    # Split at commas that are followed by typical comparative keywords
-                    parts = re.split(r",\s*(?=(after|before|on|in|from|to)\b)", norm)
-                    # re.split keeps delimiters; rebuild segments
-                    if parts:
-                        rebuilt = []
-                        i = 0
-                        while i < len(parts):
-                            if i + 1 < len(parts) and parts[i+1] in {"after","before","on","in","from","to"}:
-                                rebuilt.append((parts[i] + ", " + parts[i+1] + parts[i+2] if i+2 < len(parts) else parts[i]).strip())
-                                i += 3
-                            else:
-                                rebuilt.append(parts[i].strip())
-                                i += 1
-                        # Filter to meaningful segments
-                        cand = [seg.strip(" .") for seg in rebuilt if seg and any(k in seg.lower() for k in ["after","before","on","in","from","to"]) ]
-                        # If still poor, do a simpler split by commas
-                        if not cand:
-                            cand = [seg.strip(" .") for seg in norm.split(",") if seg.strip()]
-                        # Capitalize first letter for nicer display
-                        choices_list = [seg[0].upper() + seg[1:] if seg else seg for seg in cand]
-
-                if isinstance(choices_list, list) and all(isinstance(c, str) for c in choices_list):
-                    item['choices'] = choices_list
-                else:
-                    print(f"Warning: Could not parse choices from LLM response or question text. Raw: {response_str}")
-                    item['choices'] = []
-            except Exception as e:
-                print(f"An unexpected error occurred parsing LLM choices: {e}")
-                # Final fallback: keep no choices; frontend will use free text input
+    def _choice_query(self, item):
+        description_str = ""
+        if isinstance(item.get('description'), dict):
+            description_str = json.dumps(item['description'], indent=2)
+        elif isinstance(item.get('description'), str):
+            description_str = item['description']
+
+        rewrite_clarification_question_prompt = RewriteClarificationQuestion_prompt.format(
+            question=item['question'], description=description_str
+        )
+
+        return [
+            {
+                "role": "system",
+                "content": (
+                    "You are an AI assistant that strictly follows instructions. "
+                    "Your sole task is to output a single, valid JSON object containing a list of strings, "
+                    "without any additional text, comments, or markdown."
+                ),
+            },
+            {"role": "user", "content": rewrite_clarification_question_prompt},
+        ]
+
+    def _apply_choices(self, item, response_str):
+        try:
+            if isinstance(response_str, Exception):
+                raise response_str
+            choices_list = _parse_choices(response_str)
+
+            # Fallback: derive options directly from the ambiguity question text
+            if (not choices_list) and isinstance(item.get('question'), str):
+                qtxt = item['question'].strip()
+                # Remove leading prompt phrasing like "Do you mean" and trailing punctuation
+                qtxt = re.sub(r"^do you mean\s*", "", qtxt, flags=re.IGNORECASE).strip(" ?.")
+
+                # Normalize separators: turn " or " into commas for uniform split
+                norm = re.sub(r"\s+or\s+", ", ", qtxt, flags=re.IGNORECASE)
+                # Split at commas that are followed by typical comparative keywords
+                parts = re.split(r",\s*(?=(after|before|on|in|from|to)\b)", norm)
+                # re.split keeps delimiters; rebuild segments
+                if parts:
+                    rebuilt = []
+                    i = 0
+                    while i < len(parts):
+                        if i + 1 < len(parts) and parts[i+1] in {"after","before","on","in","from","to"}:
+                            rebuilt.append((parts[i] + ", " + parts[i+1] + parts[i+2] if i+2 < len(parts) else parts[i]).strip())
+                            i += 3
+                        else:
+                            rebuilt.append(parts[i].strip())
+                            i += 1
+                    # Filter to meaningful segments
+                    cand = [seg.strip(" .") for seg in rebuilt if seg and any(k in seg.lower() for k in ["after","before","on","in","from","to"]) ]
+                    # If still poor, do a simpler split by commas
+                    if not cand:
+                        cand = [seg.strip(" .") for seg in norm.split(",") if seg.strip()]
+                    # Capitalize first letter for nicer display
+                    choices_list = [seg[0].upper() + seg[1:] if seg else seg for seg in cand]
+
+            if isinstance(choices_list, list) and all(isinstance(c, str) for c in choices_list):
+                item['choices'] = choices_list
+            else:
+                log.warning("could not parse choices", response=str(response_str))
                 item['choices'] = []
+        except Exception as e:
+            log.exception("unexpected error parsing choices", error=repr(e))
+            # Final fallback: keep no choices; frontend will use free text input
+            item['choices'] = []
+        return item
 
-        return question_set
-    
     def format_response(self, question, intention_model):
         response = {
             "is_clarified" : True,
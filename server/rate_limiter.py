@@ -0,0 +1,106 @@
+"""Rate limiting primitives for LLM calls.
+
+``TokenBucket`` enforces requests-per-minute and tokens-per-minute quotas;
+``AIMDController`` adapts the number of concurrent calls of a model to what the
+provider accepts: it grows additively while calls succeed quickly and shrinks
+multiplicatively on 429 responses or when latency exceeds a target.
+"""
+import threading
+import time
+
+
+def estimate_tokens(messages, completion_tokens=0):
+    """Roughly estimate the tokens a chat call consumes (about 4 characters per token)."""
+    prompt_tokens = sum(len(str(message.get("content") or "")) // 4 + 4 for message in messages or [])
+    return prompt_tokens + completion_tokens
+
+
+def retry_after(error):
+    """Return the delay in seconds the provider asked for in a 429 response, or None."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at ``per_minute`` tokens per minute.
+
+    ``reserve`` always succeeds and returns how long the caller must wait
+    before using its tokens, so callers queue in order instead of failing.
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        """Take ``amount`` tokens and return the seconds to wait until they are covered."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def refund(self, amount):
+        """Give back (or, if negative, additionally take) tokens once the real usage is known."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def drain(self, seconds=0.0):
+        """Empty the bucket (e.g. after a 429) so that waiting callers back off together."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, 0.0 - seconds * self.rate)
+
+
+class AIMDController:
+    """Additive-increase / multiplicative-decrease control of a concurrency limit."""
+
+    def __init__(self, limiter, min_limit, max_limit, latency_target, cooldown=5.0):
+        self.limiter = limiter
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.throttled = 0
+        self._credit = 0.0
+        self._last_decrease = 0.0
+        self._lock = threading.Lock()
+
+    def on_success(self, latency=None):
+        with self._lock:
+            if latency is not None and self.latency_target and latency > self.latency_target:
+                self._decrease(0.9)
+                return
+            # About +1 per round of ``limit`` successful calls
+            self._credit += 1.0 / max(self.limiter.limit, 1)
+            if self._credit >= 1.0 and self.limiter.limit < self.max_limit:
+                self._credit = 0.0
+                self.limiter.set_limit(self.limiter.limit + 1)
+
+    def on_throttle(self):
+        with self._lock:
+            self.throttled += 1
+            self._decrease(0.5)
+
+    def _decrease(self, factor):
+        # A burst of failures from one overload counts as a single signal
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self._credit = 0.0
+        self.limiter.set_limit(max(self.min_limit, int(self.limiter.limit * factor)))
@@ -0,0 +1,196 @@
+"""Compare the raw and clarified result sets without holding either in memory.
+
+While :func:`db_utils.run_query` fetches a page of rows it feeds every row of
+the result, including the ones past the page, to a :class:`RowDigest`, so
+each query is executed once and both digests are built concurrently. Rows
+are reduced to 128-bit BLAKE2b digests of their type-tagged values, so two
+rows match only when every value has the same type and repr (``1``, ``1.0``
+and ``True`` all differ; NULL matches NULL):
+
+* unordered (multiset) mode counts the digests of each side;
+* ordered mode, for ORDER BY queries, keeps them by position and compares
+  the two sides position by position.
+
+Only digests are kept (at most ``AMBISQL_DIFF_MAX_ROWS`` per side). Example
+rows are taken from the page already in memory; only when unmatched rows lie
+beyond it is a side read again, within what is left of the request's
+deadline, until ``AMBISQL_DIFF_SAMPLE_SIZE`` examples are found.
+"""
+import hashlib
+import sqlite3
+import time
+from collections import Counter
+from contextlib import contextmanager
+from itertools import islice
+
+from config import DIFF_MAX_ROWS, DIFF_SAMPLE_SIZE
+from db_utils import QueryTimeout, open_query
+from metrics import timed
+from tracing import annotate, get_logger
+
+log = get_logger(__name__)
+
+FETCH_BATCH = 1000
+# Bytes of each row digest
+DIGEST_SIZE = 16
+
+
+def _row_hash(row):
+    serialized = repr(tuple((type(value).__name__, value) for value in row))
+    return hashlib.blake2b(serialized.encode("utf-8", "backslashreplace"), digest_size=DIGEST_SIZE).digest()
+
+
+class RowDigest:
+    """Digests of a query's rows, filled by ``run_query`` while it reads them.
+
+    In ordered mode the digests are packed back to back in one bytearray.
+    """
+
+    def __init__(self, ordered=False, max_rows=DIFF_MAX_ROWS):
+        self.ordered = ordered
+        self.max_rows = max_rows
+        self.hashes = bytearray() if ordered else Counter()
+        self.count = 0
+        # False when the result had more than max_rows rows, or reading it failed
+        self.complete = True
+        self.error = None
+        self.timed_out = False
+
+    def extend(self, rows):
+        """Add ``rows``; return False once the digest is full."""
+        for row in rows:
+            if self.max_rows and self.count >= self.max_rows:
+                self.complete = False
+                return False
+            if self.ordered:
+                self.hashes += _row_hash(row)
+            else:
+                self.hashes[_row_hash(row)] += 1
+            self.count += 1
+        return True
+
+    def consume(self, cursor):
+        """Add the rows ``cursor`` has left; a failure (e.g. the deadline) is recorded, not raised."""
+        try:
+            while True:
+                rows = cursor.fetchmany(FETCH_BATCH)
+                if not rows or not self.extend(rows):
+                    return
+        except sqlite3.OperationalError as e:
+            self.complete = False
+            self.timed_out = "interrupted" in str(e)
+            self.error = "Query exceeded its time limit while hashing rows" if self.timed_out else str(e)
+
+    def at(self, position):
+        """Digest of the row at ``position`` (ordered mode)."""
+        return bytes(self.hashes[position * DIGEST_SIZE:(position + 1) * DIGEST_SIZE])
+
+    def unmatched(self, other):
+        """Predicate ``(position, row) -> bool`` picking this side's rows that ``other`` lacks."""
+        if self.ordered:
+            return lambda position, row: position < self.count and (
+                position >= other.count or self.at(position) != other.at(position)
+            )
+        taken = Counter()
+
+        def pick(position, row):
+            row_hash = _row_hash(row)
+            if self.hashes.get(row_hash, 0) - other.hashes.get(row_hash, 0) - taken[row_hash] > 0:
+                taken[row_hash] += 1
+                return True
+            return False
+        return pick
+
+
+def _compare(raw, clarified):
+    """Return ``(intersection, first_difference)`` of two digests."""
+    if not raw.ordered:
+        smaller, larger = sorted((raw.hashes, clarified.hashes), key=len)
+        return sum(min(count, larger.get(row_hash, 0)) for row_hash, count in smaller.items()), None
+    intersection = 0
+    first_difference = None
+    raw_view, clarified_view = memoryview(raw.hashes), memoryview(clarified.hashes)
+    for position in range(min(raw.count, clarified.count)):
+        start = position * DIGEST_SIZE
+        if raw_view[start:start + DIGEST_SIZE] == clarified_view[start:start + DIGEST_SIZE]:
+            intersection += 1
+        elif first_difference is None:
+            first_difference = position
+    if first_difference is None and raw.count != clarified.count:
+        first_difference = min(raw.count, clarified.count)
+    return intersection, first_difference
+
+
+def _collect(rows, start, pick, ordered, samples, limit):
+    for position, row in enumerate(rows, start):
+        if len(samples) >= limit:
+            return
+        if pick(position, row):
+            samples.append({"position": position, "row": list(row)} if ordered else list(row))
+
+
+def reread_source(path, db_name, sql_query, deadline):
+    """Re-read ``sql_query`` for examples, within what is left until ``deadline`` (monotonic)."""
+    @contextmanager
+    def source():
+        remaining = deadline - time.monotonic() if deadline is not None else None
+        if remaining is not None and remaining <= 0:
+            raise QueryTimeout("No time left to read example rows")
+        with open_query(path, db_name, sql_query, remaining) as cursor:
+            yield cursor
+    return source
+
+
+@timed("result_diff")
+def diff_results(raw, clarified, sample_size=DIFF_SAMPLE_SIZE, reread=None):
+    """Diff two ``QueryResult`` objects whose ``digest`` was filled by ``run_query``; return a summary dict.
+
+    ``intersection`` counts the rows both sides share (with multiplicity, or
+    at the same position in ordered mode); ``only_raw`` / ``only_clarified``
+    count the rest. ``samples`` holds up to ``sample_size`` rows of each, as
+    ``{"position", "row"}`` in ordered mode. ``complete`` is False when a side
+    had more than ``AMBISQL_DIFF_MAX_ROWS`` rows and only that prefix was
+    compared. ``reread`` maps ``"raw"`` / ``"clarified"`` to a source (see
+    :func:`reread_source`) used when examples lie past the rows in memory.
+    """
+    started = time.monotonic()
+    for digest in (raw.digest, clarified.digest):
+        if digest.error is not None:
+            return {"error": digest.error, "timed_out": digest.timed_out}
+    ordered = raw.digest.ordered
+    intersection, first_difference = _compare(raw.digest, clarified.digest)
+
+    samples = {}
+    for side, result, other in (("only_raw", raw, clarified), ("only_clarified", clarified, raw)):
+        unmatched = result.digest.count - intersection
+        pick = result.digest.unmatched(other.digest)
+        found = samples[side] = []
+        _collect(result.rows, result.offset, pick, ordered, found, min(sample_size, unmatched))
+        source = (reread or {}).get(side.replace("only_", ""))
+        beyond = result.offset + len(result.rows)
+        if len(found) < min(sample_size, unmatched) and source is not None and beyond < result.digest.count:
+            try:
+                with source() as rows:
+                    _collect(islice(rows, beyond, result.digest.count), beyond, pick, ordered, found,
+                             min(sample_size, unmatched))
+            except (QueryTimeout, sqlite3.Error) as e:
+                log.info("example rows incomplete", side=side, error=str(e))
+
+    summary = {
+        "ordered": ordered,
+        "complete": raw.digest.complete and clarified.digest.complete,
+        "equal": raw.digest.complete and clarified.digest.complete
+                 and raw.digest.count == clarified.digest.count == intersection,
+        "columns_match": len(raw.columns) == len(clarified.columns),
+        "raw_rows": raw.digest.count,
+        "clarified_rows": clarified.digest.count,
+        "intersection": intersection,
+        "only_raw": raw.digest.count - intersection,
+        "only_clarified": clarified.digest.count - intersection,
+        "first_difference": first_difference,
+        "samples": samples,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 3),
+    }
+    annotate(ordered=ordered, raw_rows=raw.digest.count, clarified_rows=clarified.digest.count,
+             intersection=intersection, complete=summary["complete"])
+    return summary
@@ -0,0 +1,105 @@
+"""Compact encodings of query results for ``/api/sql/compare``.
+
+``rows`` (the default) keeps each result's ``rows`` as lists of values.
+``columnar`` replaces them with ``types`` and ``values`` (one array per
+column, aligned with ``columns``), which is smaller for wide results and maps
+directly onto a DataFrame. ``arrow`` replaces them with an Arrow IPC stream,
+base64-encoded under ``arrow`` (needs ``pyarrow``). In JSON, BLOB values are
+base64 strings.
+
+Responses are gzip-compressed when the client accepts it and the body is at
+least ``AMBISQL_GZIP_MIN_BYTES``.
+"""
+import base64
+import gzip
+import json
+
+from config import GZIP_MIN_BYTES
+
+FORMATS = ("rows", "columnar", "arrow")
+
+_SQLITE_TYPES = {int: "integer", float: "real", str: "text", bytes: "blob"}
+
+
+def check_format(fmt):
+    """Raise ValueError unless ``fmt`` is a known format that can be produced here."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown format {fmt!r}; use one of {', '.join(FORMATS)}")
+    if fmt == "arrow":
+        _pyarrow()
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc  # noqa: F401
+    except ImportError as e:
+        raise ValueError("The arrow format requires pyarrow: pip install pyarrow") from e
+    return pyarrow
+
+
+def column_type(values):
+    """SQLite storage class shared by ``values``: integer, real, text, blob, null (all NULL) or mixed."""
+    kinds = {_SQLITE_TYPES.get(type(value), "mixed") for value in values if value is not None}
+    if not kinds:
+        return "null"
+    if kinds == {"integer", "real"}:
+        return "real"
+    return kinds.pop() if len(kinds) == 1 else "mixed"
+
+
+def _columns_of(result):
+    rows = result.get("rows") or []
+    width = len(result.get("columns") or []) or (len(rows[0]) if rows else 0)
+    return [list(column) for column in zip(*rows)] if rows else [[] for _ in range(width)]
+
+
+def _to_columnar(result):
+    values = _columns_of(result)
+    encoded = {key: value for key, value in result.items() if key != "rows"}
+    encoded.update(format="columnar", types=[column_type(column) for column in values], values=values)
+    return encoded
+
+
+def _to_arrow(result):
+    pa = _pyarrow()
+    values = _columns_of(result)
+    names = list(result.get("columns") or [f"column_{i}" for i in range(len(values))])
+    types = [column_type(column) for column in values]
+    arrays = []
+    for column, kind in zip(values, types):
+        if kind == "mixed":
+            # Arrow columns have one type; keep mixed SQLite columns as text
+            column = [None if v is None else str(v) for v in column]
+        arrays.append(pa.array(column, type=pa.null() if kind == "null" else None))
+    table = pa.Table.from_arrays(arrays, names=names)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    encoded = {key: value for key, value in result.items() if key != "rows"}
+    encoded.update(format="arrow", types=types, arrow=base64.b64encode(sink.getvalue().to_pybytes()).decode("ascii"))
+    return encoded
+
+
+def encode_result(result, fmt):
+    """Return a compare result dict (``QueryResult.to_dict()``) with its rows in format ``fmt``."""
+    if fmt == "rows" or not result.get("success"):
+        return result
+    return _to_arrow(result) if fmt == "arrow" else _to_columnar(result)
+
+
+def _json_default(value):
+    # BLOB values
+    if isinstance(value, bytes):
+        return base64.b64encode(value).decode("ascii")
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(payload, accept_encoding=""):
+    """Serialize ``payload`` for a response; return ``(body, headers)``, gzipped if the client accepts it."""
+    body = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode("utf-8")
+    headers = {"Content-Type": "application/json", "Vary": "Accept-Encoding"}
+    if "gzip" in (accept_encoding or "").lower() and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
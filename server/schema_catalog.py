@@ -0,0 +1,281 @@
+"""Process-wide, versioned cache of database schema catalogs.
+
+Building a catalog reads every description CSV, inspects each SQLite table and
+profiles its columns. None of that changes unless the database
+file or its descriptions change, so a catalog is built once per source
+fingerprint, shared by every session, and mirrored to disk so that a restarted
+server can warm up without touching the database again.
+"""
+import hashlib
+import json
+import os
+import threading
+
+import pandas as pd
+
+from artifact_writer import artifact_writer, write_atomic
+from column_profiler import describe_column, profile_table
+from config import CATALOG_DIR
+from db_utils import connect, sqlite_path
+from metrics import timed
+from schema_index import SchemaIndex
+from tracing import get_logger
+
+log = get_logger(__name__)
+
+CATALOG_FORMAT_VERSION = 4
+
+
+def _read_csv_robust(file_path: str) -> pd.DataFrame:
+    """Read CSV with fallback encodings to avoid UnicodeDecodeError.
+
+    Tries utf-8 and common Windows encodings (utf-8-sig, cp1252, latin1).
+    Falls back to python engine with on_bad_lines='skip' if needed.
+    """
+    for enc in ("utf-8", "utf-8-sig", "cp1252", "latin1"):
+        try:
+            return pd.read_csv(file_path, encoding=enc)
+        except UnicodeDecodeError:
+            continue
+        except Exception:
+            # Other errors should propagate for visibility
+            raise
+    # Final fallback: tolerate bad lines
+    return pd.read_csv(file_path, encoding="latin1", engine="python", on_bad_lines="skip")
+
+
+def check_merge(columns_in_columns_df, columns_in_table_info):
+    missing_in_table_info = columns_in_columns_df - columns_in_table_info
+    missing_in_columns_df = columns_in_table_info - columns_in_columns_df
+
+    if missing_in_table_info or missing_in_columns_df:
+        if missing_in_table_info:
+            log.error("column mismatch: missing in table_info", columns=sorted(missing_in_table_info))
+            raise ValueError("Column mismatch between table_info and columns_df. See log above.")
+        if missing_in_columns_df:
+            log.warning("redundant columns in database_description", columns=sorted(missing_in_columns_df))
+
+
+def description_dir(path, db):
+    return os.path.join(path, db, 'database_description')
+
+
+def description_files(path, db):
+    """Return the description CSV filenames of a database in a stable order."""
+    return sorted(f for f in os.listdir(description_dir(path, db)) if f.endswith('.csv'))
+
+
+def schema_header(db):
+    return f"The following schema from the {db} database outlines the table names and their respective columns. Each column is detailed in this order: column_name, is_PrimaryKey, data_type, column_description, value_description, value_example, and value_stats. \n\n"
+
+
+@timed("catalog_build")
+def build_db_schema(path, db):
+    """Build the per-table schema text, per-column schema JSON and column stats of a database."""
+    # A pooled read-only connection: the pages profiled here stay cached for queries
+    with connect(path, db) as conn:
+        return _build_db_schema(conn.cursor(), path, db)
+
+
+def _build_db_schema(cursor, path, db):
+    csv_path = description_dir(path, db)
+    table_texts = {}
+    schema_json = {}
+    column_stats = {}
+    for filename in description_files(path, db):
+        file_path = os.path.join(csv_path, filename)
+        table = filename[:-4]
+        table_info = _read_csv_robust(file_path)
+        table_info = table_info.drop(columns=['column_name'])
+        table_info = table_info.rename(columns={'original_column_name': 'column_name'})
+        table_info = table_info[['column_name', 'column_description', 'value_description']]
+        table_info['column_name'] = table_info['column_name'].astype(str).str.strip()
+        cursor.execute(f"PRAGMA table_info({table});")
+        columns_info = cursor.fetchall()
+        columns_df = pd.DataFrame(columns_info, columns=['cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'])
+        columns_df = columns_df[['name', 'pk', 'type']]
+        columns_df = columns_df.rename(columns={'name': 'column_name', 'type': 'data_type'})
+        columns_df['pk'] = columns_df['pk'].apply(lambda x: 'Primary Key' if x == 1 else '')
+        check_merge(set(columns_df['column_name']), set(table_info['column_name']))
+        table_info = pd.merge(columns_df, table_info, on='column_name', how='left')
+        column_stats[table] = profile_table(cursor, table, list(table_info['column_name']))
+        table_info['value_examples'] = [
+            str(column_stats[table]['columns'][column_name]['examples'])
+            for column_name in table_info['column_name']
+        ]
+        table_info['value_stats'] = [
+            describe_column(column_stats[table]['columns'][column_name])
+            for column_name in table_info['column_name']
+        ]
+
+        table_texts[table] = table_info.to_csv(sep=',', index=False, header=False)
+        schema_json[table] = table_info.set_index('column_name').to_dict(orient='index')
+    cursor.close()
+    return table_texts, schema_json, column_stats
+
+
+class SchemaCatalog:
+    """Immutable snapshot of one database's schema.
+
+    ``schema_json`` is shared by every session using the catalog and must be
+    treated as read-only.
+    """
+
+    def __init__(self, db_name, fingerprint, table_texts, schema_json, column_stats):
+        self.db_name = db_name
+        self.fingerprint = fingerprint
+        self.table_texts = table_texts
+        self.schema_json = schema_json
+        self.column_stats = column_stats
+        self.schema_text = self.format_schema()
+        self._schema_index = None
+
+    def format_schema(self, tables=None):
+        """Return the formatted schema text, optionally restricted to ``tables``."""
+        tables = self.table_texts if tables is None else [t for t in tables if t in self.table_texts]
+        return schema_header(self.db_name) + ''.join(f"\nTable: {table}\n{self.table_texts[table]}" for table in tables)
+
+    @property
+    def schema_index(self):
+        """Lexical index over this catalog, built on first use."""
+        if self._schema_index is None:
+            self._schema_index = SchemaIndex.from_schema_json(self.schema_json)
+        return self._schema_index
+
+    def to_dict(self):
+        return {
+            "version": CATALOG_FORMAT_VERSION,
+            "db_name": self.db_name,
+            "fingerprint": self.fingerprint,
+            "table_texts": self.table_texts,
+            "schema_json": self.schema_json,
+            "column_stats": self.column_stats,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["db_name"], data["fingerprint"], data["table_texts"], data["schema_json"], data["column_stats"])
+
+
+class CatalogStore:
+    """Builds catalogs on demand and caches them in memory and on disk.
+
+    A catalog is keyed by database and versioned by a fingerprint made of the
+    ``.sqlite`` file's mtime/size and a content hash of the description CSVs.
+    Concurrent requests for the same stale catalog wait for a single build.
+    """
+
+    def __init__(self, cache_dir=CATALOG_DIR):
+        self.cache_dir = str(cache_dir)
+        self._catalogs = {}
+        self._csv_hashes = {}
+        self._lock = threading.Lock()
+        self._build_locks = {}
+
+    def get(self, path, db_name):
+        key = os.path.realpath(os.path.join(path, db_name))
+        fingerprint = self.fingerprint(path, db_name)
+        catalog = self._catalogs.get(key)
+        if catalog is not None and catalog.fingerprint == fingerprint:
+            return catalog
+
+        with self._build_lock(key):
+            catalog = self._catalogs.get(key)
+            if catalog is not None and catalog.fingerprint == fingerprint:
+                return catalog
+            catalog = self._load(db_name, fingerprint)
+            if catalog is None:
+                log.info("building schema catalog", db=db_name)
+                table_texts, schema_json, column_stats = build_db_schema(path, db_name)
+                catalog = SchemaCatalog(db_name, fingerprint, table_texts, schema_json, column_stats)
+                self._save(catalog)
+            self._catalogs[key] = catalog
+            self._publish_artifacts(path, catalog)
+            return catalog
+
+    def invalidate(self, path=None, db_name=None):
+        """Drop cached catalogs, either all of them or those of one database."""
+        with self._lock:
+            if db_name is None:
+                self._catalogs.clear()
+                self._csv_hashes.clear()
+            else:
+                key = os.path.realpath(os.path.join(path, db_name))
+                self._catalogs.pop(key, None)
+                self._csv_hashes.pop(key, None)
+
+    def fingerprint(self, path, db_name):
+        """Return the version of a database's schema sources.
+
+        The CSV content hash is only recomputed when one of the description
+        files' stat signature changes, so the common path is a few ``stat`` calls.
+        """
+        db_file = os.stat(sqlite_path(path, db_name))
+        csv_dir = description_dir(path, db_name)
+        filenames = description_files(path, db_name)
+        signature = []
+        for filename in filenames:
+            st = os.stat(os.path.join(csv_dir, filename))
+            signature.append((filename, st.st_mtime_ns, st.st_size))
+        signature = tuple(signature)
+
+        key = os.path.realpath(os.path.join(path, db_name))
+        cached = self._csv_hashes.get(key)
+        if cached is not None and cached[0] == signature:
+            csv_hash = cached[1]
+        else:
+            digest = hashlib.sha1()
+            for filename in filenames:
+                digest.update(filename.encode('utf-8'))
+                with open(os.path.join(csv_dir, filename), 'rb') as f:
+                    digest.update(f.read())
+            csv_hash = digest.hexdigest()
+            self._csv_hashes[key] = (signature, csv_hash)
+        return f"{db_file.st_mtime_ns}-{db_file.st_size}-{csv_hash}"
+
+    def _publish_artifacts(self, path, catalog):
+        """Refresh ``<db>/schema.csv`` and ``<db>/column_stats.json`` in the background if their sources changed."""
+        schema_path = os.path.join(path, catalog.db_name, 'schema.csv')
+        artifact_writer.submit(schema_path, catalog.fingerprint, lambda: catalog.schema_text)
+        stats_path = os.path.join(path, catalog.db_name, 'column_stats.json')
+        artifact_writer.submit(
+            stats_path,
+            catalog.fingerprint,
+            lambda: json.dumps(catalog.column_stats, ensure_ascii=False, indent=2, default=str),
+        )
+
+    def _build_lock(self, key):
+        with self._lock:
+            lock = self._build_locks.get(key)
+            if lock is None:
+                lock = self._build_locks[key] = threading.Lock()
+            return lock
+
+    def _cache_file(self, db_name):
+        return os.path.join(self.cache_dir, f"{db_name}.catalog.json")
+
+    def _load(self, db_name, fingerprint):
+        cache_file = self._cache_file(db_name)
+        try:
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != CATALOG_FORMAT_VERSION or data.get("fingerprint") != fingerprint:
+            return None
+        return SchemaCatalog.from_dict(data)
+
+    def _save(self, catalog):
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            write_atomic(self._cache_file(catalog.db_name), json.dumps(catalog.to_dict(), ensure_ascii=False, default=str))
+        except OSError as e:
+            log.warning("could not persist schema catalog", db=catalog.db_name, error=repr(e))
+
+
+# Shared by every SchemaGenerator in the process
+catalog_store = CatalogStore()
+
+
+def get_catalog(path, db_name):
+    return catalog_store.get(path, db_name)
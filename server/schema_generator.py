@@ -1,29 +1,18 @@
 from llm_call import LLMCaller
 from prompts.schema_linking_prompt import SelectColumns_prompt
+from schema_catalog import get_catalog
+from value_index import get_value_index
+from config import SCHEMA_INDEX_ENABLED, SCHEMA_INDEX_TOP_N
+from metrics import timed
+from tracing import get_logger
 
-import sqlite3
-import os
+import asyncio
 import json
 import re
-import pandas as pd
+import threading
 
+log = get_logger(__name__)
 
-def _read_csv_robust(file_path: str) -> pd.DataFrame:
-    """Read CSV with fallback encodings to avoid UnicodeDecodeError.
-
-    Tries utf-8 and common Windows encodings (utf-8-sig, cp1252, latin1).
-    Falls back to python engine with on_bad_lines='skip' if needed.
-    """
-    for enc in ("utf-8", "utf-8-sig", "cp1252", "latin1"):
-        try:
-            return pd.read_csv(file_path, encoding=enc)
-        except UnicodeDecodeError:
-            continue
-        except Exception:
-            # Other errors should propagate for visibility
-            raise
-    # Final fallback: tolerate bad lines
-    return pd.read_csv(file_path, encoding="latin1", engine="python", on_bad_lines="skip")
 
 class SchemaGenerator:
     def __init__(self, db_name, path, question, model):
@@ -31,79 +20,103 @@ class SchemaGenerator:
         self.path = path
         self.question = question
         self.llm_model = LLMCaller(model = model)
-        self.db_schema, self.db_schema_json = self.filter_schema()
-        self.formatted_full_schema, self.formatted_full_schema_json = self.obtain_db_schema(self.path, self.db_name)
-        
+        self.catalog = get_catalog(self.path, self.db_name)
+        self.formatted_full_schema, self.formatted_full_schema_json = self.catalog.schema_text, self.catalog.schema_json
+        self.value_index = get_value_index(self.path, self.db_name, self.catalog.fingerprint)
+        self.db_schema_json = self.formatted_full_schema_json
+        self._db_schema = None
+        self._db_schema_lock = threading.Lock()
+        self._db_schema_task = None
+
+    @property
+    def db_schema(self):
+        """Schema text filtered to the question, linked on first access."""
+        if self._db_schema is None:
+            with self._db_schema_lock:
+                if self._db_schema is None:
+                    self._db_schema, _ = self.filter_schema()
+        return self._db_schema
+
+    @db_schema.setter
+    def db_schema(self, value):
+        self._db_schema = value
+
+    async def aget_db_schema(self):
+        """Async counterpart of :attr:`db_schema`; concurrent callers share one linking call."""
+        if self._db_schema is None:
+            if self._db_schema_task is None:
+                self._db_schema_task = asyncio.ensure_future(self.afilter_schema())
+            try:
+                self._db_schema, _ = await self._db_schema_task
+            finally:
+                self._db_schema_task = None
+        return self._db_schema
+
+    @timed("schema_filter")
     def filter_schema(self):
-        db_schema, db_schema_json = self.obtain_db_schema(self.path, self.db_name)
-        Select_Columns = [{"role": "system", "content": "You are an expert and very smart data analyst."}, {'role': 'user', 'content': SelectColumns_prompt.format(DATABASE_SCHEMA = db_schema, QUESTION = self.question)}]
-        columns = self.llm_model.call(Select_Columns)
+        resolved, query = self._prepare_linking()
+        if resolved is not None:
+            return resolved
+        columns = self.llm_model.call(query, stage="schema_linking")
+        return self._apply_linking(columns)
+
+    @timed("schema_filter")
+    async def afilter_schema(self):
+        resolved, query = self._prepare_linking()
+        if resolved is not None:
+            return resolved
+        columns = await self.llm_model.async_call(query, "schema_linking")
+        return self._apply_linking(columns)
+
+    def _prepare_linking(self):
+        """Return ``(result, None)`` if the schema is linked locally, else ``(None, query)``."""
+        db_schema, db_schema_json = self.formatted_full_schema, self.formatted_full_schema_json
+        candidate_schema = db_schema
+        if SCHEMA_INDEX_ENABLED:
+            ranking = self.catalog.schema_index.rank(self.question)
+            if ranking.confident:
+                tables = ranking.linked_tables
+                log.info("schema linking resolved locally", tables=tables)
+                columns_json = {table: list(db_schema_json[table]) for table in tables}
+                return (self.format_filtered_schema(columns_json, db_schema_json), db_schema_json), None
+            if ranking.table_scores:
+                candidate_schema = self.catalog.format_schema(ranking.top_tables(SCHEMA_INDEX_TOP_N))
+        Select_Columns = [{"role": "system", "content": "You are an expert and very smart data analyst."}, {'role': 'user', 'content': SelectColumns_prompt.format(DATABASE_SCHEMA = candidate_schema, QUESTION = self.question)}]
+        return None, Select_Columns
+
+    def _apply_linking(self, columns):
+        db_schema, db_schema_json = self.formatted_full_schema, self.formatted_full_schema_json
         columns_json = json.loads(columns.strip('```json\n'))
         try:
-            filter_columns = f"{self.db_name} database outlines the table names and their respective columns. Each column is detailed in this order: column_name, is_PrimaryKey, data_type, column_description, value_description, and value_example. \n\n"
-            for table, columns in columns_json.items():
-                if table != 'explanation':
-                    filter_columns += f"\nTable: {table}\n"
-                    for column in columns:
-                        filter_columns += (f" - {column}:" + ', '.join(re.sub(r'\s+', ' ', str(value)).strip()  for value in db_schema_json[table][column].values()) + "\n")               
-            return filter_columns, db_schema_json
+            return self.format_filtered_schema(columns_json, db_schema_json), db_schema_json
         except:
             return db_schema, db_schema_json
 
-    def obtain_db_schema(self, path, db):
-        conn = sqlite3.connect(os.path.join(path, db, f"{db}.sqlite"))
-        cursor = conn.cursor()
-        schema_path = os.path.join(path, db, 'schema.csv')
-        result = f"The following schema from the {db} database outlines the table names and their respective columns. Each column is detailed in this order: column_name, is_PrimaryKey, data_type, column_description, value_description, and value_example. \n\n"
-        with open(schema_path, 'w', encoding='utf-8') as w_file:
-            w_file.write(result)
-        csv_path = os.path.join(path, db, 'database_description')
-        table_info_str = ''
-        schema_json = {}
-        for filename in os.listdir(csv_path):
-            if filename.endswith('.csv'):
-                file_path = os.path.join(csv_path, filename)
-                table = filename[:-4]
-                with open(schema_path, 'a', encoding='utf-8') as w_file:
-                    w_file.write(f"\nTable: {table}\n")
-                table_info = _read_csv_robust(file_path)
-                table_info = table_info.drop(columns=['column_name'])
-                table_info = table_info.rename(columns={'original_column_name': 'column_name'})
-                table_info = table_info[['column_name', 'column_description', 'value_description']]
-                table_info['column_name'] = table_info['column_name'].astype(str).str.strip()
-                cursor.execute(f"PRAGMA table_info({table});")
-                columns_info = cursor.fetchall()
-                columns_df = pd.DataFrame(columns_info, columns=['cid', 'name', 'type', 'notnull', 'dflt_value', 'pk'])
-                columns_df = columns_df[['name', 'pk', 'type']]
-                columns_df = columns_df.rename(columns={'name': 'column_name', 'type': 'data_type'})
-                columns_df['pk'] = columns_df['pk'].apply(lambda x: 'Primary Key' if x == 1 else '')
-                self.check_merge(set(columns_df['column_name']), set(table_info['column_name']))
-                table_info = pd.merge(columns_df, table_info, on='column_name', how='left')
-                table_info['value_examples'] = None
-                for column_name in table_info['column_name']:
-                    cursor.execute(f"SELECT DISTINCT [{column_name}] FROM {table} LIMIT 3;")
-                    distinct_values = [row[0] for row in cursor.fetchall()]
-                    table_info.loc[table_info['column_name'] == column_name, 'value_examples'] = str(distinct_values)
+    def format_filtered_schema(self, columns_json, db_schema_json):
+        filter_columns = f"{self.db_name} database outlines the table names and their respective columns. Each column is detailed in this order: column_name, is_PrimaryKey, data_type, column_description, value_description, value_example, and value_stats. \n\n"
+        for table, columns in columns_json.items():
+            if table != 'explanation':
+                filter_columns += f"\nTable: {table}\n"
+                for column in columns:
+                    filter_columns += (f" - {column}:" + ', '.join(re.sub(r'\s+', ' ', str(value)).strip()  for value in db_schema_json[table][column].values()) + "\n")
+        return filter_columns
 
-                with open(schema_path, 'a', encoding='utf-8') as w_file:
-                    table_info_str = table_info.to_csv(sep=',', index=False, header=False)
-                    w_file.write(table_info_str)
-                
-                result += f"\nTable: {table}\n{table_info_str}"
-                schema_json[table] = table_info.set_index('column_name').to_dict(orient='index')
-        cursor.close()
-        conn.close()
-        return result, schema_json
+    @property
+    def value_index_ready(self):
+        """True when value evidence comes from an index built for the current catalog."""
+        return self.value_index is not None and self.value_index.fresh
 
-    def check_merge(self,columns_in_columns_df, columns_in_table_info):
-        missing_in_table_info = columns_in_columns_df - columns_in_table_info
-        missing_in_columns_df = columns_in_table_info - columns_in_columns_df
+    def value_evidence(self, question):
+        """Describe which literals of ``question`` exist in the data, or None."""
+        if self.value_index is None:
+            return None
+        try:
+            return self.value_index.evidence(question)
+        except Exception as e:
+            log.warning("value index lookup failed", error=repr(e))
+            return None
 
-        if missing_in_table_info or missing_in_columns_df:
-            print("⚠️ Column mismatch detected:")
-            if missing_in_table_info:
-                print(f" - Missing in table_info: {sorted(missing_in_table_info)}")
-                raise ValueError("Column mismatch between table_info and columns_df. See printout above.")
-            if missing_in_columns_df:
-                print(f"There are redundant columns in database_description:: {sorted(missing_in_columns_df)}")
-                
+    def obtain_db_schema(self, path, db):
+        """Return the formatted schema text and schema JSON from the shared catalog."""
+        catalog = get_catalog(path, db)
+        return catalog.schema_text, catalog.schema_json
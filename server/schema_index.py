@@ -0,0 +1,180 @@
+"""Local BM25 index over a schema catalog for pre-filtering schema linking.
+
+Every column is indexed as a small document made of its table name, column
+name, ``column_description`` and ``value_description``. Ranking a question
+takes milliseconds and is used to decide whether the LLM schema-linking call
+can be skipped, or to shrink the schema it is sent to the top-N tables.
+"""
+import math
+import re
+from collections import Counter, defaultdict
+
+from config import (
+    SCHEMA_INDEX_CONFIDENT_RATIO,
+    SCHEMA_INDEX_CONFIDENT_TABLES,
+)
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+STOPWORDS = frozenset("""
+a an and are as at be by did do does for from had has have how i in is it its many me much of on or
+s show than that the their them there these they this to was were what when where which who whom whose
+why with list give find tell all any each every most more
+""".split())
+
+
+def _stem(token):
+    for suffix in ("ies", "es", "s"):
+        if len(token) > len(suffix) + 2 and token.endswith(suffix):
+            return token[:-len(suffix)] + ("y" if suffix == "ies" else "")
+    return token
+
+
+def tokenize(text):
+    """Lowercase word tokens with camelCase/snake_case split and light stemming."""
+    if not isinstance(text, str):
+        return []
+    text = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", text)
+    text = re.sub(r"([A-Z]+)([A-Z][a-z])", r"\1 \2", text)
+    tokens = re.findall(r"[a-z0-9]+", text.lower())
+    return [_stem(t) for t in tokens if t not in STOPWORDS]
+
+
+def _names_table(column, table):
+    """True if ``column`` is ``<entity>Id`` / ``<entity>_id`` and ``table`` is that entity (or its plural)."""
+    column, table = column.lower(), table.lower()
+    if not column.endswith("id") or len(column) <= 2:
+        return False
+    entity = column[:-2].rstrip("_")
+    plurals = {entity, entity + "s", entity + "es"}
+    if entity.endswith("y"):
+        plurals.add(entity[:-1] + "ies")
+    return table in plurals
+
+
+def key_links(schema_json):
+    """Map each table to the tables whose primary key it holds, matched by name.
+
+    A key column is the primary key of the table it names (``driverId`` of
+    ``drivers``, ``statusId`` of ``status``); every other table with a column
+    of that name links to it.
+    """
+    key_tables = {}
+    for table, columns in schema_json.items():
+        for column, info in columns.items():
+            if info.get('pk') == 'Primary Key' and _names_table(column, table):
+                key_tables[column.lower()] = table
+    links = defaultdict(set)
+    for table, columns in schema_json.items():
+        for column in columns:
+            target = key_tables.get(column.lower())
+            if target is not None and target != table:
+                links[table].add(target)
+    return dict(links)
+
+
+class SchemaRanking:
+    """Result of ranking a question against a :class:`SchemaIndex`."""
+
+    def __init__(self, table_scores, column_scores, query_terms, matched_terms, key_links=None):
+        # [(table, score)] best first, only tables that matched at all
+        self.table_scores = table_scores
+        # {table: [(column, score)] best first}
+        self.column_scores = column_scores
+        self.query_terms = query_terms
+        # {table: set of query terms matched by any of its columns}
+        self.matched_terms = matched_terms
+        # {table: tables whose primary key it references by name}
+        self.key_links = key_links or {}
+
+    def top_tables(self, n):
+        return [table for table, _ in self.table_scores[:n]]
+
+    @property
+    def confident_tables(self):
+        """Tables whose score is close to the best one."""
+        if not self.table_scores:
+            return []
+        best = self.table_scores[0][1]
+        return [table for table, score in self.table_scores if score >= SCHEMA_INDEX_CONFIDENT_RATIO * best]
+
+    @property
+    def confident(self):
+        """True when a few tables clearly stand out and cover every query term.
+
+        A term that matches no schema token (e.g. a literal value such as a
+        driver's name) usually needs an entity table the index cannot find, so
+        it makes the ranking not confident.
+        """
+        tables = self.confident_tables
+        if not tables or len(tables) > SCHEMA_INDEX_CONFIDENT_TABLES:
+            return False
+        covered = set().union(*(self.matched_terms[table] for table in tables))
+        return set(self.query_terms) <= covered
+
+    @property
+    def linked_tables(self):
+        """The confident tables plus the tables they join to through key columns (``driverId`` -> ``drivers``)."""
+        tables = list(self.confident_tables)
+        for table in list(tables):
+            tables += [linked for linked in sorted(self.key_links.get(table, ())) if linked not in tables]
+        return tables
+
+
+class SchemaIndex:
+    def __init__(self, documents, key_links=None):
+        # documents: [(table, column, tokens)]
+        self.documents = documents
+        self.key_links = key_links or {}
+        self.doc_freq = Counter()
+        self.postings = defaultdict(list)
+        total_length = 0
+        for doc_id, (_, _, tokens) in enumerate(documents):
+            counts = Counter(tokens)
+            total_length += len(tokens)
+            for term, tf in counts.items():
+                self.doc_freq[term] += 1
+                self.postings[term].append((doc_id, tf))
+        self.doc_lengths = [len(tokens) for _, _, tokens in documents]
+        self.avg_length = total_length / len(documents) if documents else 0.0
+
+    @classmethod
+    def from_schema_json(cls, schema_json):
+        documents = []
+        for table, columns in schema_json.items():
+            table_tokens = tokenize(table)
+            for column, info in columns.items():
+                tokens = list(table_tokens)
+                tokens += tokenize(column)
+                tokens += tokenize(info.get('column_description'))
+                tokens += tokenize(info.get('value_description'))
+                documents.append((table, column, tokens))
+        return cls(documents, key_links(schema_json))
+
+    def idf(self, term):
+        n = len(self.documents)
+        df = self.doc_freq.get(term, 0)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def rank(self, question):
+        query_terms = list(dict.fromkeys(tokenize(question)))
+        scores = defaultdict(float)
+        matched = defaultdict(set)
+        for term in query_terms:
+            idf = self.idf(term)
+            for doc_id, tf in self.postings.get(term, ()):
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[doc_id] / self.avg_length)
+                scores[doc_id] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+                matched[self.documents[doc_id][0]].add(term)
+
+        column_scores = defaultdict(list)
+        for doc_id, score in scores.items():
+            table, column, _ = self.documents[doc_id]
+            column_scores[table].append((column, score))
+        table_scores = []
+        for table, columns in column_scores.items():
+            columns.sort(key=lambda item: item[1], reverse=True)
+            table_scores.append((table, columns[0][1]))
+        table_scores.sort(key=lambda item: item[1], reverse=True)
+        return SchemaRanking(table_scores, dict(column_scores), query_terms, dict(matched), self.key_links)
@@ -4,7 +4,9 @@ import json
 import time
 import re
 import sys
-from openai import OpenAI
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 
 import pandas as pd
@@ -16,15 +18,22 @@ import asyncio
 import functools
 from typing import Callable, Any, TypeVar, Awaitable
 from datetime import datetime
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 from pathlib import Path
 
 from question_rewriter import QuestionRewriter
 from schema_generator import SchemaGenerator
-from utils import format_message, parse_schema_text, add_semicolon_if_missing, sanitize_sql
+from utils import format_message, parse_schema_text, add_semicolon_if_missing, sanitize_sql, has_top_level_order_by
 from prompts.xiyan_template_prompt import xiyan_template_en
-from db_utils import execute_query
+from db_utils import QueryResult, decode_cursor, run_query
+from result_diff import RowDigest, diff_results, reread_source
+from result_encoding import check_format, encode_json, encode_result
+from llm_pool import llm_pool
+from config import DB_MAX_ROWS, DB_QUERY_TIMEOUT, DB_QUERY_WORKERS, SQL_MODEL_ID, SQL_GENERATION_WORKERS, SPECULATIVE_RAW_SQL
+from metrics import CONTENT_TYPE, HTTP_RESPONSES, STREAM_ERRORS, render, timed
+from session_store import SessionConflict, SessionStore, deep_size, get_session_backend, register_session_metrics
+from tracing import get_logger, propagate, request_trace, set_session, trace_store, traced_request
 # from text2sql.udf_exec_json import LLMEnhancedDBExecutor
 
 CURR_DIR = Path(__file__).resolve().parent
@@ -35,64 +44,154 @@ db_path = str((CURR_DIR / "../minidev/dev_databases").resolve())
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}}, supports_credentials=True)
 
-# memory-resident session related data
-sessions = {}
+log = get_logger(__name__)
 
-def sql_generator(question, evidence, schema):
+# Session state: hot sessions in memory (bounded by idle TTL, count and size),
+# optionally persisted to a backend shared by every worker
+sessions = SessionStore(backend=get_session_backend(), restore=lambda state: ChatSession.from_state(state))
+register_session_metrics(sessions)
+
+# The raw and clarified generations of one request run side by side on this pool
+_sql_executor = ThreadPoolExecutor(max_workers=SQL_GENERATION_WORKERS, thread_name_prefix="sql-generation")
+# /api/sql/compare runs the raw and clarified queries side by side on this pool,
+# each on its own pooled connection
+_query_executor = ThreadPoolExecutor(max_workers=DB_QUERY_WORKERS, thread_name_prefix="sql-execution")
+
+
+def _sql_api_key():
     #base_url = 'https://api-inference.modelscope.cn/v1'
     api_key = 'YOUR_API_KEY'
     if not api_key:
         raise PermissionError("Missing MODELSCOPE_API_KEY for SQL generation")
-    client = OpenAI(
-        api_key=api_key  # ModelScope API_KEY
-    )
+    return api_key
 
-    prompt_raw = xiyan_template_en.format(
-        dialect="SQLite",
-        question=question,
-        db_schema=schema,
-        evidence= None
-    )
-    
-    prompt_with_evidence = xiyan_template_en.format(
+
+def get_sql_client():
+    """Return the pooled OpenAI client used for SQL generation."""
+    return llm_pool.client(_sql_api_key())  # ModelScope API_KEY
+
+
+def get_async_sql_client():
+    """Return the pooled async OpenAI client of the running event loop (async serving mode)."""
+    return llm_pool.async_client(_sql_api_key())
+
+
+def _sql_messages(question, evidence, schema):
+    prompt = xiyan_template_en.format(
         dialect="SQLite",
         question=question,
         db_schema=schema,
-        evidence= evidence
-    )
-    
-    response_raw = client.chat.completions.create(
-        model='gpt-4.1', # ModelScope Model-Id
-        messages=[
-            {
-                'role': 'system',
-                'content': 'You are a helpful assistant.'
-            },
-            {
-                'role': 'user',
-                'content': prompt_raw
-            }
-        ]
+        evidence=evidence
     )
-    sql_raw = response_raw.choices[0].message.content
-    
-    response_clarified = client.chat.completions.create(
-        model='gpt-4.1',
-        messages=[
-            {
-                'role': 'system',
-                'content': 'You are a helpful assistant.'
-            },
-            {
-                'role': 'user',
-                'content': prompt_with_evidence
-            }
-        ]
-    )
-    sql_clarified = response_clarified.choices[0].message.content
+    return [
+        {
+            'role': 'system',
+            'content': 'You are a helpful assistant.'
+        },
+        {
+            'role': 'user',
+            'content': prompt
+        }
+    ]
+
+
+@timed("sql_generation")
+def generate_sql(question, evidence, schema):
+    """Make one SQL generation call for ``question`` with optional ``evidence``."""
+    messages = _sql_messages(question, evidence, schema)
+    with llm_pool.slot(SQL_MODEL_ID, messages, stage="sql_generation") as slot:
+        response = slot.call(lambda: get_sql_client().chat.completions.create(
+            model=SQL_MODEL_ID,
+            messages=messages
+        ))
+    return response.choices[0].message.content
+
+
+@timed("sql_generation")
+async def agenerate_sql(question, evidence, schema):
+    """Async counterpart of :func:`generate_sql`."""
+    messages = _sql_messages(question, evidence, schema)
+    async with llm_pool.aslot(SQL_MODEL_ID, messages, stage="sql_generation") as slot:
+        response = await slot.acall(lambda: get_async_sql_client().chat.completions.create(
+            model=SQL_MODEL_ID,
+            messages=messages
+        ))
+    return response.choices[0].message.content
+
+
+def sql_generator(raw_question, clarified_question, evidence, schema, raw_future=None):
+    """Generate the raw and the clarified SQL concurrently.
+
+    Raw SQL answers the original question without evidence; clarified SQL
+    answers the refined question with the clarification evidence. A raw
+    generation already started speculatively can be passed as ``raw_future``;
+    it is regenerated if it failed or was cancelled.
+    """
+    if raw_future is None:
+        raw_future = _sql_executor.submit(propagate(generate_sql), raw_question, None, schema)
+    sql_clarified = generate_sql(clarified_question, evidence, schema)
+    try:
+        sql_raw = raw_future.result()
+    except Exception as e:
+        log.warning("speculative raw sql unavailable, regenerating", error=repr(e))
+        sql_raw = generate_sql(raw_question, None, schema)
     return sql_raw, sql_clarified
     
     
+async def asql_generator(raw_question, clarified_question, evidence, schema, raw_task=None):
+    """Async counterpart of :func:`sql_generator`; ``raw_task`` is an asyncio task."""
+    if raw_task is None:
+        raw_task = asyncio.ensure_future(agenerate_sql(raw_question, None, schema))
+    sql_clarified = await agenerate_sql(clarified_question, evidence, schema)
+    try:
+        sql_raw = await raw_task
+    except Exception as e:
+        log.warning("speculative raw sql unavailable, regenerating", error=repr(e))
+        sql_raw = await agenerate_sql(raw_question, None, schema)
+    return sql_raw, sql_clarified
+
+
+async def aiter_sql_generation(raw_question, clarified_question, evidence, schema, raw_task=None):
+    """Async counterpart of :func:`iter_sql_generation`."""
+    if raw_task is None:
+        raw_task = asyncio.ensure_future(agenerate_sql(raw_question, None, schema))
+
+    async def raw():
+        try:
+            return "raw", await raw_task
+        except Exception as e:
+            log.warning("speculative raw sql unavailable, regenerating", error=repr(e))
+            return "raw", await agenerate_sql(raw_question, None, schema)
+
+    async def clarified():
+        return "clarified", await agenerate_sql(clarified_question, evidence, schema)
+
+    tasks = [asyncio.ensure_future(raw()), asyncio.ensure_future(clarified())]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks + [raw_task]:
+            task.cancel()
+
+
+def iter_sql_generation(raw_question, clarified_question, evidence, schema, raw_future=None):
+    """Like :func:`sql_generator`, but yield ``("raw" | "clarified", sql)`` as each one finishes."""
+    if raw_future is None:
+        raw_future = _sql_executor.submit(propagate(generate_sql), raw_question, None, schema)
+    clarified_future = _sql_executor.submit(propagate(generate_sql), clarified_question, evidence, schema)
+    labels = {raw_future: "raw", clarified_future: "clarified"}
+    for future in as_completed(labels):
+        if labels[future] == "raw":
+            try:
+                yield "raw", future.result()
+            except Exception as e:
+                log.warning("speculative raw sql unavailable, regenerating", error=repr(e))
+                yield "raw", generate_sql(raw_question, None, schema)
+        else:
+            yield "clarified", future.result()
+
+
 class ChatSession:
     def __init__(self, session_id):
         self.session_id = session_id
@@ -106,6 +205,11 @@ class ChatSession:
         # Store generated SQL for comparison endpoint
         self.sql_raw = None
         self.sql_clarified = None
+        # Ambiguities last presented to the user
+        self.question_set = None
+        # Raw SQL generated speculatively while the user clarifies
+        self.raw_sql_future = None
+        self.raw_sql_question = None
 
     def add_message(self, role, content):
         """Add message to session history"""
@@ -127,8 +231,92 @@ class ChatSession:
     def clear(self):
         """Clear session history"""
         self.messages = []
+        self.cancel_raw_sql()
         self.last_accessed = datetime.now().isoformat()
 
+    def start_raw_sql(self, question, schema):
+        """Start generating the raw SQL of ``question`` in the background.
+
+        The raw SQL only depends on the original question and the full schema,
+        so it can be produced while the user answers the clarifications.
+        """
+        self.set_raw_sql(question, _sql_executor.submit(propagate(generate_sql), question, None, schema))
+
+    def set_raw_sql(self, question, future):
+        """Track a raw SQL generation of ``question`` (a thread future or an asyncio task)."""
+        self.cancel_raw_sql()
+        self.raw_sql_question = question
+        self.raw_sql_future = future
+
+    def cancel_raw_sql(self):
+        """Drop a pending speculative generation; a call already in flight is discarded."""
+        future = self.raw_sql_future
+        if isinstance(future, asyncio.Future):
+            # May run on a worker thread (session store calls, eviction); tasks are cancelled on their loop
+            try:
+                future.get_loop().call_soon_threadsafe(future.cancel)
+            except RuntimeError:
+                pass  # Loop already closed
+        elif future is not None:
+            future.cancel()
+        self.raw_sql_future = None
+        self.raw_sql_question = None
+
+    def pop_raw_sql(self, question):
+        """Hand over the speculative raw SQL future if it was started for ``question``."""
+        future = self.raw_sql_future if self.raw_sql_question == question else None
+        if future is None:
+            self.cancel_raw_sql()
+        self.raw_sql_future = None
+        self.raw_sql_question = None
+        return future
+
+    def approximate_size(self):
+        """Approximate bytes owned by this session; shared schema catalogs and clients are not counted."""
+        owned = [self.question, self.sql_raw, self.sql_clarified, self.messages]
+        qr = self.question_rewriter_instance
+        if qr is not None:
+            owned += [qr.question, qr.schema_generator._db_schema, qr.intention_model.root]
+        return deep_size(owned)
+
+    def to_state(self):
+        """Serializable state for a session backend; a speculative SQL generation is not kept."""
+        qr = self.question_rewriter_instance
+        return {
+            "session_id": self.session_id,
+            "db_name": self.db_name,
+            "question": self.question,
+            "created_at": self.created_at,
+            "messages": self.messages,
+            "question_set": self.question_set,
+            "sql_raw": self.sql_raw,
+            "sql_clarified": self.sql_clarified,
+            "rewriter": None if qr is None else {
+                "question": qr.question,
+                "db_schema": qr.schema_generator._db_schema,
+                "preference_tree": qr.intention_model.to_dict(),
+            },
+        }
+
+    @classmethod
+    def from_state(cls, state):
+        """Rebuild a session saved with :meth:`to_state` (in this or another worker)."""
+        session = cls(state["session_id"])
+        session.db_name = state["db_name"]
+        session.question = state["question"]
+        session.created_at = state["created_at"]
+        session.messages = state["messages"]
+        session.question_set = state["question_set"]
+        session.sql_raw = state["sql_raw"]
+        session.sql_clarified = state["sql_clarified"]
+        rewriter = state["rewriter"]
+        if rewriter is not None:
+            qr = attach_question_rewriter(session)
+            qr.question = rewriter["question"]
+            qr.schema_generator.db_schema = rewriter["db_schema"]
+            qr.intention_model.restore(rewriter["preference_tree"])
+        return session
+
     def to_dict(self):
         """transform session object to dict"""
         return {
@@ -139,174 +327,361 @@ class ChatSession:
         }
 
 
+def error_status(e):
+    """Map an exception to the HTTP status reported to the client."""
+    msg = str(e)
+    if isinstance(e, SessionConflict):
+        return 409
+    if isinstance(e, PermissionError) or "invalid_api_key" in msg.lower() or "incorrect api key" in msg.lower():
+        return 401
+    return 500
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event."""
+    if event == "error":
+        # The HTTP status of a stream is already 200 when it fails
+        STREAM_ERRORS.inc(data.get("status", 500))
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def open_session(data):
+    """Resolve (or create) the session of an analyze request and reset it for a new question."""
+    client_session_id = data.get("session_id") 
+
+    session_id = None
+    current_session = None
+
+    existing = sessions.get(client_session_id) if client_session_id else None
+    if existing is not None:
+        session_id = client_session_id
+        current_session = existing
+        log.info("using existing session", session_id=session_id)
+    else:
+        session_id = str(uuid.uuid4())
+        current_session = ChatSession(session_id)
+        sessions.add(current_session)
+        log.info("created new session", session_id=session_id)
+
+    set_session(session_id)
+
+    question = data.get("question", "")
+    db_name = data.get("db", "")
+    current_session.db_name = db_name
+    current_session.question = question
+    current_session.cancel_raw_sql()
+    return current_session
+
+
+def attach_question_rewriter(current_session):
+    """Create the QuestionRewriter of the session's question and store it on the session."""
+    model = "gpt"
+    qr_instance = QuestionRewriter(current_session.db_name, db_path, current_session.question, model)
+    current_session.question_rewriter_instance = qr_instance
+    return qr_instance
+
+
+def start_analysis(data):
+    """Resolve the session of an analyze request and attach a fresh QuestionRewriter to it."""
+    current_session = open_session(data)
+    qr_instance = attach_question_rewriter(current_session)
+    if SPECULATIVE_RAW_SQL:
+        current_session.start_raw_sql(current_session.question, qr_instance.schema_generator.formatted_full_schema)
+    return current_session, qr_instance
+
+
+def analysis_payload(current_session, parsed_schema, dialect, response_json):
+    response = json.loads(response_json)
+    current_session.question_set = response["question_set"]
+    sessions.save(current_session)
+    return {
+        "session_id": current_session.session_id,
+        "suggested_schema": parsed_schema,
+        "analysis": "Schema analysis completed",
+        "dialect_info": dialect,
+        "ambiguities": response["question_set"],
+    }
+
+
 # Ambiguity Identification
 @app.route("/api/sql/analyze", methods=["POST"])
+@traced_request("analyze")
 def analyze_sql_query():
     try:
         data = request.json
-        client_session_id = data.get("session_id") 
-
-        session_id = None
-        current_session = None
-
-        if client_session_id and client_session_id in sessions:
-            session_id = client_session_id
-            current_session = sessions[session_id]
-            current_session.last_accessed = datetime.now().isoformat() 
-            print(f"Using existing session: {session_id}")
-        else:
-            session_id = str(uuid.uuid4())
-            current_session = ChatSession(session_id)
-            sessions[session_id] = current_session
-            print(f"Created new session: {session_id}")
-
-        question = data.get("question", "")
         dialect = data.get("dialect", "SQLite")
-        db_name = data.get("db", "")
-        current_session.db_name = db_name
-        current_session.question = question
-        model = "gpt"
-
-        # Get or create session
-        if session_id not in sessions:
-            sessions[session_id] = ChatSession(session_id)
-        current_session = sessions[session_id]
+        current_session, qr_instance = start_analysis(data)
 
-        # Create QuestionRewriter instance and store it to session
-        qr_instance = QuestionRewriter(db_name, db_path, question, model)
-        print("qr created")  
-        current_session.question_rewriter_instance = qr_instance
+        # Detect first: a cached detection result also restores the linked schema
+        response_json = qr_instance.ambi_detection()
+        log.debug("analysis response", response=response_json)
 
         # parse schema
         schema_text = qr_instance.schema_generator.db_schema
         parsed_schema = parse_schema_text(schema_text)
 
-        response_json = qr_instance.ambi_detection()
-        print(response_json)
-
-        response = json.loads(response_json)
-        question_set = response["question_set"]
-
-        response_data = {
-            "session_id": session_id,
-            "suggested_schema": parsed_schema,
-            "analysis": "Schema analysis completed",
-            "dialect_info": dialect,
-            "ambiguities": question_set,
-        }
+        response_data = analysis_payload(current_session, parsed_schema, dialect, response_json)
         return jsonify(response_data), 200
 
     except Exception as e:
-        msg = str(e)
-        status = 500
-        if isinstance(e, PermissionError) or "invalid_api_key" in msg.lower() or "incorrect api key" in msg.lower():
-            status = 401
-        return (jsonify({"error": msg, "message": "Error processing schema analysis"}), status)
+        return (jsonify({"error": str(e), "message": "Error processing schema analysis"}), error_status(e))
+
+
+@app.route("/api/sql/analyze/stream", methods=["POST"])
+def analyze_sql_query_stream():
+    """Streaming variant of /api/sql/analyze (Server-Sent Events).
+
+    Emits ``session``, then ``schema`` once schema linking is done, one
+    ``ambiguity`` event per ambiguity as soon as its choices exist, and
+    finally ``done`` with the same payload as /api/sql/analyze. Failures are
+    reported as an ``error`` event carrying the HTTP status.
+    """
+    data = request.json or {}
+
+    def generate():
+        with request_trace("analyze_stream"):
+            yield from analyze_events()
+
+    def analyze_events():
+        try:
+            dialect = data.get("dialect", "SQLite")
+            current_session, qr_instance = start_analysis(data)
+            yield sse_event("session", {"session_id": current_session.session_id})
+
+            events = queue.Queue()
+            cached_json = qr_instance.cached_detection()
+            if cached_json is None:
+                # Detection runs alongside schema linking; it does not need the linked schema
+                def detect():
+                    try:
+                        result = qr_instance.ambi_detection(
+                            on_ambiguity=lambda index, item: events.put(("ambiguity", {"index": index, "ambiguity": item}))
+                        )
+                        events.put(("detected", result))
+                    except Exception as e:
+                        events.put(("failed", e))
+
+                threading.Thread(target=propagate(detect), daemon=True).start()
+
+            parsed_schema = parse_schema_text(qr_instance.schema_generator.db_schema)
+            yield sse_event("schema", {"suggested_schema": parsed_schema})
+
+            if cached_json is not None:
+                for index, item in enumerate(json.loads(cached_json).get("question_set") or []):
+                    yield sse_event("ambiguity", {"index": index, "ambiguity": item})
+                response_json = cached_json
+            else:
+                while True:
+                    kind, payload = events.get()
+                    if kind == "ambiguity":
+                        yield sse_event(kind, payload)
+                    elif kind == "failed":
+                        raise payload
+                    else:
+                        response_json = payload
+                        break
+            log.debug("analysis response", response=response_json)
+            yield sse_event("done", analysis_payload(current_session, parsed_schema, dialect, response_json))
+        except Exception as e:
+            yield sse_event("error", {"status": error_status(e), "error": str(e), "message": "Error processing schema analysis"})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
+def clarification_message(data):
+    """Build the QuestionRewriter message from the user's answers of a solve request."""
+    clarification_list = data.get('clarificationList', [])
+
+    qa_set = []
+    for item in clarification_list:
+        q_data = item.get('question', {})
+        ans = item.get('answer', '')
+        qa_set.append({
+            "level_1_label": q_data.get('level_1_label', None),
+            "level_2_label": q_data.get('level_2_label', None),
+            "question": q_data.get('question', None),
+            "answer": ans
+        })
+    additional_info = data.get('additional_info', '')
+    formatted_message = format_message(qa_set, additional_info)
+    log.debug("clarification message", message=formatted_message)
+    return formatted_message
+
+
+def run_clarification(qr_instance, data):
+    """Feed the user's answers of a solve request to the QuestionRewriter."""
+    formatted_message = clarification_message(data)
+    response_json = qr_instance.ambi_correction(message = formatted_message)
+    log.debug("clarification response", response=response_json)
+    return json.loads(response_json)
+
+
+def find_solve_session(data):
+    """Return ``(session, None)`` for a solve request, or ``(None, (error, status))``."""
+    session_id = data.get('session_id')
+    if not session_id:
+        return None, ({"error": "session_id is required"}, 400)
+    current_session = sessions.get(session_id)
+    if not current_session:
+        return None, ({"error": "Session not found or expired"}, 404)
+    set_session(session_id)
+    if not current_session.question_rewriter_instance:
+        return None, ({"error": "QuestionRewriter instance not found in session. Please call /analyze first."}, 400)
+    return current_session, None
+
+
+def needs_clarification(parsed_response):
+    return "has_ambiguity" in parsed_response or parsed_response['is_clarified'] == False
+
+
+def clarification_payload(current_session, parsed_response):
+    current_session.question_set = parsed_response['question_set']
+    sessions.save(current_session)
+    return {
+        "is_clarified": "False",
+        "session_id": current_session.session_id,
+        "ambiguities": parsed_response['question_set'],
+    }
+
+
+def store_sql(current_session, sql_raw, sql_clarified):
+    """Clean up and persist the generated SQL for /compare and return the solve payload."""
+    # Clean up any markdown formatting and ensure statement termination
+    sql_raw = add_semicolon_if_missing(sanitize_sql(sql_raw))
+    sql_clarified = add_semicolon_if_missing(sanitize_sql(sql_clarified))
+    log.info("sql generated", sql_raw=sql_raw, sql_clarified=sql_clarified)
+    current_session.sql_raw = sql_raw
+    current_session.sql_clarified = sql_clarified
+    sessions.save(current_session)
+    return {
+        "session_id": current_session.session_id,
+        "is_clarified": "True",
+        "sql_statement_raw": sql_raw,
+        "sql_statement_clarified": sql_clarified,
+    }
+
 
 @app.route("/api/sql/solve", methods=["POST"])
+@traced_request("solve")
 def solve_ambiguities():
-    print("[Solve] Entered solve_ambiguities route.") 
     try:
         # session management
         data = request.json
-        print(f"[Solve] Request JSON data: {data}") 
-        session_id = data.get('session_id')
-        print(f"[Solve] Session ID: {session_id}") 
-
-        if not session_id:
-            print("[Solve] No session_id provided, returning 400.") 
-            return jsonify({"error": "session_id is required"}), 400
-
-        current_session = sessions.get(session_id)
-        print(f"[Solve] Current session object: {current_session}") 
-        if not current_session:
-            print("[Solve] Session not found or expired, returning 404.") 
-            return jsonify({"error": "Session not found or expired"}), 404
+        current_session, error = find_solve_session(data)
+        if error is not None:
+            log.info("solve rejected", status=error[1], error=error[0]["error"])
+            return jsonify(error[0]), error[1]
 
         # residual ambiguity identification and question rewrite
         qr_instance = current_session.question_rewriter_instance
-        text2sql_agent = current_session.text2sql_agent
-        print(f"[Solve] QuestionRewriter instance from session: {qr_instance}") 
-        if not qr_instance:
-            print("[Solve] QuestionRewriter instance not found in session, returning 400.") 
-            return jsonify({"error": "QuestionRewriter instance not found in session. Please call /analyze first."}), 400
-
-        clarification_list = data.get('clarificationList', [])
-        print(f"[Solve] Clarification List: {clarification_list}") 
-        
-        qa_set = []
-        for item in clarification_list:
-            q_data = item.get('question', {})
-            ans = item.get('answer', '')
-            qa_set.append({
-                "level_1_label": q_data.get('level_1_label', None),
-                "level_2_label": q_data.get('level_2_label', None),
-                "question": q_data.get('question', None),
-                "answer": ans
-            })
-        print(f"[Solve] Prepared QA Set: {qa_set}") 
-            
-        additional_info = data.get('additional_info', '')
-        print(f"[Solve] Additional Info: {additional_info}")
-
-        formatted_message = format_message(qa_set, additional_info)
-        print(f"[Solve] Formatted message: {formatted_message}")
-
-        print("[Solve] Calling qr_instance.process_message for clarification...")
-        response_json = qr_instance.ambi_correction(message = formatted_message)
-        print(f"[Solve] process_message returned: {response_json}")
-         
-        parsed_response = json.loads(response_json) 
-        print(f"[Solve]Parsed response: {parsed_response}") 
+        parsed_response = run_clarification(qr_instance, data)
         
         response_data = None
         
-        if "has_ambiguity" in parsed_response or parsed_response['is_clarified'] == False:
-            response_data = {
-                "is_clarified": "False",
-                "session_id": session_id,
-                "ambiguities": parsed_response['question_set'],
-            }
+        if needs_clarification(parsed_response):
+            response_data = clarification_payload(current_session, parsed_response)
         else:
             # Generate raw SQL from the original question (no evidence),
             # and clarified SQL from the refined question with evidence.
             original_q = current_session.question or ""
             refined_q = parsed_response.get('question', original_q)
-            # Raw: original question, no evidence
-            sql_raw, _ = sql_generator(original_q, None, qr_instance.schema_generator.formatted_full_schema)
-            # Clarified: refined question, with evidence
-            _, sql_clarified = sql_generator(refined_q, parsed_response.get('evidence'), qr_instance.schema_generator.formatted_full_schema)
-            # Clean up any markdown formatting and ensure statement termination
-            sql_raw = add_semicolon_if_missing(sanitize_sql(sql_raw))
-            sql_clarified = add_semicolon_if_missing(sanitize_sql(sql_clarified))
-            print(f"Raw SQL parsed: {sql_raw}")
-            print(f"Clarified SQL parsed: {sql_clarified}")
+            sql_raw, sql_clarified = sql_generator(
+                original_q, refined_q, parsed_response.get('evidence'),
+                qr_instance.schema_generator.formatted_full_schema,
+                raw_future=current_session.pop_raw_sql(original_q),
+            )
             # persist to session for later comparison
-            current_session.sql_raw = sql_raw
-            current_session.sql_clarified = sql_clarified
-            response_data = {
-                "session_id": session_id,
-                "is_clarified": "True",
-                "sql_statement_raw": sql_raw,
-                # "result_raw": raw_result,
-                "sql_statement_clarified": sql_clarified,
-                # "result_clarified": clarified_reuslt
-            }
+            response_data = store_sql(current_session, sql_raw, sql_clarified)
 
         return jsonify(response_data), 200 
     
     except Exception as e:
-        print(f"[Solve Error] An exception occurred: {e}") 
-        import traceback
-        traceback.print_exc() # print complete traceback
-        msg = str(e)
-        status = 500
-        if isinstance(e, PermissionError) or "invalid_api_key" in msg.lower() or "incorrect api key" in msg.lower():
-            status = 401
+        log.exception("solve failed", error=repr(e))
         return jsonify({
-            "error": msg,
+            "error": str(e),
             "message": "Error processing ambiguity resolution"
-        }), status
+        }), error_status(e)
+
+
+@app.route("/api/sql/solve/stream", methods=["POST"])
+def solve_ambiguities_stream():
+    """Streaming variant of /api/sql/solve (Server-Sent Events).
+
+    Emits ``clarified`` with the refined question (or ``ambiguities`` when
+    more clarification is needed), then ``sql_raw`` and ``sql_clarified`` in
+    whichever order they finish, and finally ``done`` with the same payload
+    as /api/sql/solve. Failures are reported as an ``error`` event.
+    """
+    data = request.json or {}
+    current_session, error = find_solve_session(data)
+    if error is not None:
+        return jsonify(error[0]), error[1]
+    session_id = current_session.session_id
+    qr_instance = current_session.question_rewriter_instance
+
+    def generate():
+        with request_trace("solve_stream", session_id):
+            yield from solve_events()
+
+    def solve_events():
+        try:
+            parsed_response = run_clarification(qr_instance, data)
+            if needs_clarification(parsed_response):
+                yield sse_event("ambiguities", {"ambiguities": parsed_response['question_set']})
+                yield sse_event("done", clarification_payload(current_session, parsed_response))
+                return
+
+            original_q = current_session.question or ""
+            refined_q = parsed_response.get('question', original_q)
+            yield sse_event("clarified", {"question": refined_q, "evidence": parsed_response.get('evidence')})
+            statements = {}
+            for label, sql in iter_sql_generation(
+                original_q, refined_q, parsed_response.get('evidence'),
+                qr_instance.schema_generator.formatted_full_schema,
+                raw_future=current_session.pop_raw_sql(original_q),
+            ):
+                statements[label] = sql
+                yield sse_event(f"sql_{label}", {"sql": add_semicolon_if_missing(sanitize_sql(sql))})
+            yield sse_event("done", store_sql(current_session, statements["raw"], statements["clarified"]))
+        except Exception as e:
+            log.exception("solve failed", error=repr(e))
+            yield sse_event("error", {"status": error_status(e), "error": str(e), "message": "Error processing ambiguity resolution"})
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.after_request
+def count_response(response):
+    HTTP_RESPONSES.inc(request.method, route_label(request), response.status_code)
+    return response
+
+
+def route_label(req):
+    """Label a request by its route pattern, so metric labels stay bounded."""
+    return req.url_rule.rule if req.url_rule is not None else "unmatched"
+
+
+@app.route("/api/sessions/<session_id>/trace")
+def session_trace(session_id):
+    """Span trees of the session's recent analyze, solve and compare requests."""
+    payload, status = trace_payload(session_id)
+    return jsonify(payload), status
+
+
+def trace_payload(session_id):
+    requests = trace_store.get(session_id)
+    if requests is None:
+        if session_id in sessions:
+            requests = []
+        else:
+            return {"error": "No trace for this session"}, 404
+    return {"session_id": session_id, "requests": requests}, 200
+
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus metrics."""
+    return Response(render(), content_type=CONTENT_TYPE)
+
 
 @app.route("/")
 def health_check():
@@ -315,6 +690,7 @@ def health_check():
 
 
 @app.route("/api/sql/compare", methods=["POST"])
+@traced_request("compare")
 def compare_sql():
     try:
         data = request.json
@@ -325,42 +701,98 @@ def compare_sql():
         current_session = sessions.get(session_id)
         if not current_session:
             return jsonify({"error": "Session not found or expired"}), 404
+        set_session(session_id)
 
-        # Ensure we have SQLs to execute
-        raw_sql = sanitize_sql(current_session.sql_raw) if current_session.sql_raw else None
-        clarified_sql = sanitize_sql(current_session.sql_clarified) if current_session.sql_clarified else None
-        if not raw_sql and not clarified_sql:
-            return jsonify({"error": "No SQL statements available for comparison. Solve ambiguities first."}), 400
-
-        db_name = current_session.db_name
-        # Execute queries
-        raw_rows = execute_query(db_path, db_name, raw_sql) if raw_sql else []
-        clarified_rows = execute_query(db_path, db_name, clarified_sql) if clarified_sql else []
-
-        raw_payload = {
-            "success": True,
-            "rows": raw_rows,
-            "row_count": len(raw_rows) if isinstance(raw_rows, list) else 0,
-        }
-        clarified_payload = {
-            "success": True,
-            "rows": clarified_rows,
-            "row_count": len(clarified_rows) if isinstance(clarified_rows, list) else 0,
-        }
-
-        return jsonify({
-            "raw_sql": raw_sql,
-            "clarified_sql": clarified_sql,
-            "raw_result": raw_payload,
-            "clarified_result": clarified_payload,
-        }), 200
+        payload, status = compare_payload(current_session, data)
+        body, headers = encode_json(payload, request.headers.get("Accept-Encoding", ""))
+        return Response(body, status=status, headers=headers)
     except Exception as e:
-        print(f"[Compare Error] {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("compare failed", error=repr(e))
         return jsonify({"error": str(e), "message": "Error processing SQL comparison"}), 500
 
 
+def _run_until(deadline, *args, **kwargs):
+    """``run_query`` with the time left until ``deadline`` (monotonic, or None) as its timeout."""
+    timeout = max(deadline - time.monotonic(), 0.001) if deadline is not None else None
+    return run_query(*args, timeout=timeout, **kwargs)
+
+
+def compare_payload(current_session, options=None):
+    """Execute the session's raw and clarified SQL and return ``(payload, status)``.
+
+    ``options`` may set ``page_size`` (capped at ``AMBISQL_DB_MAX_ROWS``) and
+    ``raw_cursor`` / ``clarified_cursor``, the ``next_cursor`` of a previous
+    response, to fetch the following page of that side. The first page also
+    carries a ``diff`` of the full results (see ``result_diff``); ``diff``
+    turns it on or off and ``ordered`` overrides whether row order counts
+    (by default, when both queries end with an ORDER BY). ``format`` selects
+    how the rows are encoded: ``rows``, ``columnar`` or ``arrow`` (see
+    ``result_encoding``).
+    """
+    options = options or {}
+    # Ensure we have SQLs to execute
+    raw_sql = sanitize_sql(current_session.sql_raw) if current_session.sql_raw else None
+    clarified_sql = sanitize_sql(current_session.sql_clarified) if current_session.sql_clarified else None
+    if not raw_sql and not clarified_sql:
+        return {"error": "No SQL statements available for comparison. Solve ambiguities first."}, 400
+
+    try:
+        page_size = int(options.get("page_size") or 0)
+        if page_size < 0:
+            raise ValueError("page_size must be positive")
+        if DB_MAX_ROWS:
+            page_size = min(page_size, DB_MAX_ROWS) if page_size else DB_MAX_ROWS
+        result_format = options.get("format", "rows")
+        check_format(result_format)
+        raw_offset = decode_cursor(options["raw_cursor"], raw_sql) if raw_sql and options.get("raw_cursor") else 0
+        clarified_offset = (
+            decode_cursor(options["clarified_cursor"], clarified_sql)
+            if clarified_sql and options.get("clarified_cursor") else 0
+        )
+    except (TypeError, ValueError) as e:
+        return {"error": str(e)}, 400
+
+    db_name = current_session.db_name
+    want_diff = bool(raw_sql and clarified_sql and options.get("diff", not (raw_offset or clarified_offset)))
+    ordered = options.get("ordered")
+    if want_diff and ordered is None:
+        ordered = has_top_level_order_by(raw_sql) and has_top_level_order_by(clarified_sql)
+
+    # Execute both queries concurrently under one deadline; with a diff, each
+    # run also hashes its whole result, so neither query is executed twice
+    started = time.monotonic()
+    deadline = started + DB_QUERY_TIMEOUT if DB_QUERY_TIMEOUT else None
+
+    def submit(sql_query, offset):
+        if not sql_query:
+            return None
+        digest = RowDigest(ordered=bool(ordered)) if want_diff else None
+        return _query_executor.submit(propagate(_run_until), deadline, db_path, db_name, sql_query,
+                                      max_rows=page_size, offset=offset, digest=digest)
+
+    raw_future = submit(raw_sql, raw_offset)
+    clarified_future = submit(clarified_sql, clarified_offset)
+    # A side without SQL is reported as an empty, successful result
+    raw_result = raw_future.result() if raw_future is not None else QueryResult(None)
+    clarified_result = clarified_future.result() if clarified_future is not None else QueryResult(None)
+
+    diff = None
+    if want_diff and raw_result.success and clarified_result.success:
+        diff = diff_results(raw_result, clarified_result, reread={
+            "raw": reread_source(db_path, db_name, raw_sql, deadline),
+            "clarified": reread_source(db_path, db_name, clarified_sql, deadline),
+        })
+
+    return {
+        "raw_sql": raw_sql,
+        "clarified_sql": clarified_sql,
+        "raw_result": encode_result(raw_result.to_dict(), result_format),
+        "clarified_result": encode_result(clarified_result.to_dict(), result_format),
+        "diff": diff,
+        "elapsed_ms": round((time.monotonic() - started) * 1000, 3),
+    }, 200
+
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 8765))
     app.run(host="0.0.0.0", port=port, debug=True)
@@ -0,0 +1,367 @@
+"""Bounded, thread-safe store of chat sessions, optionally backed by SQLite.
+
+Sessions expire after ``AMBISQL_SESSION_TTL`` seconds without a request. When
+more than ``AMBISQL_SESSION_MAX_ENTRIES`` sessions (or, if set, more than
+``AMBISQL_SESSION_MAX_BYTES`` of approximate session state) are held, the
+least recently used ones are evicted. Sizes are approximate: they count what a
+session owns (question, linked schema, preference tree, SQL, messages) and
+not the schema catalogs shared between sessions.
+
+With ``AMBISQL_SESSION_BACKEND=sqlite`` every saved session is also written to
+a SQLite file, so any worker process on the host (or a restarted server) can
+resume it. The in-memory store then acts as a cache of hot sessions: a hit only
+checks that no other worker has saved a newer version.
+
+A backend provides ``load(session_id) -> (state, version) | None``,
+``version(session_id) -> int | None``, ``save(session_id, state,
+expected_version) -> version``, ``touch(session_id)``, ``delete(session_id)``
+and ``purge_expired()``; ``state`` is the dict returned by the session's
+``to_state()``. A backend expires a session ``ttl`` seconds after it was last
+saved or touched; the store touches the sessions it serves at most every
+``TOUCH_INTERVAL`` seconds, so reads keep a session alive as well as writes.
+``save`` only replaces the version the caller last saw and raises
+:class:`SessionConflict` when another worker saved the session in between.
+"""
+import json
+import sqlite3
+import sys
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from datetime import datetime
+
+from config import SESSION_BACKEND, SESSION_DB_PATH, SESSION_MAX_BYTES, SESSION_MAX_ENTRIES, SESSION_TTL
+from metrics import family, register_collector
+from tracing import get_logger
+
+log = get_logger(__name__)
+
+
+class SessionConflict(Exception):
+    """Another worker saved the session since this process last loaded or saved it."""
+
+
+def deep_size(obj, seen=None):
+    """Approximate the bytes held by ``obj`` and the containers and plain objects it references."""
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += deep_size(vars(obj), seen)
+    return size
+
+
+class SQLiteSessionBackend:
+    """Sessions as compressed JSON rows of a local SQLite file shared between processes."""
+
+    # Expired rows are purged at most this often (seconds)
+    PURGE_INTERVAL = 60
+
+    def __init__(self, path=SESSION_DB_PATH, ttl=SESSION_TTL):
+        self.path = str(path)
+        self.ttl = ttl
+        self._last_purge = 0.0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL;")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                session_id TEXT PRIMARY KEY,
+                state BLOB NOT NULL,
+                version INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS sessions_updated_at ON sessions (updated_at);")
+        self._conn.commit()
+
+    @staticmethod
+    def encode(state):
+        return zlib.compress(json.dumps(state, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+    @staticmethod
+    def decode(blob):
+        return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+    def _live(self):
+        return time.time() - self.ttl if self.ttl else float("-inf")
+
+    def load(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT state, version FROM sessions WHERE session_id = ? AND updated_at >= ?;",
+                (session_id, self._live()),
+            ).fetchone()
+        if row is None:
+            return None
+        return self.decode(row[0]), row[1]
+
+    def version(self, session_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT version FROM sessions WHERE session_id = ? AND updated_at >= ?;",
+                (session_id, self._live()),
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    def save(self, session_id, state, expected_version=None):
+        """Write ``state`` over ``expected_version`` (or as a new row) and return the new version."""
+        blob = self.encode(state)
+        now = time.time()
+        with self._lock:
+            row = None
+            if expected_version is not None:
+                row = self._conn.execute(
+                    """
+                    UPDATE sessions SET state = ?, version = version + 1, updated_at = ?
+                    WHERE session_id = ? AND version = ? RETURNING version;
+                    """,
+                    (blob, now, session_id, expected_version),
+                ).fetchone()
+            if row is None:
+                # New, or purged since it was loaded; an existing row means someone else saved it
+                row = self._conn.execute(
+                    """
+                    INSERT INTO sessions (session_id, state, version, updated_at) VALUES (?, ?, 1, ?)
+                    ON CONFLICT (session_id) DO NOTHING RETURNING version;
+                    """,
+                    (session_id, blob, now),
+                ).fetchone()
+            self._conn.commit()
+        if row is None:
+            raise SessionConflict(f"Session {session_id} was modified by another request; retry")
+        return row[0]
+
+    def touch(self, session_id):
+        """Restart the session's TTL without changing its version."""
+        with self._lock:
+            self._conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?;", (time.time(), session_id))
+            self._conn.commit()
+
+    def delete(self, session_id):
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE session_id = ?;", (session_id,))
+            self._conn.commit()
+
+    def purge_expired(self):
+        now = time.monotonic()
+        if not self.ttl or now - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = now
+        with self._lock:
+            self._conn.execute("DELETE FROM sessions WHERE updated_at < ?;", (self._live(),))
+            self._conn.commit()
+
+
+def get_session_backend():
+    """Return the backend configured with ``AMBISQL_SESSION_BACKEND`` (None keeps sessions in memory only)."""
+    if SESSION_BACKEND == "sqlite":
+        return SQLiteSessionBackend()
+    if SESSION_BACKEND not in ("", "memory"):
+        raise ValueError(f"Unknown session backend {SESSION_BACKEND!r}; use 'memory' or 'sqlite'")
+    return None
+
+
+class SessionStore:
+    """In-memory sessions, and a cache of hot sessions in front of ``backend`` if one is given.
+
+    ``restore(state)`` rebuilds a session from the state a backend returns.
+    """
+
+    # Longest time (seconds) between two backend touches of a session in use
+    TOUCH_INTERVAL = 60
+
+    def __init__(self, ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES, max_bytes=SESSION_MAX_BYTES,
+                 backend=None, restore=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.backend = backend
+        self.restore = restore
+        self.created = 0
+        self.restored = 0
+        self.evictions = Counter()
+        self.total_bytes = 0
+        # session_id -> [session, last access (monotonic), size, backend version, last backend write (monotonic)],
+        # least recently accessed first
+        self._entries = OrderedDict()
+        self._lock = threading.RLock()
+        # Serializes backend writes, so this process never conflicts with itself
+        self._save_lock = threading.Lock()
+        self.touch_interval = min(self.TOUCH_INTERVAL, ttl / 10) if ttl else self.TOUCH_INTERVAL
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __contains__(self, session_id):
+        return self.get(session_id, touch=False) is not None
+
+    def get(self, session_id, touch=True):
+        """Return the session, or None if it is unknown or has expired."""
+        with self._lock:
+            entry = self._entries.get(session_id)
+            if entry is not None and self._expired(entry, time.monotonic()):
+                self._evict(session_id, "ttl")
+                entry = None
+        if self.backend is not None:
+            entry = self._refresh(session_id, entry)
+        if entry is None:
+            return None
+        if touch:
+            now = time.monotonic()
+            with self._lock:
+                entry[1] = now
+                if session_id in self._entries:
+                    self._entries.move_to_end(session_id)
+                stale = self.backend is not None and now - entry[4] > self.touch_interval
+                if stale:
+                    entry[4] = now
+            if stale:
+                self.backend.touch(session_id)
+            entry[0].last_accessed = datetime.now().isoformat()
+        return entry[0]
+
+    def _refresh(self, session_id, entry):
+        """Return ``entry`` if it is the latest version in the backend, else reload the session from it."""
+        if entry is not None:
+            version = self.backend.version(session_id)
+            if version == entry[3]:
+                return entry
+            if version is None:
+                # Expired or deleted by another worker
+                self.pop(session_id)
+                return None
+        loaded = self.backend.load(session_id)
+        if loaded is None:
+            return None
+        state, version = loaded
+        session = self.restore(state)
+        with self._lock:
+            self.restored += 1
+            # Loaded, not written: the next access touches it in the backend
+            self._insert(session, version, written=float("-inf"))
+            return self._entries[session_id]
+
+    def add(self, session):
+        """Store a new session."""
+        with self._lock:
+            self.created += 1
+        self.save(session)
+
+    def save(self, session):
+        """Store ``session`` again after it changed: re-measure it and write it to the backend.
+
+        Raises SessionConflict (and drops the stale copy from memory) if
+        another worker saved the session after this process last saw it.
+        """
+        if self.backend is None:
+            with self._lock:
+                self._insert(session, None)
+            return
+        with self._save_lock:
+            with self._lock:
+                entry = self._entries.get(session.session_id)
+            # A session evicted from memory while in use is saved over the latest version
+            expected = entry[3] if entry is not None else self.backend.version(session.session_id)
+            try:
+                version = self.backend.save(session.session_id, session.to_state(), expected)
+            except SessionConflict:
+                self.pop(session.session_id)
+                log.warning("session save conflict", conflicting_session=session.session_id, version=expected)
+                raise
+            with self._lock:
+                self._insert(session, version)
+
+    def _insert(self, session, version, written=None):
+        size = session.approximate_size()
+        entry = self._entries.pop(session.session_id, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+        now = time.monotonic()
+        self._entries[session.session_id] = [session, now, size, version, now if written is None else written]
+        self.total_bytes += size
+        self._enforce_limits(keep=session.session_id)
+
+    def pop(self, session_id):
+        with self._lock:
+            entry = self._entries.pop(session_id, None)
+            if entry is None:
+                return None
+            self.total_bytes -= entry[2]
+            return entry[0]
+
+    def sweep(self):
+        """Evict every expired session (from memory; the backend purges its own expired rows).
+
+        Entries are kept in access order, so only the expired ones at the front are visited.
+        """
+        with self._lock:
+            now = time.monotonic()
+            while self._entries:
+                session_id, entry = next(iter(self._entries.items()))
+                if not self._expired(entry, now):
+                    break
+                self._evict(session_id, "ttl")
+        if self.backend is not None:
+            self.backend.purge_expired()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self.total_bytes,
+                "created": self.created,
+                "restored": self.restored,
+                "evictions": dict(self.evictions),
+            }
+
+    def _expired(self, entry, now):
+        return bool(self.ttl) and now - entry[1] > self.ttl
+
+    def _enforce_limits(self, keep):
+        self.sweep()
+        for reason, over in (
+            ("capacity", lambda: self.max_entries and len(self._entries) > self.max_entries),
+            ("memory", lambda: self.max_bytes and self.total_bytes > self.max_bytes),
+        ):
+            while over():
+                # Least recently used first; the session being saved is never evicted
+                victim = next((sid for sid in self._entries if sid != keep), None)
+                if victim is None:
+                    break
+                self._evict(victim, reason)
+
+    def _evict(self, session_id, reason):
+        session = self.pop(session_id)
+        if session is None:
+            return
+        self.evictions[reason] += 1
+        session.cancel_raw_sql()
+        log.info("session evicted", evicted_session=session_id, reason=reason)
+
+
+def register_session_metrics(store):
+    """Expose ``store``'s size and evictions at ``/metrics``."""
+    @register_collector
+    def collect_session_metrics():
+        stats = store.stats()
+        return [
+            *family("ambisql_sessions", "gauge", "Sessions held in memory.", [({}, stats["sessions"])]),
+            *family("ambisql_session_bytes", "gauge", "Approximate bytes of session state held in memory.",
+                    [({}, stats["bytes"])]),
+            *family("ambisql_sessions_created_total", "counter", "Sessions created.", [({}, stats["created"])]),
+            *family("ambisql_sessions_restored_total", "counter", "Sessions loaded from the session backend.",
+                    [({}, stats["restored"])]),
+            *family("ambisql_session_evictions_total", "counter", "Sessions evicted, by reason (ttl, capacity, memory).",
+                    [({"reason": reason}, count) for reason, count in sorted(stats["evictions"].items())]),
+        ]
+    return collect_session_metrics
@@ -0,0 +1,343 @@
+"""Per-request span tracing and structured logging.
+
+Each analyze, solve and compare request opens a root span with
+:func:`request_trace`; pipeline stages (``metrics.timed``) open child spans
+with :func:`span`, and every LLM call records a leaf span (:func:`start_span`)
+with its prompt and response sizes and token usage. The current span lives in
+a context variable, so it follows asyncio tasks; work handed to a thread pool
+is wrapped with :func:`propagate`.
+
+When a request ends, its spans go to its session's ring buffer (served at
+``/api/sessions/<id>/trace``) and, if ``AMBISQL_TRACE_EXPORT_PATH`` is set,
+are appended to that file as one JSON line. Spans that end after their request
+(e.g. speculative SQL generation) are added to the buffer as they finish.
+"""
+import contextvars
+import functools
+import inspect
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from config import LOG_FORMAT, LOG_LEVEL, TRACE_EXPORT_PATH, TRACE_MAX_SESSIONS, TRACE_MAX_SPANS
+
+_current_span = contextvars.ContextVar("ambisql_span", default=None)
+
+
+class Span:
+    def __init__(self, name, trace, parent_id=None, attributes=None):
+        self.name = name
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.attributes = dict(attributes or {})
+        self.started_at = time.time()
+        self._started = time.monotonic()
+        self.duration = None
+        self.error = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, amount=1):
+        self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def finish(self, error=None):
+        if self.duration is not None:
+            return
+        self.duration = time.monotonic() - self._started
+        if error is not None:
+            self.error = repr(error)
+        self.trace.finished(self)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace.trace_id,
+            "request": self.trace.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 3) if self.duration is not None else None,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """The spans of one request."""
+
+    def __init__(self, name, session_id=None):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.session_id = session_id
+        self.spans = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def finished(self, span):
+        with self._lock:
+            if not self.closed:
+                self.spans.append(span)
+                return
+        trace_store.add(self.session_id, [span.to_dict()])
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+            spans = [span.to_dict() for span in self.spans]
+        trace_store.add(self.session_id, spans, export=True)
+
+
+def span_tree(spans):
+    """Nest flat span dicts under their parents; return the root spans in start order."""
+    nodes = {s["span_id"]: {**s, "children": []} for s in spans}
+    roots = []
+    for node in sorted(nodes.values(), key=lambda n: n["started_at"]):
+        parent = nodes.get(node["parent_id"])
+        (parent["children"] if parent is not None else roots).append(node)
+    return roots
+
+
+class TraceStore:
+    """Ring buffer of finished spans per session, for the most recent sessions."""
+
+    def __init__(self, max_spans=TRACE_MAX_SPANS, max_sessions=TRACE_MAX_SESSIONS, export_path=TRACE_EXPORT_PATH):
+        self.max_spans = max_spans
+        self.max_sessions = max_sessions
+        self.export_path = export_path
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._export_lock = threading.Lock()
+
+    def add(self, session_id, spans, export=False):
+        if export and self.export_path and spans:
+            self._export(session_id, spans)
+        if session_id is None or not self.max_spans:
+            return
+        with self._lock:
+            buffer = self._sessions.get(session_id)
+            if buffer is None:
+                buffer = self._sessions[session_id] = deque(maxlen=self.max_spans)
+            self._sessions.move_to_end(session_id)
+            buffer.extend(spans)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get(self, session_id):
+        """Return the span trees of a session's requests in start order, or None if unknown."""
+        with self._lock:
+            buffer = self._sessions.get(session_id)
+            spans = list(buffer) if buffer is not None else None
+        if spans is None:
+            return None
+        return span_tree(spans)
+
+    def drop(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _export(self, session_id, spans):
+        line = json.dumps({"session_id": session_id, "spans": spans}, ensure_ascii=False, default=str)
+        try:
+            with self._export_lock, open(self.export_path, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            get_logger(__name__).warning("trace export failed", path=self.export_path, error=repr(e))
+
+
+trace_store = TraceStore()
+
+
+def current_span():
+    return _current_span.get()
+
+
+def _enter(new_span):
+    return _current_span.set(new_span)
+
+
+def _exit(token):
+    try:
+        _current_span.reset(token)
+    except ValueError:
+        # A generator finalized from another context; that context never saw the span
+        pass
+
+
+@contextmanager
+def request_trace(name, session_id=None):
+    """Trace one request; its spans are stored when the block exits."""
+    trace = Trace(name, session_id)
+    root = Span(name, trace)
+    token = _enter(root)
+    error = None
+    try:
+        yield root
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _exit(token)
+        root.finish(error)
+        trace.close()
+
+
+def traced_request(name):
+    """Decorator running a (sync or async) route handler inside :func:`request_trace`."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with request_trace(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with request_trace(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_session(session_id):
+    """Attach the current request's trace to ``session_id``."""
+    current = _current_span.get()
+    if current is not None:
+        current.trace.session_id = session_id
+
+
+def start_span(name, **attributes):
+    """Start a child of the current span without making it current; None outside a request."""
+    parent = _current_span.get()
+    if parent is None:
+        return None
+    return Span(name, parent.trace, parent.span_id, attributes)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Run the block as a child span of the current one (untraced outside a request)."""
+    child = start_span(name, **attributes)
+    if child is None:
+        yield None
+        return
+    token = _enter(child)
+    error = None
+    try:
+        yield child
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _exit(token)
+        child.finish(error)
+
+
+def annotate(**attributes):
+    """Set attributes on the current span, if any."""
+    current = _current_span.get()
+    if current is not None:
+        current.set(**attributes)
+
+
+def propagate(func):
+    """Bind ``func`` to the current context, so a thread pool runs it inside the current span."""
+    return functools.partial(contextvars.copy_context().run, func)
+
+
+class _StructuredFormatter(logging.Formatter):
+    def __init__(self, as_json):
+        super().__init__()
+        self.as_json = as_json
+
+    def format(self, record):
+        fields = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S"),
+            "level": record.levelname,
+            "logger": record.name,
+            "event": record.getMessage(),
+        }
+        if getattr(record, "session_id", None):
+            fields["session_id"] = record.session_id
+        if getattr(record, "trace_id", None):
+            fields["trace_id"] = record.trace_id
+        fields.update(getattr(record, "fields", {}))
+        if record.exc_info:
+            fields["exc"] = self.formatException(record.exc_info)
+        if self.as_json:
+            return json.dumps(fields, ensure_ascii=False, default=str)
+        head = f'{fields.pop("ts")} {fields.pop("level")} {fields.pop("logger")} {fields.pop("event")}'
+        return " ".join([head] + [f"{key}={_logfmt(value)}" for key, value in fields.items()])
+
+
+def _logfmt(value):
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    return json.dumps(text, ensure_ascii=False) if (not text or any(c in text for c in ' "=\n')) else text
+
+
+class StructuredLogger:
+    """Logger taking an event name plus key/value fields: ``log.info("sql generated", chars=120)``.
+
+    Records carry the session and trace of the current request.
+    """
+
+    def __init__(self, logger):
+        self._logger = logger
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        current = _current_span.get()
+        extra = {
+            "fields": fields,
+            "session_id": current.trace.session_id if current is not None else None,
+            "trace_id": current.trace.trace_id if current is not None else None,
+        }
+        self._logger.log(level, event, exc_info=exc_info, extra=extra, stacklevel=3)
+
+
+_configure_lock = threading.Lock()
+_configured = False
+
+
+def _configure():
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        root = logging.getLogger("ambisql")
+        handler = logging.StreamHandler(sys.stdout)
+        handler.setFormatter(_StructuredFormatter(as_json=LOG_FORMAT == "json"))
+        root.addHandler(handler)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False
+        _configured = True
+
+
+def get_logger(name):
+    """Return the structured logger of module ``name`` (under the ``ambisql`` logger)."""
+    _configure()
+    return StructuredLogger(logging.getLogger(f"ambisql.{name}"))
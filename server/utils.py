@@ -1,5 +1,13 @@
+import asyncio
+import contextvars
 import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from tracing import get_logger
+
+log = get_logger(__name__)
 
 def format_message(qa_set, additional_info):
     message = {
@@ -37,7 +45,7 @@ def parse_json_response(response):
         else:
             raise ValueError("Can not retrieve JSON")
     except json.JSONDecodeError:
-        print(response)
+        log.warning("llm response is not valid json", response=response)
         raise ValueError("JSON Decoder failed.")
     except Exception as e:
         raise ValueError(f"Error: {e}")
@@ -97,3 +105,151 @@ def sanitize_sql(sql: str) -> str:
     if text.lower().startswith('sql\n'):
         text = text[4:].lstrip()
     return text
+
+def has_top_level_order_by(sql: str) -> bool:
+    """True if the outermost SELECT of ``sql`` has an ORDER BY (string literals and subqueries are ignored)."""
+    if not isinstance(sql, str):
+        return False
+    # Blank out string literals, quoted identifiers and comments first
+    text = re.sub(r"'(?:[^']|'')*'|\"(?:[^\"]|\"\")*\"|`[^`]*`|\[[^\]]*\]|--[^\n]*|/\*[\s\S]*?\*/", " ", sql)
+    depth = 0
+    for token in re.finditer(r"[()]|\border\s+by\b", text, flags=re.IGNORECASE):
+        if token.group(0) == "(":
+            depth += 1
+        elif token.group(0) == ")":
+            depth -= 1
+        elif depth == 0:
+            return True
+    return False
+
+
+_background_loop = None
+_background_loop_lock = threading.Lock()
+
+
+def _get_background_loop():
+    global _background_loop
+    if _background_loop is None:
+        with _background_loop_lock:
+            if _background_loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="async-bridge", daemon=True).start()
+                _background_loop = loop
+    return _background_loop
+
+
+def run_sync(coro):
+    """Run a coroutine to completion from synchronous code.
+
+    Coroutines run on one long-lived background event loop, so async clients
+    and their keep-alive connections are reused across calls. A coroutine
+    submitted from that loop itself runs on a fresh loop in a helper thread.
+    Either way it runs in a copy of the caller's context (e.g. its trace span).
+    """
+    loop = _get_background_loop()
+    try:
+        running = asyncio.get_running_loop()
+    except RuntimeError:
+        running = None
+    if running is loop:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(contextvars.copy_context().run, asyncio.run, coro).result()
+    return asyncio.run_coroutine_threadsafe(_in_context(coro, contextvars.copy_context()), loop).result()
+
+
+async def _in_context(coro, context):
+    # The task wrapping this coroutine has its own context, so setting the caller's values here is local to it
+    for var, value in context.items():
+        var.set(value)
+    return await coro
+
+
+class QuestionSetStreamParser:
+    """Incrementally extract the entries of a streamed ``question_set`` array.
+
+    Feed the LLM response chunk by chunk; ``feed`` returns every entry of the
+    top-level ``question_set`` array whose object closed in that chunk, so work
+    on the first ambiguity can start while later ones are still being written.
+    Only the text of the entry (or key) still open is buffered.
+    """
+
+    def __init__(self, key="question_set"):
+        self.key = key
+        # Unconsumed text; positions below are relative to its start
+        self.text = ""
+        self.pos = 0
+        # frames: {"type": "{" or "[", "key": last key seen, "value": expecting a value, "target": is the question_set array}
+        self.stack = []
+        self.in_string = False
+        self.escape = False
+        self.string_start = None
+        self.item_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        items = []
+        while self.pos < len(self.text):
+            ch = self.text[self.pos]
+            top = self.stack[-1] if self.stack else None
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+                    if top is not None and top["type"] == "{" and not top["value"]:
+                        top["key"] = self.text[self.string_start + 1:self.pos]
+            elif ch == '"':
+                self.in_string = True
+                self.string_start = self.pos
+            elif ch in "{[":
+                if ch == "{" and top is not None and top["target"] and self.item_start is None:
+                    self.item_start = self.pos
+                is_target = (
+                    ch == "[" and len(self.stack) == 1 and top["type"] == "{" and top["key"] == self.key
+                )
+                self.stack.append({"type": ch, "key": None, "value": False, "target": is_target})
+            elif ch in "}]":
+                if self.stack:
+                    self.stack.pop()
+                top = self.stack[-1] if self.stack else None
+                if ch == "}" and self.item_start is not None and top is not None and top["target"]:
+                    item = self._load(self.text[self.item_start:self.pos + 1])
+                    if item is not None:
+                        items.append(item)
+                    self.item_start = None
+            elif ch == ":" and top is not None and top["type"] == "{":
+                top["value"] = True
+            elif ch == "," and top is not None and top["type"] == "{":
+                top["value"] = False
+            self.pos += 1
+        self._trim()
+        return items
+
+    def _trim(self):
+        """Drop the text no open entry or key string still needs."""
+        if self.item_start is not None:
+            cut = self.item_start
+        elif self.in_string:
+            cut = self.string_start
+        else:
+            cut = self.pos
+        if cut:
+            self.text = self.text[cut:]
+            self.pos -= cut
+            if self.item_start is not None:
+                self.item_start -= cut
+            self.string_start = self.string_start - cut if self.in_string else None
+
+    @staticmethod
+    def _load(text):
+        try:
+            return json.loads(text)
+        except json.JSONDecodeError:
+            pass
+        try:
+            # Same leniency as parse_json_response
+            return json.loads(text.replace("True", "true").replace("False", "false").replace("None", "null"))
+        except json.JSONDecodeError:
+            return None
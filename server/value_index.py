@@ -0,0 +1,197 @@
+"""Full-text index over the distinct text values of a database.
+
+The index lives next to the source database as ``<db>/<db>.values.sqlite`` and
+holds every distinct value of every text column, in a plain table (for exact
+and prefix lookups on the case-folded value) and an FTS5 trigram table (for
+fuzzy substring matches). Ambiguity detection uses it to tell the LLM whether
+literals in the question, such as "Hamilton" or "British GP", actually exist
+in the data and under which spelling.
+
+Build it offline with ``python value_index.py <db_name> [<databases_path>]``.
+"""
+import difflib
+import os
+import re
+import sqlite3
+import sys
+
+from artifact_writer import artifact_writer, is_fresh
+from config import VALUE_INDEX_AUTOBUILD, VALUE_INDEX_MAX_MATCHES
+
+MAX_VALUES_PER_COLUMN = 50000
+MAX_VALUE_LENGTH = 200
+FUZZY_MIN_RATIO = 0.6
+
+_TEXT_TYPES = ("CHAR", "CLOB", "TEXT")
+_QUESTION_WORDS = frozenset(
+    "how what which who whom whose when where why list name give show find tell please among "
+    "is are was were do does did can the a an in of for".split()
+)
+
+
+def value_index_path(path, db):
+    return os.path.join(path, db, f"{db}.values.sqlite")
+
+
+def _normalize(value):
+    return re.sub(r"\s+", " ", value).strip().casefold()
+
+
+def _text_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info([{table}]);")
+    return [name for _, name, col_type, *_ in cursor.fetchall()
+            if not col_type or any(t in col_type.upper() for t in _TEXT_TYPES)]
+
+
+def build_value_index(source_path, index_path):
+    """Create the value index for the database at ``source_path`` in ``index_path``."""
+    if os.path.exists(index_path):
+        os.remove(index_path)
+    source = sqlite3.connect(f"file:{source_path}?mode=ro", uri=True)
+    index = sqlite3.connect(index_path)
+    try:
+        index.executescript("""
+            CREATE TABLE value_terms (norm TEXT NOT NULL, value TEXT NOT NULL, tbl TEXT NOT NULL, col TEXT NOT NULL);
+            CREATE VIRTUAL TABLE value_fts USING fts5(value, tbl UNINDEXED, col UNINDEXED, tokenize='trigram');
+        """)
+        cursor = source.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%';")
+        tables = [row[0] for row in cursor.fetchall()]
+        for table in tables:
+            for column in _text_columns(cursor, table):
+                cursor.execute(
+                    f"SELECT DISTINCT [{column}] FROM [{table}] WHERE typeof([{column}]) = 'text' "
+                    f"AND length([{column}]) BETWEEN 1 AND ? LIMIT ?;",
+                    (MAX_VALUE_LENGTH, MAX_VALUES_PER_COLUMN),
+                )
+                rows = [(_normalize(value), value, table, column) for (value,) in cursor.fetchall() if value.strip()]
+                index.executemany("INSERT INTO value_terms VALUES (?, ?, ?, ?);", rows)
+                index.executemany(
+                    "INSERT INTO value_fts (value, tbl, col) VALUES (?, ?, ?);",
+                    [(value, table, column) for _, value, table, column in rows],
+                )
+        index.execute("CREATE INDEX value_terms_norm ON value_terms (norm);")
+        index.commit()
+    finally:
+        source.close()
+        index.close()
+
+
+def extract_literals(question):
+    """Return candidate value literals mentioned in a question.
+
+    Quoted strings and runs of capitalized words (e.g. "British GP", "Lewis
+    Hamilton") are candidates, as are the individual words of a run.
+    """
+    candidates = [m.strip() for m in re.findall(r"[\"“'‘]([^\"”'’]{2,})[\"”'’]", question)]
+    words = re.findall(r"[\w][\w.&-]*", question)
+    run = []
+    for position, word in enumerate(words + [""]):
+        capitalized = word[:1].isupper() or (word.isupper() and len(word) > 1)
+        if capitalized and not (position == 0 and word.lower() in _QUESTION_WORDS):
+            run.append(word)
+            continue
+        if run:
+            candidates.append(" ".join(run))
+            if len(run) > 1:
+                candidates.extend(w for w in run if len(w) > 2)
+            run = []
+    seen = set()
+    return [c for c in candidates if not (c.casefold() in seen or seen.add(c.casefold()))]
+
+
+class ValueIndex:
+    def __init__(self, index_path, fresh=True):
+        self.index_path = index_path
+        # False while a stale index is served during its rebuild
+        self.fresh = fresh
+
+    def _connect(self):
+        return sqlite3.connect(f"file:{self.index_path}?mode=ro", uri=True, check_same_thread=False)
+
+    def lookup(self, literal, limit=VALUE_INDEX_MAX_MATCHES):
+        """Return ``{"exact": [...], "prefix": [...], "fuzzy": [...]}`` matches for a literal.
+
+        Each match is a ``(value, table, column)`` tuple. Fuzzy matching only
+        runs when there is no exact match.
+        """
+        norm = _normalize(literal)
+        conn = self._connect()
+        try:
+            exact = conn.execute(
+                "SELECT value, tbl, col FROM value_terms WHERE norm = ? LIMIT ?;", (norm, limit)
+            ).fetchall()
+            prefix = conn.execute(
+                "SELECT value, tbl, col FROM value_terms WHERE norm > ? AND norm < ? LIMIT ?;",
+                (norm, norm + "\U0010ffff", limit),
+            ).fetchall()
+            fuzzy = []
+            terms = [w for w in re.findall(r"\w+", norm) if len(w) >= 3]
+            if not exact and terms:
+                match_query = " OR ".join('"' + t.replace('"', '""') + '"' for t in terms)
+                rows = conn.execute(
+                    "SELECT value, tbl, col FROM value_fts WHERE value_fts MATCH ? ORDER BY rank LIMIT ?;",
+                    (match_query, limit * 10),
+                ).fetchall()
+                scored = [(difflib.SequenceMatcher(None, norm, _normalize(r[0])).ratio(), r) for r in rows]
+                scored.sort(key=lambda item: item[0], reverse=True)
+                fuzzy = [r for ratio, r in scored if ratio >= FUZZY_MIN_RATIO][:limit]
+            return {"exact": exact, "prefix": prefix, "fuzzy": fuzzy}
+        finally:
+            conn.close()
+
+    def evidence(self, question):
+        """Format value matches for every literal in ``question`` as prompt evidence."""
+        lines = []
+        literals = extract_literals(question)
+        for literal in literals:
+            # A word of a longer capitalized run is only worth reporting if it matched
+            is_part = any(literal != other and literal in other.split() for other in literals)
+            matches = self.lookup(literal)
+            parts = []
+            for kind in ("exact", "prefix", "fuzzy"):
+                if matches[kind]:
+                    found = "; ".join(f"{table}.{column} = {value!r}" for value, table, column in matches[kind])
+                    parts.append(f"{kind} match: {found}")
+            if parts:
+                lines.append(f'- "{literal}": ' + " | ".join(parts))
+            elif not is_part:
+                lines.append(f'- "{literal}": no matching value in the database')
+        if not lines:
+            return None
+        return "Database values matching literals in the question:\n" + "\n".join(lines)
+
+
+def get_value_index(path, db, fingerprint):
+    """Return the value index of a database, or None if it has not been built yet.
+
+    A missing or stale index is (re)built in the background when autobuild is on;
+    a stale index is still served meanwhile.
+    """
+    index_path = value_index_path(path, db)
+    fresh = is_fresh(index_path, fingerprint)
+    if VALUE_INDEX_AUTOBUILD and not fresh:
+        source_path = os.path.join(path, db, f"{db}.sqlite")
+        artifact_writer.submit_file(index_path, fingerprint, lambda tmp_path: build_value_index(source_path, tmp_path))
+    if not os.path.exists(index_path):
+        return None
+    return ValueIndex(index_path, fresh)
+
+
+if __name__ == "__main__":
+    from pathlib import Path
+
+    from schema_catalog import get_catalog
+
+    if len(sys.argv) < 2:
+        sys.exit("usage: python value_index.py <db_name> [<databases_path>]")
+    db_name = sys.argv[1]
+    databases_path = sys.argv[2] if len(sys.argv) > 2 else str((Path(__file__).resolve().parent / "../minidev/dev_databases").resolve())
+    catalog = get_catalog(databases_path, db_name)
+    target = value_index_path(databases_path, db_name)
+    artifact_writer.submit_file(
+        target, catalog.fingerprint,
+        lambda tmp_path: build_value_index(os.path.join(databases_path, db_name, f"{db_name}.sqlite"), tmp_path),
+    )
+    artifact_writer.flush()
+    print(f"Value index written to {target}")
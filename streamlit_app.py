@@ -1,6 +1,9 @@
 import streamlit as st
 import requests
+import base64
+import io
 import json
+import pandas as pd
 
 # Page config
 st.set_page_config(page_title="AmbiSQL - Streamlit", layout="wide")
@@ -18,10 +21,98 @@ if 'raw_result' not in st.session_state:
     st.session_state.raw_result = None
 if 'clarified_result' not in st.session_state:
     st.session_state.clarified_result = None
+if 'result_diff' not in st.session_state:
+    st.session_state.result_diff = None
 
 # API Base URL
 API_BASE = "http://localhost:8765/api"
 
+
+def stream_events(path, payload):
+    """POST to a streaming endpoint and yield its Server-Sent Events as (event, data)."""
+    with requests.post(f"{API_BASE}{path}", json=payload, stream=True) as response:
+        if response.status_code != 200:
+            yield "error", {"status": response.status_code, "error": response.text}
+            return
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event:"):
+                event = line[len("event:"):].strip()
+            elif line.startswith("data:") and event:
+                yield event, json.loads(line[len("data:"):].strip())
+                event = None
+
+
+def solve_stream(payload, status):
+    """Run /sql/solve/stream, reporting progress in ``status``; return the final payload."""
+    for event, data in stream_events("/sql/solve/stream", payload):
+        if event == "clarified":
+            status.write(f"Refined question: {data.get('question')}")
+        elif event == "sql_raw":
+            status.write("Raw SQL generated")
+        elif event == "sql_clarified":
+            status.write("Clarified SQL generated")
+        elif event == "error":
+            raise RuntimeError(f"{data.get('status')} - {data.get('error')}")
+        elif event == "done":
+            return data
+    raise RuntimeError("Stream ended before the SQL was generated")
+
+
+def result_frame(result):
+    """Build a DataFrame from one /sql/compare result (columnar, arrow or row format)."""
+    columns = result.get('columns') or None
+    if 'values' in result:
+        values = result['values']
+        frame = pd.DataFrame({index: column for index, column in enumerate(values)})
+        frame.columns = columns or [f"column_{i}" for i in range(len(values))]
+        return frame
+    if 'arrow' in result:
+        import pyarrow.ipc
+        return pyarrow.ipc.open_stream(io.BytesIO(base64.b64decode(result['arrow']))).read_pandas()
+    return pd.DataFrame(result.get('rows') or [], columns=columns)
+
+
+def render_result(result):
+    """Show one side of a /sql/compare response: row count, timing, truncation and the rows."""
+    if not isinstance(result, dict):
+        st.dataframe(result)
+        return
+    if not result.get('success'):
+        st.error(f"❌ Evaluation: Failed - {result.get('error', '')}")
+        return
+    count = result.get('row_count', 0)
+    elapsed = result.get('elapsed_ms')
+    st.info(f"Rows: {count}" + (f" · {elapsed:.0f} ms" if elapsed is not None else ""))
+    if result.get('truncated'):
+        st.caption(f"Showing the first {count} rows; the query returned more.")
+    if count:
+        st.dataframe(result_frame(result))
+
+
+def render_diff(diff):
+    """Show the server-side diff of the raw and clarified results."""
+    if diff.get('error'):
+        st.warning(f"Result diff unavailable: {diff['error']}")
+        return
+    if diff.get('equal'):
+        st.success(f"Both queries return the same {diff['raw_rows']} rows")
+    mode = "row by row (ordered)" if diff.get('ordered') else "as multisets"
+    st.markdown(f"**Result diff** ({mode})")
+    c1, c2, c3 = st.columns(3)
+    c1.metric("In both", diff.get('intersection', 0))
+    c2.metric("Only without AmbiSQL", diff.get('only_raw', 0))
+    c3.metric("Only with AmbiSQL", diff.get('only_clarified', 0))
+    if not diff.get('complete', True):
+        st.caption("Only the first rows of a very large result were compared.")
+    if not diff.get('columns_match', True):
+        st.caption("The two queries return a different number of columns.")
+    samples = diff.get('samples') or {}
+    for key, label in (('only_raw', "Example rows only without AmbiSQL"), ('only_clarified', "Example rows only with AmbiSQL")):
+        if samples.get(key):
+            with st.expander(label):
+                st.dataframe(samples[key])
+
 st.title("🔍 AmbiSQL - SQL Ambiguity Resolver")
 st.markdown("---")
 
@@ -66,24 +157,34 @@ with col1:
             st.session_state.clarified_sql = None
             st.session_state.raw_result = None
             st.session_state.clarified_result = None
+            st.session_state.result_diff = None
             st.rerun()
 
     with btn_col2:
         if st.button("🚀 Submit", type="primary", use_container_width=True):
-            with st.spinner("Analyzing question for ambiguities..."):
+            with st.status("Analyzing question for ambiguities...", expanded=True) as status:
                 try:
-                    response = requests.post(
-                        f"{API_BASE}/sql/analyze",
-                        json={
-                            "question": question,
-                            "dialect": dialect,
-                            "db": db_used,
-                            "session_id": st.session_state.session_id
-                        }
-                    )
-
-                    if response.status_code == 200:
-                        data = response.json()
+                    data = None
+                    for event, payload in stream_events("/sql/analyze/stream", {
+                        "question": question,
+                        "dialect": dialect,
+                        "db": db_used,
+                        "session_id": st.session_state.session_id
+                    }):
+                        if event == "session":
+                            st.session_state.session_id = payload.get('session_id')
+                        elif event == "schema":
+                            status.write(f"Schema linked: {len(payload.get('suggested_schema') or [])} tables")
+                        elif event == "ambiguity":
+                            amb = payload.get('ambiguity') or {}
+                            status.write(f"Ambiguity {payload.get('index', 0) + 1}: {amb.get('question', '')}")
+                        elif event == "error":
+                            status.update(label="Analysis failed", state="error")
+                            st.error(f"❌ Error: {payload.get('status')} - {payload.get('error')}")
+                        elif event == "done":
+                            data = payload
+
+                    if data is not None:
                         st.session_state.session_id = data.get('session_id')
                         ambiguities = data.get('ambiguities') or []
                         st.session_state.ambiguities = ambiguities
@@ -91,10 +192,10 @@ with col1:
                         st.session_state.clarification_list = [
                             {"question": amb, "answer": ""} for amb in ambiguities
                         ]
+                        status.update(label="Analysis complete", state="complete", expanded=False)
                         st.success(f"✅ Found {len(ambiguities)} ambiguities")
-                    else:
-                        st.error(f"❌ Error: {response.status_code} - {response.text}")
                 except requests.exceptions.RequestException as e:
+                    status.update(label="Analysis failed", state="error")
                     st.error(f"❌ Connection Error: {str(e)}")
 
     st.markdown("---")
@@ -149,67 +250,60 @@ with col1:
         )
 
         if st.button("✨ Submit Clarifications", type="primary", use_container_width=True):
-            with st.spinner("Generating SQL with clarifications..."):
+            with st.status("Generating SQL with clarifications...", expanded=True) as status:
                 try:
-                    response = requests.post(
-                        f"{API_BASE}/sql/solve",
-                        json={
-                            "session_id": st.session_state.session_id,
-                            "clarificationList": st.session_state.clarification_list,
-                            "additional_info": additional_info or "",
-                        }
-                    )
-
-                    if response.status_code == 200:
-                        data = response.json()
-                        # If further ambiguities returned, update and continue
-                        if data.get('ambiguities'):
-                            st.session_state.ambiguities = data['ambiguities']
-                            st.session_state.clarification_list = [
-                                {"question": amb, "answer": ""} for amb in data['ambiguities']
-                            ]
-                            st.info("More clarification needed. Please answer the new questions.")
-                            st.rerun()
-                        else:
-                            st.session_state.raw_sql = data.get('sql_statement_raw')
-                            st.session_state.clarified_sql = data.get('sql_statement_clarified')
-                            st.success("✅ Clarified SQL generated!")
-                            st.rerun()
+                    data = solve_stream({
+                        "session_id": st.session_state.session_id,
+                        "clarificationList": st.session_state.clarification_list,
+                        "additional_info": additional_info or "",
+                    }, status)
+                    # If further ambiguities returned, update and continue
+                    if data.get('ambiguities'):
+                        st.session_state.ambiguities = data['ambiguities']
+                        st.session_state.clarification_list = [
+                            {"question": amb, "answer": ""} for amb in data['ambiguities']
+                        ]
+                        st.info("More clarification needed. Please answer the new questions.")
+                        st.rerun()
                     else:
-                        st.error(f"❌ Error: {response.status_code} - {response.text}")
+                        st.session_state.raw_sql = data.get('sql_statement_raw')
+                        st.session_state.clarified_sql = data.get('sql_statement_clarified')
+                        st.success("✅ Clarified SQL generated!")
+                        st.rerun()
+                except RuntimeError as e:
+                    status.update(label="SQL generation failed", state="error")
+                    st.error(f"❌ Error: {e}")
                 except requests.exceptions.RequestException as e:
+                    status.update(label="SQL generation failed", state="error")
                     st.error(f"❌ Connection Error: {str(e)}")
     else:
         st.info("No ambiguities detected. You can still generate SQL.")
         # Allow generating SQL even when no ambiguities were found in analysis
         if st.session_state.session_id and st.button("✨ Generate SQL", type="primary", use_container_width=True):
-            with st.spinner("Generating SQL..."):
+            with st.status("Generating SQL...", expanded=True) as status:
                 try:
-                    response = requests.post(
-                        f"{API_BASE}/sql/solve",
-                        json={
-                            "session_id": st.session_state.session_id,
-                            "clarificationList": [],
-                            "additional_info": "",
-                        }
-                    )
-                    if response.status_code == 200:
-                        data = response.json()
-                        if data.get('ambiguities'):
-                            st.session_state.ambiguities = data['ambiguities']
-                            st.session_state.clarification_list = [
-                                {"question": amb, "answer": ""} for amb in data['ambiguities']
-                            ]
-                            st.info("More clarification needed. Please answer the new questions.")
-                            st.rerun()
-                        else:
-                            st.session_state.raw_sql = data.get('sql_statement_raw')
-                            st.session_state.clarified_sql = data.get('sql_statement_clarified')
-                            st.success("✅ SQL generated!")
-                            st.rerun()
+                    data = solve_stream({
+                        "session_id": st.session_state.session_id,
+                        "clarificationList": [],
+                        "additional_info": "",
+                    }, status)
+                    if data.get('ambiguities'):
+                        st.session_state.ambiguities = data['ambiguities']
+                        st.session_state.clarification_list = [
+                            {"question": amb, "answer": ""} for amb in data['ambiguities']
+                        ]
+                        st.info("More clarification needed. Please answer the new questions.")
+                        st.rerun()
                     else:
-                        st.error(f"❌ Error: {response.status_code} - {response.text}")
+                        st.session_state.raw_sql = data.get('sql_statement_raw')
+                        st.session_state.clarified_sql = data.get('sql_statement_clarified')
+                        st.success("✅ SQL generated!")
+                        st.rerun()
+                except RuntimeError as e:
+                    status.update(label="SQL generation failed", state="error")
+                    st.error(f"❌ Error: {e}")
                 except requests.exceptions.RequestException as e:
+                    status.update(label="SQL generation failed", state="error")
                     st.error(f"❌ Connection Error: {str(e)}")
 
 with col2:
@@ -220,16 +314,7 @@ with col2:
     if st.session_state.raw_sql:
         st.code(st.session_state.raw_sql, language="sql")
         if st.session_state.raw_result:
-            if isinstance(st.session_state.raw_result, dict) and st.session_state.raw_result.get('success'):
-                rows = st.session_state.raw_result.get('rows')
-                count = st.session_state.raw_result.get('row_count', 0)
-                st.info(f"Rows: {count}")
-                if isinstance(rows, list) and len(rows) > 0:
-                    st.dataframe(rows)
-            elif isinstance(st.session_state.raw_result, dict):
-                st.error(f"❌ Evaluation: Failed - {st.session_state.raw_result.get('error', '')}")
-            else:
-                st.dataframe(st.session_state.raw_result)
+            render_result(st.session_state.raw_result)
     else:
         st.info("Raw SQL will appear here after submission")
 
@@ -240,19 +325,14 @@ with col2:
     if st.session_state.clarified_sql:
         st.code(st.session_state.clarified_sql, language="sql")
         if st.session_state.clarified_result:
-            if isinstance(st.session_state.clarified_result, dict) and st.session_state.clarified_result.get('success'):
-                rows = st.session_state.clarified_result.get('rows')
-                count = st.session_state.clarified_result.get('row_count', 0)
-                st.info(f"Rows: {count}")
-                if isinstance(rows, list) and len(rows) > 0:
-                    st.dataframe(rows)
-            elif isinstance(st.session_state.clarified_result, dict):
-                st.error(f"❌ Evaluation: Failed - {st.session_state.clarified_result.get('error', '')}")
-            else:
-                st.dataframe(st.session_state.clarified_result)
+            render_result(st.session_state.clarified_result)
     else:
         st.info("Clarified SQL will appear here after clarification")
 
+    if st.session_state.result_diff:
+        st.markdown("---")
+        render_diff(st.session_state.result_diff)
+
     st.markdown("---")
 
     # Compare button
@@ -262,7 +342,7 @@ with col2:
             try:
                 response = requests.post(
                     f"{API_BASE}/sql/compare",
-                    json={"session_id": st.session_state.session_id}
+                    json={"session_id": st.session_state.session_id, "format": "columnar"}
                 )
 
                 if response.status_code == 200:
@@ -271,6 +351,7 @@ with col2:
                     st.session_state.clarified_sql = data.get('clarified_sql')
                     st.session_state.raw_result = data.get('raw_result')
                     st.session_state.clarified_result = data.get('clarified_result')
+                    st.session_state.result_diff = data.get('diff')
                     st.success("✅ Comparison complete!")
                     st.rerun()
                 else:
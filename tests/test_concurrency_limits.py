@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import httpx
+from openai import RateLimitError
+
+from llm_pool import ConcurrencyLimiter, llm_pool
+from rate_limiter import AIMDController
+
+
+def rate_limit_error(retry_after="0"):
+    request = httpx.Request("POST", "https://api.example.test/v1/chat/completions")
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=request)
+    return RateLimitError("rate limited", response=response, body=None)
+
+
+def test_throttle_halves_the_limit():
+    limiter = ConcurrencyLimiter(8)
+    controller = AIMDController(limiter, min_limit=1, max_limit=8, latency_target=0)
+    controller.on_throttle()
+    assert limiter.limit == 4
+    assert controller.throttled == 1
+
+
+def test_a_burst_of_throttles_counts_once():
+    limiter = ConcurrencyLimiter(8)
+    controller = AIMDController(limiter, min_limit=1, max_limit=8, latency_target=0, cooldown=60)
+    for _ in range(5):
+        controller.on_throttle()
+    assert limiter.limit == 4
+    assert controller.throttled == 5
+
+
+def test_limit_never_drops_below_the_minimum():
+    limiter = ConcurrencyLimiter(3)
+    controller = AIMDController(limiter, min_limit=2, max_limit=8, latency_target=0, cooldown=0)
+    for _ in range(4):
+        controller.on_throttle()
+    assert limiter.limit == 2
+
+
+def test_successes_grow_the_limit_additively():
+    limiter = ConcurrencyLimiter(2)
+    controller = AIMDController(limiter, min_limit=1, max_limit=3, latency_target=0)
+    for _ in range(2):
+        controller.on_success()
+    assert limiter.limit == 3
+    for _ in range(10):
+        controller.on_success()
+    assert limiter.limit == 3
+
+
+def test_slow_calls_shrink_the_limit():
+    limiter = ConcurrencyLimiter(10)
+    controller = AIMDController(limiter, min_limit=1, max_limit=10, latency_target=1.0)
+    controller.on_success(latency=5.0)
+    assert limiter.limit == 9
+
+
+def test_a_429_through_the_pool_halves_the_model_limit_and_retries():
+    model = "test-model-429"
+    limits = llm_pool.limits(model)
+    before = limits.limiter.limit
+    attempts = []
+
+    def create():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise rate_limit_error()
+        return "ok"
+
+    with llm_pool.slot(model) as slot:
+        assert slot.call(create) == "ok"
+    assert len(attempts) == 2
+    assert limits.limiter.limit == max(1, before // 2)
+    assert limits.controller.throttled == 1
+
+
+def test_lowered_limit_holds_back_new_callers():
+    limiter = ConcurrencyLimiter(2)
+    limiter.acquire()
+    limiter.acquire()
+    limiter.set_limit(1)
+    acquired = threading.Event()
+    threading.Thread(target=lambda: (limiter.acquire(), acquired.set()), daemon=True).start()
+    limiter.release()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(1)
+
+
+def test_released_slot_goes_to_an_async_waiter():
+    async def scenario():
+        limiter = ConcurrencyLimiter(1)
+        limiter.acquire()
+        waiter = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0)
+        assert not waiter.done()
+        limiter.release()
+        await asyncio.wait_for(waiter, 1)
+        assert limiter.in_use == 1
+
+    asyncio.run(scenario())
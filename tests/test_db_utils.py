@@ -0,0 +1,67 @@
+import sqlite3
+import time
+
+import pytest
+
+from db_utils import QueryTimeout, decode_cursor, encode_cursor, open_query, run_query
+
+SLOW_QUERY = "WITH RECURSIVE c(x) AS (SELECT 1 UNION ALL SELECT x + 1 FROM c) SELECT count(*) FROM c"
+
+
+@pytest.fixture
+def databases(tmp_path):
+    (tmp_path / "numbers").mkdir()
+    connection = sqlite3.connect(tmp_path / "numbers" / "numbers.sqlite")
+    connection.execute("CREATE TABLE numbers (n INTEGER)")
+    connection.executemany("INSERT INTO numbers VALUES (?)", [(n,) for n in range(25)])
+    connection.commit()
+    connection.close()
+    return str(tmp_path)
+
+
+def test_cursor_round_trip():
+    sql = "SELECT n FROM numbers ORDER BY n"
+    assert decode_cursor(encode_cursor(sql, 40), sql) == 40
+
+
+def test_cursor_of_another_query_is_rejected():
+    token = encode_cursor("SELECT n FROM numbers", 10)
+    with pytest.raises(ValueError, match="does not belong"):
+        decode_cursor(token, "SELECT n FROM numbers WHERE n > 3")
+
+
+@pytest.mark.parametrize("token", ["not a cursor", "e30=", ""])
+def test_malformed_cursor_is_rejected(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, "SELECT 1")
+
+
+def test_pages_follow_their_cursors(databases):
+    sql = "SELECT n FROM numbers ORDER BY n"
+    first = run_query(databases, "numbers", sql, max_rows=10)
+    assert first.truncated and [row[0] for row in first.rows] == list(range(10))
+    second = run_query(databases, "numbers", sql, max_rows=10, offset=decode_cursor(first.next_cursor, sql))
+    assert [row[0] for row in second.rows] == list(range(10, 20))
+    last = run_query(databases, "numbers", sql, max_rows=10, offset=decode_cursor(second.next_cursor, sql))
+    assert len(last.rows) == 5 and not last.truncated and last.next_cursor is None
+
+
+def test_query_past_its_deadline_raises_query_timeout(databases):
+    started = time.monotonic()
+    with pytest.raises(QueryTimeout):
+        with open_query(databases, "numbers", SLOW_QUERY, timeout=0.2) as cursor:
+            cursor.fetchall()
+    assert time.monotonic() - started < 5
+
+
+def test_run_query_reports_the_timeout(databases):
+    result = run_query(databases, "numbers", SLOW_QUERY, timeout=0.2)
+    assert result.timed_out
+    assert not result.success
+    assert result.to_dict()["timed_out"] is True
+
+
+def test_connections_are_read_only(databases):
+    result = run_query(databases, "numbers", "DELETE FROM numbers")
+    assert not result.success
+    assert run_query(databases, "numbers", "SELECT count(*) FROM numbers").rows == [(25,)]
@@ -0,0 +1,62 @@
+import pytest
+
+from db_utils import QueryResult
+from result_diff import RowDigest, diff_results
+
+
+def result(rows, ordered=False, max_rows=0):
+    query_result = QueryResult("SELECT 1")
+    query_result.columns = ["value"]
+    query_result.rows = rows
+    query_result.digest = RowDigest(ordered=ordered, max_rows=max_rows)
+    query_result.digest.extend(rows)
+    return query_result
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_values_whose_python_hashes_collide_differ(ordered):
+    # hash(-1) == hash(-2) in CPython
+    diff = diff_results(result([(-1,)], ordered), result([(-2,)], ordered))
+    assert not diff["equal"]
+    assert diff["intersection"] == 0
+
+
+@pytest.mark.parametrize("ordered", [False, True])
+def test_values_of_different_types_differ(ordered):
+    diff = diff_results(result([(1,), (1.0,), (True,)], ordered), result([(True,), (1,), (1.0,)], ordered))
+    if ordered:
+        assert diff["intersection"] == 0
+        assert diff["first_difference"] == 0
+    else:
+        assert diff["equal"]
+    diff = diff_results(result([(1,)], ordered), result([(1.0,)], ordered))
+    assert not diff["equal"]
+    assert diff["samples"]["only_raw"] and diff["samples"]["only_clarified"]
+
+
+def test_null_rows_match():
+    diff = diff_results(result([(None, 1), (None, None)]), result([(None, None), (None, 1)]))
+    assert diff["equal"]
+    diff = diff_results(result([(None,)]), result([("None",)]))
+    assert diff["intersection"] == 0
+
+
+def test_multiset_counts_and_samples():
+    diff = diff_results(result([(1,), (1,), (2,), (3,)]), result([(1,), (2,), (4,)]))
+    assert (diff["intersection"], diff["only_raw"], diff["only_clarified"]) == (2, 2, 1)
+    assert sorted(diff["samples"]["only_raw"]) == [[1], [3]]
+    assert diff["samples"]["only_clarified"] == [[4]]
+
+
+def test_ordered_compares_positions():
+    diff = diff_results(result([(1,), (2,), (3,)], True), result([(1,), (3,), (2,)], True))
+    assert diff["intersection"] == 1
+    assert diff["first_difference"] == 1
+    assert diff["samples"]["only_raw"][0] == {"position": 1, "row": [2]}
+
+
+def test_row_cap_marks_the_diff_incomplete():
+    diff = diff_results(result([(1,)] * 5, max_rows=3), result([(1,)] * 5, max_rows=3))
+    assert diff["raw_rows"] == 3
+    assert not diff["complete"]
+    assert not diff["equal"]
@@ -0,0 +1,74 @@
+from schema_index import SchemaIndex, key_links, tokenize
+
+
+def column(description, pk=False, values=""):
+    info = {"column_description": description, "value_description": values}
+    if pk:
+        info["pk"] = "Primary Key"
+    return info
+
+
+SCHEMA = {
+    "drivers": {
+        "driverId": column("the unique identification number identifying each driver", pk=True),
+        "forename": column("forename of the driver"),
+        "surname": column("surname of the driver"),
+        "nationality": column("nationality of the driver"),
+    },
+    "races": {
+        "raceId": column("the unique identification number identifying the race", pk=True),
+        "year": column("year of the race"),
+        "name": column("name of the race"),
+    },
+    "status": {
+        "statusId": column("the unique identification number identifying the status", pk=True),
+        "status": column("full name of the status", values="Finished, Accident, Engine"),
+    },
+    "results": {
+        "resultId": column("the unique identification number identifying the result", pk=True),
+        "raceId": column("the identification number identifying the race"),
+        "driverId": column("the identification number identifying the driver"),
+        "statusId": column("status ID"),
+        "fastestLapSpeed": column("fastest lap speed", values="km/h"),
+    },
+    "circuits": {
+        "circuitId": column("unique identification number of the circuit", pk=True),
+        "location": column("location of the circuit"),
+        "country": column("country of the circuit"),
+    },
+}
+
+
+def test_tokenize_splits_camel_case_and_drops_stopwords():
+    assert tokenize("What is the fastestLapSpeed of drivers?") == ["fastest", "lap", "speed", "driver"]
+
+
+def test_key_links_follow_primary_keys_by_name():
+    assert key_links(SCHEMA) == {"results": {"drivers", "races", "status"}}
+
+
+def test_question_covered_by_one_table_is_confident():
+    ranking = SchemaIndex.from_schema_json(SCHEMA).rank("What is the fastest lap speed?")
+    assert ranking.confident
+    assert ranking.confident_tables == ["results"]
+    # The tables results joins to are linked too, so joins are not lost
+    assert ranking.linked_tables == ["results", "drivers", "races", "status"]
+
+
+def test_question_with_unmatched_terms_is_not_confident():
+    ranking = SchemaIndex.from_schema_json(SCHEMA).rank("What was Sebastian Vettel's fastest lap speed?")
+    assert not ranking.confident
+    assert "vettel" not in set().union(*ranking.matched_terms.values())
+    assert ranking.top_tables(1) == ["results"]
+
+
+def test_question_spread_over_many_tables_is_not_confident():
+    ranking = SchemaIndex.from_schema_json(SCHEMA).rank("identification number")
+    assert len(ranking.confident_tables) > 2
+    assert not ranking.confident
+
+
+def test_question_matching_nothing_is_not_confident():
+    ranking = SchemaIndex.from_schema_json(SCHEMA).rank("Who painted the Mona Lisa?")
+    assert ranking.table_scores == []
+    assert not ranking.confident
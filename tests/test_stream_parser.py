@@ -0,0 +1,67 @@
+import json
+
+import pytest
+
+from utils import QuestionSetStreamParser
+
+QUESTION_SET = [
+    {
+        "question": 'Which "race" do you mean?',
+        "ambiguity_type": "entity",
+        "description": {"term": "race {id}", "candidates": ["races.name", "races.raceId"], "note": "ends with \\"},
+    },
+    {
+        "question": "Fastest lap in {seconds} or [minutes]?",
+        "ambiguity_type": "unit",
+        "description": {"nested": {"deeper": [1, 2, {"x": "}]"}]}},
+    },
+    {"question": "Which season?", "ambiguity_type": "time", "description": {}},
+]
+
+RESPONSE = (
+    "Here is the analysis.\n```json\n"
+    + json.dumps({"has_ambiguity": True, "reasoning": "a {brace} and \"quote\"",
+                  "question_set": QUESTION_SET}, indent=2)
+    + "\n```\n"
+)
+
+
+def feed_in_chunks(text, size):
+    parser = QuestionSetStreamParser()
+    items = []
+    for start in range(0, len(text), size):
+        items.extend(parser.feed(text[start:start + size]))
+    return parser, items
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 16, 64, len(RESPONSE)])
+def test_items_are_extracted_at_any_chunk_size(size):
+    _, items = feed_in_chunks(RESPONSE, size)
+    assert items == QUESTION_SET
+
+
+def test_item_is_returned_by_the_chunk_that_closes_it():
+    parser = QuestionSetStreamParser()
+    first = json.dumps(QUESTION_SET[0])
+    assert parser.feed('{"question_set": [' + first[:-1]) == []
+    assert parser.feed("}, ") == [QUESTION_SET[0]]
+
+
+def test_only_the_open_item_is_buffered():
+    parser = QuestionSetStreamParser()
+    parser.feed(RESPONSE)
+    assert parser.text == ""
+    parser = QuestionSetStreamParser()
+    parser.feed('{"question_set": [{"question": "partial')
+    assert parser.text == '{"question": "partial'
+
+
+def test_nested_arrays_named_like_the_key_are_ignored():
+    text = json.dumps({"other": {"question_set": [{"question": "no"}]}, "question_set": [{"question": "yes"}]})
+    _, items = feed_in_chunks(text, 5)
+    assert items == [{"question": "yes"}]
+
+
+def test_python_literals_are_accepted():
+    _, items = feed_in_chunks('{"question_set": [{"question": "q", "flag": True, "value": None}]}', 4)
+    assert items == [{"question": "q", "flag": True, "value": None}]